@@ -1 +1,2 @@
-from .main import COMMAND_ROOT, FRAME_BINARY, FRAME_EOF, FRAME_JSON, FRAME_NULL, FRAME_TEXT, STATUS_NOTFOUND, STATUS_OK, pack_eof, pack_frame, Session, SessionHandler, BaseDuplexHandler, CommandDuplexContext, CommandError, CommandHandler, CommandManager, InternalCommandError, StatusCode
+from .main import COMMAND_ROOT, FRAME_BINARY, FRAME_EOF, FRAME_FRAGMENT, FRAME_FRAGMENT_END, FRAME_JSON, FRAME_NULL, FRAME_RESULT, FRAME_STRUCT, FRAME_TEXT, STATUS_NOTFOUND, STATUS_OK, pack_eof, pack_frame, encode_frame, iterate_chunks, pack_result, unpack_result, unpack_frame, pack_batch, unpack_batch, pack_struct, unpack_struct, Session, SessionHandler, BaseDuplexHandler, CommandDuplexContext, CommandCancelled, CommandError, CommandFailed, CommandHandler, CommandManager, CommandScheduler, FrameRouter, FrameSegment, FrameWriter, HandlerPool, InternalCommandError, MemoryBudget, Overloaded, PoolContext, Priority, PubSub, ReplayLost, ResultCache, SessionMisdirected, SharedFrame, StatusCode, TicketSigner, TransportSessionHandler, VerifierPool
+from .store import SessionStore, MemorySessionStore, SQLiteSessionStore
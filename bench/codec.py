@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+# Microbenchmark for the long-poll batch codec.
+# Compares `main.pack_batch`/`main.unpack_batch` against the previous
+# `StreamReader`-based path used by `duplex.QuartLongPollManager`.
+
+import time
+import asyncio
+import argparse
+from pbnj import main
+
+COMMAND = (1).to_bytes(4, "little")
+
+# previous implementation, kept here for comparison
+
+async def legacy_pack(data:list[bytes]) -> bytes:
+    to = asyncio.StreamReader()
+    to.feed_data(len(data).to_bytes(4, "little", signed=False))
+    for i in data:
+        to.feed_data(len(i).to_bytes(4, "little", signed=False))
+        to.feed_data(i)
+    to.feed_eof()
+
+    res = []
+    while True:
+        chunk = await to.read(8192)
+        if not chunk:
+            break
+        res.append(chunk)
+    return b"".join(res)
+
+async def legacy_unpack(body:bytes) -> list[bytes]:
+    async def feed(to:asyncio.StreamReader):
+        to.feed_data(body)
+        to.feed_eof()
+
+    reader = asyncio.StreamReader()
+    asyncio.create_task(feed(reader))
+
+    res = []
+    for i in range(int.from_bytes(await reader.readexactly(4), "little", signed=False)):
+        length = int.from_bytes(await reader.readexactly(4), "little", signed=False)
+        res.append(await reader.readexactly(length))
+    return res
+
+# new implementation
+
+async def batch_pack(data:list[bytes]) -> bytes:
+    return main.pack_batch(data)
+
+async def batch_unpack(body:bytes) -> list[memoryview]:
+    return main.unpack_batch(body)
+
+# runner
+
+async def measure(fn, arg, rounds:int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await fn(arg)
+    return time.perf_counter() - start
+
+async def run(count:int, size:int, rounds:int):
+    messages = [COMMAND + b"\x40" + bytes(size) for _ in range(count)]
+    body = main.pack_batch(messages)
+
+    assert await legacy_pack(messages) == body
+    assert [bytes(i) for i in await batch_unpack(body)] == await legacy_unpack(body)
+
+    print(f"{count} messages x {size} bytes, {rounds} rounds")
+    for name, old, new, arg in (
+            ("pack", legacy_pack, batch_pack, messages),
+            ("unpack", legacy_unpack, batch_unpack, body)):
+        t_old = await measure(old, arg, rounds)
+        t_new = await measure(new, arg, rounds)
+        rate = count * rounds / t_new
+
+        print(f"  {name:<7}legacy {t_old * 1e6 / rounds:9.1f} us  batch {t_new * 1e6 / rounds:9.1f} us  "
+              f"x{t_old / t_new:5.1f}  ({rate:,.0f} msg/s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    for count, size in ((1, 32), (64, 32), (512, 32), (64, 4096)):
+        asyncio.run(run(count, size, args.rounds))
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+# Benchmark for broadcasting one value to many sessions.
+# Compares sending to each subscriber with `CommandDuplexContext.send()`, which
+# packs the value every time, against `main.PubSub.publish()`, which packs it once.
+# Each round is drained through `pack_outgoing()`, as a poll response would be.
+
+import time
+import asyncio
+import argparse
+from pbnj import main, duplex
+
+COMMAND = (1).to_bytes(4, "little")
+
+def payload(size:int) -> dict:
+    return {"flags": {f"flag-{i}": i % 3 == 0 for i in range(size // 16)}, "version": 1}
+
+class PollHandler(main.BaseDuplexHandler):
+    "The outgoing side of `duplex.QuartLongPollHandler`, without the request handling."
+
+    fragment_size = 65536
+
+    def __init__(self):
+        self.manager = duplex.QuartLongPollManager(None, window=1 << 30, max_outgoing=1 << 30)
+
+    async def send(self, data:bytes):
+        await self.manager.put(data)
+
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        await self.manager.put((cmd, frame))
+
+    def attach(self, cmd:bytes) -> asyncio.Queue:
+        return asyncio.Queue()
+
+async def setup(sessions:int) -> tuple[list[duplex.QuartLongPollManager],list[main.CommandDuplexContext],main.PubSub]:
+    hub = main.PubSub()
+    managers = []
+    contexts = []
+
+    for _ in range(sessions):
+        handler = PollHandler()
+        ctx = main.CommandDuplexContext(handler, COMMAND)
+        hub.subscribe("config", ctx)
+        managers.append(handler.manager)
+        contexts.append(ctx)
+
+    return managers, contexts, hub
+
+async def drain(managers:list[duplex.QuartLongPollManager]) -> int:
+    return sum([len(await i.pack_outgoing()) for i in managers])
+
+async def run(sessions:int, size:int, rounds:int):
+    managers, contexts, hub = await setup(sessions)
+    value = payload(size)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i in contexts:
+            await i.send(value)
+        sent = await drain(managers)
+    t_loop = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await hub.publish("config", value)
+        assert await drain(managers) == sent
+    t_pub = (time.perf_counter() - start) / rounds
+
+    print(f"{sessions:>6} sessions  {size:>6} bytes  loop {t_loop * 1e3:8.2f} ms  publish {t_pub * 1e3:8.2f} ms  "
+          f"x{t_loop / t_pub:4.1f}  ({t_pub * 1e6 / sessions:.2f} us/session)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    for sessions in (10, 100, 1000, 5000):
+        for size in (256, 16384):
+            asyncio.run(run(sessions, size, args.rounds))
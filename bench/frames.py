@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+# Benchmark for structured frames against JSON frames.
+# Reports encoded size and encode/decode time for a few payload shapes,
+# using the standard library `json` module and, if installed, `orjson`.
+
+import json
+import time
+import random
+import argparse
+from pbnj import main
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# payloads
+
+def telemetry() -> dict:
+    return {
+        "server": "8f14e45f-ceea-467f-a8f5-7c2d1e2f0a11",
+        "tick": 192311,
+        "players": [
+            {"id": 1000 + i, "pos": [random.uniform(-500, 500) for _ in range(3)], "hp": random.randint(0, 100)}
+            for i in range(24)
+        ],
+        "fps": 59.81,
+        "memory": 1843.5
+    }
+
+PAYLOADS = {
+    "telemetry": telemetry,
+    "floats[4096]": lambda: [random.random() for _ in range(4096)],
+    "ints[4096]": lambda: [random.randint(-100000, 100000) for _ in range(4096)],
+    "strings[256]": lambda: [f"item-{i}" for i in range(256)]
+}
+
+# codecs
+
+CODECS = {
+    "json": (lambda v: bytes(json.dumps(v), "utf8"), json.loads),
+    "struct": (main.pack_struct, main.unpack_struct)
+}
+
+if orjson is not None:
+    CODECS["orjson"] = (orjson.dumps, orjson.loads)
+
+# runner
+
+def measure(fn, arg, rounds:int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.perf_counter() - start) / rounds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    for name, make in PAYLOADS.items():
+        value = make()
+        print(name)
+
+        for codec, (encode, decode) in CODECS.items():
+            data = encode(value)
+            t_enc = measure(encode, value, args.rounds)
+            t_dec = measure(decode, data, args.rounds)
+
+            print(f"  {codec:<7}{len(data):>8} bytes  encode {t_enc * 1e6:9.1f} us  decode {t_dec * 1e6:9.1f} us")
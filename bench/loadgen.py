@@ -0,0 +1,445 @@
+#!/usr/bin/python3
+
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+# Load generator for the long-poll, websocket and stream transports.
+# Runs a `QuartLongPollSessionManager` (or, with `--transport websocket`, a
+# `QuartWebsocketSessionManager`) in-process behind Quart's test client,
+# or with `--transport stream`, a `stream.StreamSessionServer` on a Unix socket,
+# and simulates `--servers` clients, each running `--commands` persistent echo
+# commands (as in `example-persistent`). Every command keeps one message in flight.
+# `--transport client` runs the long-poll server, driven through `longpoll.LongPollClient`
+# (over httpx's ASGI transport) instead of the bare simulated client.
+# Results are written as JSON, to stdout or `--output`, for comparison between runs.
+
+import os
+import sys
+import json
+import time
+import typing
+import asyncio
+import argparse
+import tempfile
+import resource
+import platform
+from pbnj import main, duplex, stream, longpoll
+from argon2 import PasswordHasher
+from quart import Quart, Response, request
+
+KEY = "loadgen"
+
+# server
+
+def make_app(transport:str, cooldown:float, poll_options:dict, lanes:int=1) -> tuple[Quart,main.SessionHandler,list]:
+    # Auth cost isn't what's being measured, so the hash is made as cheap as argon2 allows.
+    hasher = PasswordHasher(time_cost=1, memory_cost=64, parallelism=1)
+    commands = main.CommandHandler()
+    opened = []
+
+    @commands.command("echo")
+    async def echo(pipe:main.CommandDuplexContext):
+        async with pipe as p:
+            while True:
+                await p.send(await p.recv())
+
+    if transport == "websocket":
+        sessions = duplex.QuartWebsocketSessionManager(commands, hasher.hash(KEY), hasher, socket_options=poll_options)
+    elif transport == "stream":
+        sessions = stream.StreamSessionServer(commands, hasher.hash(KEY), hasher, stream_options=poll_options)
+    else:
+        sessions = duplex.QuartLongPollSessionManager(
+            commands,
+            hasher.hash(KEY),
+            hasher,
+            poll_options={"cooldown": cooldown, **poll_options},
+            lanes=lanes
+        )
+    app = Quart(__name__)
+
+    @app.route("/auth", methods=["POST"])
+    async def auth():
+        ses = await sessions.authenticate(await request.get_data(False))
+        opened.append(ses)
+        token = await ses.rotate_key(3600)
+
+        response = Response("OK", 200)
+        response.headers.set("X-Pbj-Session-Id", str(ses.id))
+        response.headers.set("X-Pbj-Session", token)
+        return response
+
+    if transport == "websocket":
+        app.websocket("/pbj")(sessions.websocket_handler)
+    elif transport in ("longpoll", "client"):
+        app.route("/pbj", methods=["POST"])(sessions.request_handler)
+        app.route("/pbj", methods=["PUT"])(sessions.push_handler)
+
+    return app, sessions, opened
+
+# client
+
+class SimServer:
+    "One simulated game server, with a poll loop and a send loop like the Luau client."
+
+    def __init__(self, app:Quart, commands:int, payload:bytes, results:dict, lanes:int=1):
+        self.__client = app.test_client()
+        self.__commands = [(i + 1).to_bytes(4, "little") for i in range(commands)]
+        self.__payload = payload
+        self.__results = results
+        self.__outgoing = []
+        self.__ready = asyncio.Event()
+        self.__sent = {}
+        self.__headers = {}
+        self.__lanes = lanes
+        self.__ack = 0
+        self.__received = {}
+        self.__reorder = {}
+
+    def __queue(self, message:bytes):
+        self.__outgoing.append(message)
+        self.__ready.set()
+
+    async def connect(self):
+        res = await self.__client.post("/auth", data=bytes(KEY, "utf8"))
+        self.__headers = {
+            "X-Pbj-Session-Id": res.headers["X-Pbj-Session-Id"],
+            "X-Pbj-Session": res.headers["X-Pbj-Session"]
+        }
+
+        for i in self.__commands:
+            self.__queue(main.COMMAND_ROOT + i + b"\x04echo")
+            self.__send(i)
+
+    def __send(self, cmd:bytes):
+        self.__sent[cmd] = time.perf_counter()
+        self.__queue(cmd + main.FRAME_BINARY + self.__payload)
+
+    async def poll(self, deadline:float):
+        await asyncio.gather(*(self.__poll_lane(i, deadline) for i in range(self.__lanes)))
+
+    async def __poll_lane(self, lane:int, deadline:float):
+        while time.perf_counter() < deadline:
+            res = await self.__client.post("/pbj", data=main.pack_batch([]), headers={
+                **self.__headers,
+                "X-Pbj-Ack": str(self.__ack),
+                "X-Pbj-Lane": str(lane),
+                "X-Pbj-Received": str(self.__received.get(lane, -1))
+            })
+            if res.status_code != 200:
+                # Sessions are closed once the run is over, so only earlier failures count.
+                if time.perf_counter() < deadline:
+                    self.__results["errors"] += 1
+                return
+
+            now = time.perf_counter()
+            first, last = int(res.headers["X-Pbj-Seq-From"]), int(res.headers["X-Pbj-Seq"])
+            if "X-Pbj-Window" in res.headers:
+                self.__results["windows"].append(float(res.headers["X-Pbj-Window"]))
+
+            if last < first:
+                self.__results["batches"].append(0)
+                continue
+
+            # Batches from other lanes may arrive early, so they're handled in order, as the Luau client does.
+            self.__received[lane] = last
+            self.__reorder[first] = (last, await res.get_data())
+            while self.__ack + 1 in self.__reorder:
+                self.__ack, body = self.__reorder.pop(self.__ack + 1)
+                self.__receive(main.unpack_batch(body), now, deadline)
+
+    def __receive(self, messages:list[memoryview], now:float, deadline:float):
+        self.__results["batches"].append(len(messages))
+
+        for i in messages:
+            cmd = bytes(i[:4])
+            if i[4:5] != main.FRAME_BINARY:
+                continue
+
+            self.__results["latency"].append(now - self.__sent[cmd])
+            self.__results["received"] += 1
+            if now < deadline:
+                self.__send(cmd)
+
+    async def push(self, deadline:float):
+        while time.perf_counter() < deadline:
+            await self.__ready.wait()
+            self.__ready.clear()
+
+            # Let messages accumulate for a moment, as the Luau client does.
+            await asyncio.sleep(0)
+            messages = self.__outgoing
+            self.__outgoing = []
+
+            res = await self.__client.put("/pbj", data=main.pack_batch(messages), headers=self.__headers)
+            if res.status_code != 200:
+                # Sessions are closed once the run is over, so only earlier failures count.
+                if time.perf_counter() < deadline:
+                    self.__results["errors"] += 1
+                return
+            self.__results["sent"] += sum(1 for i in messages if i[:4] != main.COMMAND_ROOT)
+
+class SimSocketServer:
+    "One simulated game server on a websocket, with a read loop and a coalescing write loop."
+
+    def __init__(self, app:Quart, commands:int, payload:bytes, results:dict):
+        self.__client = app.test_client()
+        self.__commands = [(i + 1).to_bytes(4, "little") for i in range(commands)]
+        self.__payload = payload
+        self.__results = results
+        self.__outgoing = []
+        self.__ready = asyncio.Event()
+        self.__sent = {}
+        self.__socket = None
+        self.__ws = None
+
+    def __queue(self, message:bytes):
+        self.__outgoing.append(message)
+        self.__ready.set()
+
+    async def connect(self):
+        res = await self.__client.post("/auth", data=bytes(KEY, "utf8"))
+        self.__socket = self.__client.websocket("/pbj", headers={
+            "X-Pbj-Session-Id": res.headers["X-Pbj-Session-Id"],
+            "X-Pbj-Session": res.headers["X-Pbj-Session"]
+        })
+        self.__ws = await self.__socket.__aenter__()
+
+        for i in self.__commands:
+            self.__queue(main.COMMAND_ROOT + i + b"\x04echo")
+            self.__send(i)
+
+    async def close(self):
+        if self.__socket is not None:
+            await self.__ws.disconnect()
+
+    def __send(self, cmd:bytes):
+        self.__sent[cmd] = time.perf_counter()
+        self.__queue(cmd + main.FRAME_BINARY + self.__payload)
+
+    async def poll(self, deadline:float):
+        while time.perf_counter() < deadline:
+            messages = main.unpack_batch(await self.__ws.receive())
+            now = time.perf_counter()
+            self.__results["batches"].append(len(messages))
+
+            for i in messages:
+                cmd = bytes(i[:4])
+                if i[4:5] != main.FRAME_BINARY:
+                    continue
+
+                self.__results["latency"].append(now - self.__sent[cmd])
+                self.__results["received"] += 1
+                if now < deadline:
+                    self.__send(cmd)
+
+    async def push(self, deadline:float):
+        while time.perf_counter() < deadline:
+            await self.__ready.wait()
+            self.__ready.clear()
+
+            # Let messages accumulate for a moment, as the poll client does.
+            await asyncio.sleep(0)
+            messages = self.__outgoing
+            self.__outgoing = []
+
+            await self.__ws.send(main.pack_batch(messages))
+            self.__results["sent"] += sum(1 for i in messages if i[:4] != main.COMMAND_ROOT)
+
+class SimClientServer:
+    """One simulated relay, using a `main.DuplexClient` with one echo loop per command.  
+    `connect` makes the client: a `stream.StreamClient` or a `longpoll.LongPollClient`."""
+
+    def __init__(self, connect:typing.Callable[[],typing.Awaitable[main.DuplexClient]], commands:int, payload:bytes, results:dict):
+        self.__connect = connect
+        self.__commands = commands
+        self.__payload = payload
+        self.__results = results
+        self.__client = None
+        self.__contexts = []
+
+    async def connect(self):
+        self.__client = await self.__connect()
+        self.__contexts = [await self.__client.open("echo") for _ in range(self.__commands)]
+
+    async def close(self):
+        if self.__client is not None:
+            await self.__client.close()
+
+    async def __echo(self, ctx:main.CommandDuplexContext, deadline:float):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await ctx.send(self.__payload)
+            self.__results["sent"] += 1
+            await ctx.recv()
+
+            self.__results["latency"].append(time.perf_counter() - start)
+            self.__results["received"] += 1
+
+    async def poll(self, deadline:float):
+        try:
+            await asyncio.gather(*(self.__echo(i, deadline) for i in self.__contexts))
+        except asyncio.QueueShutDown:
+            pass
+
+    async def push(self, deadline:float):
+        pass
+
+# measurement
+
+def rss_kb() -> int:
+    "Current resident set size, falling back to the peak where /proc isn't available."
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+def percentile(data:list[float], q:float) -> float:
+    if not data:
+        return 0.0
+    return data[min(len(data) - 1, int(q * len(data)))]
+
+def histogram(data:list[int]) -> dict[str,int]:
+    "Count values in power-of-two buckets."
+
+    res = {}
+    for i in data:
+        low = 0 if i == 0 else 1 << (i.bit_length() - 1)
+        key = str(low) if low <= 1 else f"{low}-{2 * low - 1}"
+        res[key] = res.get(key, 0) + 1
+    return dict(sorted(res.items(), key=lambda i: int(i[0].split("-")[0])))
+
+async def run(args:argparse.Namespace) -> dict:
+    poll_options = json.loads(args.poll_options)
+    app, sessions, opened = make_app(args.transport, args.cooldown, poll_options, args.lanes)
+    results = {"latency": [], "batches": [], "windows": [], "sent": 0, "received": 0, "errors": 0}
+    payload = os.urandom(args.size)
+
+    async with app.test_app():
+        base_rss = rss_kb()
+
+        if args.transport == "stream":
+            path = os.path.join(tempfile.mkdtemp(), "pbj.sock")
+            server = await sessions.serve_unix(path)
+            connect = lambda: stream.StreamClient.connect_unix(path, KEY)
+            servers = [SimClientServer(connect, args.commands, payload, results) for _ in range(args.servers)]
+        elif args.transport == "client":
+            connect = lambda: longpoll.LongPollClient.connect_app(app, KEY, auth_url="/auth", max_lanes=args.lanes)
+            servers = [SimClientServer(connect, args.commands, payload, results) for _ in range(args.servers)]
+        else:
+            sim = SimSocketServer if args.transport == "websocket" else SimServer
+            if sim is SimServer:
+                servers = [SimServer(app, args.commands, payload, results, args.lanes) for _ in range(args.servers)]
+            else:
+                servers = [sim(app, args.commands, payload, results) for _ in range(args.servers)]
+        await asyncio.gather(*(i.connect() for i in servers))
+
+        start = time.perf_counter()
+        deadline = start + args.duration
+        tasks = [asyncio.create_task(j(deadline)) for i in servers for j in (i.poll, i.push)]
+
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+        peak_rss = rss_kb()
+
+        # Closing the sessions releases any poll still being held.
+        for i in opened:
+            await i.close()
+        await asyncio.wait(tasks, timeout=5)
+        for i in tasks:
+            i.cancel()
+        if args.transport != "longpoll":
+            await asyncio.gather(*(i.close() for i in servers))
+        if args.transport == "stream":
+            server.close()
+        await sessions.stop_reaper()
+
+    latency = sorted(results["latency"])
+    batches = sorted(results["batches"])
+    windows = sorted(results["windows"])
+
+    return {
+        "config": {
+            "transport": args.transport,
+            "servers": args.servers,
+            "commands": args.commands,
+            "size": args.size,
+            "duration": args.duration,
+            "cooldown": args.cooldown,
+            "lanes": args.lanes,
+            "poll_options": poll_options
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "orjson": main.orjson is not None
+        },
+        "elapsed": elapsed,
+        "messages": {
+            "sent": results["sent"],
+            "received": results["received"],
+            "per_second": results["received"] / elapsed,
+            "errors": results["errors"]
+        },
+        "latency_ms": {
+            "p50": percentile(latency, .5) * 1000,
+            "p90": percentile(latency, .9) * 1000,
+            "p99": percentile(latency, .99) * 1000,
+            "max": (latency[-1] if latency else 0) * 1000,
+            "mean": (sum(latency) / len(latency) if latency else 0) * 1000
+        },
+        "batch_size": {
+            "count": len(batches),
+            "mean": sum(batches) / len(batches) if batches else 0,
+            "p50": percentile(batches, .5),
+            "p99": percentile(batches, .99),
+            "max": batches[-1] if batches else 0,
+            "histogram": histogram(batches)
+        },
+        "hold_window_ms": {
+            "p50": percentile(windows, .5) * 1000,
+            "p99": percentile(windows, .99) * 1000,
+            "mean": (sum(windows) / len(windows) if windows else 0) * 1000
+        },
+        "rss_kb": {
+            "base": base_rss,
+            "peak": peak_rss,
+            "per_session": (peak_rss - base_rss) / args.servers
+        }
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transport", choices=("longpoll", "websocket", "stream", "client"), default="longpoll")
+    parser.add_argument("--servers", type=int, default=20, help="simulated game servers (sessions)")
+    parser.add_argument("--commands", type=int, default=8, help="echo commands per server")
+    parser.add_argument("--size", type=int, default=32, help="payload bytes per message")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--cooldown", type=float, default=.2, help="long-poll cooldown")
+    parser.add_argument("--lanes", type=int, default=1, help="long-poll requests each server keeps open")
+    parser.add_argument("--poll-options", default="{}", help="extra poll (or socket) options, as JSON")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    res = json.dumps(asyncio.run(run(args)), indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(res + "\n")
+    else:
+        print(res)
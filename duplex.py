@@ -16,218 +16,627 @@
 
 import io
 import time
+import zlib
 import typing
 import asyncio
-from . import main
+import collections
+from . import main, metrics
 from quart import Quart, request, websocket
 
-# websocket
+# acknowledged batches
 
-class QuartWebsocketHandler(main.BaseDuplexHandler):
-    __queues: dict[bytes,asyncio.Queue]
+class SentBatch:
+    """A numbered batch kept until the client acknowledges it.  
+    `state` is `None` while the response carrying it (ending with batch `response`)
+    is in flight on `lane`, then `True` if it arrived, or `False` if it was lost."""
 
-    def __init__(self):
-        self.__queues = {}
-        asyncio.create_task(self.__producer())
+    __slots__ = ("seq", "body", "lane", "response", "state")
 
-    def __get_queue(self, cmd:bytes) -> asyncio.Queue:
-        if not cmd in self.__queues:
-            self.__queues[cmd] = asyncio.Queue()
+    def __init__(self, seq:int, body:bytes, lane:int):
+        self.seq = seq
+        self.body = body
+        self.lane = lane
+        self.response = seq
+        self.state = None
 
-    async def __producer(self):
-        while True:
-            data = await websocket.receive()
-            cmd = data[:4]
-            data = data[4:]
+# compression
 
-            if cmd in self.__queues:
-                self.__queues[cmd].put_nowait(data)
+ENCODINGS = {"gzip": 31, "deflate": 15}
 
+def compress_body(data:bytes, encoding:str, level:int=6) -> bytes:
+    "Compress a batch body with a supported content encoding."
 
-    async def send(self, data:bytes):
-        await websocket.send(data)
+    obj = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    return obj.compress(data) + obj.flush()
 
-    async def recv(self, cmd:bytes):
-        return await self.__get_queue(cmd).get()
+def decompress_body(data:bytes, encoding:str, limit:int) -> bytes:
+    """Decompress a batch body with a supported content encoding.  
+    Raises `ValueError` if the body is malformed, or inflates past `limit` bytes."""
 
-    async def clean(self, cmd:bytes):
-        if cmd in self.__queues:
-            self.__queues[cmd].shutdown(True)
-            del self.__queues[cmd]
+    obj = zlib.decompressobj(ENCODINGS[encoding])
 
-# long-polling (necessary until live game support for ws)
+    try:
+        res = obj.decompress(data, limit)
+    except zlib.error as e:
+        raise ValueError("Malformed compressed body") from e
 
-async def consume_request_body(to:asyncio.StreamReader):
-    async for chunk in request.body:
-        to.feed_data(chunk)
-    
-    to.feed_eof()
+    if obj.unconsumed_tail:
+        raise ValueError("Decompressed body is too large")
+    if not obj.eof:
+        raise ValueError("Truncated compressed body")
 
-async def dump_request_body(f:asyncio.StreamReader, chunk_size:int=8192):
-    while True:
-        chunk = await f.read(chunk_size)
+    return res
 
-        if chunk:
-            yield chunk
-        else:
-            break
-    
-    f.feed_eof()
+# long-polling (necessary until live game support for ws)
 
 class QuartLongPollManager:
-    def __init__(self, cooldown:float=.2, conn_ttl=45.0):
-        self.__outgoing = asyncio.Queue()
-        self.__incoming = asyncio.Queue()
+    """Outgoing/incoming message buffer for a single long-poll session.  
+    Compression is opt-in: `compression` lists the encodings this side may use,
+    in order of preference. A response is compressed only if the client asked for
+    one of them with `X-Pbj-Accept-Encoding` and the batch is at least
+    `compress_threshold` bytes long. Bodies over `executor_threshold` bytes are
+    (de)compressed in a thread, so the event loop doesn't stall.
+
+    Every command gets a credit window of `window` bytes in the outgoing buffer.
+    `put()` waits while a command's window is full, and credit is returned once
+    its messages are packed into a response. A response holds at most `max_batch`
+    bytes, and anything left over waits for the next poll.
+
+    The whole outgoing buffer is limited to `max_outgoing` bytes, and may also draw
+    on a `main.MemoryBudget` shared with other sessions. A `put()` that can't get
+    room within `shed_timeout` seconds raises `main.Overloaded`.
+
+    Incoming messages are handed to `dispatch` one at a time as the request body is
+    parsed, so a command that is slow to read holds up the request pushing to it.
+
+    By default, every poll is held for `cooldown` seconds before it waits for data.
+    With `adaptive` set, a poll instead responds as soon as data is queued, held
+    open only long enough for more messages to join the batch. The hold window is
+    tuned from the session's outgoing message rate, and never exceeds
+    `latency_target`; a batch of `flush_count` messages or `flush_bytes` bytes
+    is sent straight away.
+
+    Clients that send `X-Pbj-Ack` get numbered batches, and batches are kept until
+    acknowledged, up to `replay_bytes`, counting towards the budget meanwhile.
+    A poll acknowledging less than was sent is answered straight away with the
+    batches it lost, so a lost response is sent again rather than losing its messages.
+
+    With `lanes` above 1, a client may keep that many polls open at once, each
+    sending its lane in `X-Pbj-Lane`. Queued messages go to whichever poll is
+    waiting, in order, and the client puts the numbered batches back in order."""
+
+    def __init__(self,
+            dispatch:typing.Callable[[memoryview],typing.Awaitable[None]],
+            cooldown:float=.2,
+            conn_ttl=45.0,
+            compression:typing.Sequence[str]=(),
+            compress_threshold:int=1024,
+            compress_level:int=6,
+            executor_threshold:int=65536,
+            max_body:int=16777216,
+            window:int=262144,
+            max_batch:int=1048576,
+            max_outgoing:int=4194304,
+            shed_timeout:float=30,
+            budget:main.MemoryBudget|None=None,
+            adaptive:bool=False,
+            latency_target:float=.05,
+            flush_count:int=128,
+            flush_bytes:int=65536,
+            replay_bytes:int=4194304,
+            lanes:int=1):
+        for i in compression:
+            if not i in ENCODINGS:
+                raise ValueError(f"Unsupported encoding '{i}'")
+
+        self.__outgoing = collections.deque()
+        self.__ready = asyncio.Event()
+        self.__credit = asyncio.Condition()
+        self.__pending = {}
+        self.__closed = False
+        self.__window = window
+        self.__max_batch = max_batch
+        self.__queued = 0
+        self.__max_outgoing = max_outgoing
+        self.__segment_limit = min(window, max_batch, max_outgoing)
+        self.__shed_timeout = shed_timeout
+        self.__budget = budget
+        self.__dispatch = dispatch
         self.__cooldown = cooldown
+        self.__adaptive = adaptive
+        self.__latency_target = latency_target
+        self.__flush_count = flush_count
+        self.__flush_bytes = flush_bytes
+        self.__flush = asyncio.Event()
+        self.__interval = conn_ttl
+        self.__last_put = time.perf_counter()
+        self.__hold = cooldown
         self.__ttl = conn_ttl
+        self.__compression = tuple(compression)
+        self.__compress_threshold = compress_threshold
+        self.__compress_level = compress_level
+        self.__executor_threshold = executor_threshold
+        self.__max_body = max_body
+        self.__stats = {"compressed": 0, "raw_bytes": 0, "sent_bytes": 0, "compress_time": 0.0}
+        self.__flow = {
+            "window_waits": 0, "session_waits": 0, "timeouts": 0, "rejected": 0,
+            "resent": 0, "replay_dropped": 0
+        }
+        self.__replay = collections.deque()
+        self.__replay_size = 0
+        self.__max_replay = replay_bytes
+        self.__seq = 0
+        self.__acked = 0
+        self.__lost = 0
+        self.__lanes = lanes
+        self.__parked = 0
+
+    async def __offload(self, size:int, fn:typing.Callable[...,bytes], *args) -> bytes:
+        if size >= self.__executor_threshold:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def __negotiate(self) -> str|None:
+        accepted = [i.strip().lower() for i in request.headers.get("X-Pbj-Accept-Encoding", "").split(",")]
+
+        for i in self.__compression:
+            if i in accepted:
+                return i
+
+    async def encode_outgoing(self, body:bytes) -> tuple[bytes,dict[str,str]]:
+        "Compress a packed batch if negotiated, returning the body and response headers."
+
+        encoding = self.__negotiate()
+        if encoding is None or len(body) < self.__compress_threshold:
+            return body, {}
 
-    async def put(self, data:bytes):
-        "Place data in the outgoing queue."
-
-        print("put", data)
-        self.__outgoing.put_nowait(data)
+        start = time.perf_counter()
+        res = await self.__offload(len(body), compress_body, body, encoding, self.__compress_level)
+        elapsed = time.perf_counter() - start
 
-    async def pack_outgoing(self, to:asyncio.StreamReader):
-        data = []
+        if len(res) >= len(body):
+            return body, {}
+
+        self.__stats["compressed"] += 1
+        self.__stats["raw_bytes"] += len(body)
+        self.__stats["sent_bytes"] += len(res)
+        self.__stats["compress_time"] += elapsed
+
+        return res, {
+            "Content-Encoding": encoding,
+            "X-Pbj-Compression-Ratio": f"{len(res) / len(body):.4f}",
+            "X-Pbj-Compression-Time": f"{elapsed:.6f}"
+        }
+
+    def compression_stats(self) -> dict[str,int|float]:
+        "Get counters for compressed responses."
+
+        return dict(self.__stats)
+
+    def flow_stats(self) -> dict[str,int]:
+        "Get backpressure counters, and the current size of the outgoing buffer."
+
+        return {
+            **self.__flow,
+            "queued": self.__queued,
+            "messages": len(self.__outgoing),
+            "hold_window": self.__hold,
+            "parked": self.__parked,
+            "unacked": len(self.__replay),
+            "unacked_bytes": self.__replay_size
+        }
+
+    def __has_credit(self, cmd:bytes, size:int) -> bool:
+        if self.__closed is True or not cmd in self.__pending:
+            return True
+        return self.__pending[cmd] + size <= self.__window
+
+    def __has_room(self, cmd:bytes, size:int) -> bool:
+        if self.__queued > 0 and self.__queued + size > self.__max_outgoing:
+            return self.__closed
+        return self.__has_credit(cmd, size)
+
+    async def put(self, data:main.T_Message):
+        """Place data in the outgoing queue.  
+        Data may be a `(command ID, frame)` pair, in which case the frame is queued
+        as it is, so one frame can be shared between many sessions, or a `main.FrameSegment`
+        of several messages, which is queued (and later batched) whole if it fits in
+        `window` and `max_batch`, and split between its messages otherwise.  
+        Waits while the command's credit window or the session's buffer is full.
+        A message larger than either is still accepted once nothing is queued ahead of it.  
+        EOF frames never wait, so a command can always be closed."""
+
+        if type(data) is main.FrameSegment and len(data.data) > self.__segment_limit:
+            # Queued piece by piece, so a segment is held to the same limits as single messages.
+            for i in data.split(self.__segment_limit):
+                await self.put(i)
+            return
+
+        if metrics.tracer is not None:
+            metrics.tracer("poll.put", main.message_bytes(data))
+
+        if type(data) is tuple:
+            cmd, frame = data
+            size = len(cmd) + len(frame)
+        elif type(data) is main.FrameSegment:
+            cmd, frame = data.cmd, b""
+            size = len(data.data)
+        else:
+            cmd, frame = data[:4], data[4:5]
+            size = len(data)
 
+        if frame[:1] == main.FRAME_EOF:
+            if self.__budget is not None:
+                self.__budget.force(size)
+        else:
+            if not self.__has_room(cmd, size):
+                if self.__has_credit(cmd, size):
+                    self.__flow["session_waits"] += 1
+                else:
+                    self.__flow["window_waits"] += 1
+
+                try:
+                    async with asyncio.timeout(self.__shed_timeout):
+                        async with self.__credit:
+                            await self.__credit.wait_for(lambda: self.__has_room(cmd, size))
+                except TimeoutError:
+                    self.__flow["timeouts"] += 1
+                    raise main.Overloaded("Session outgoing buffer is full") from None
+
+            if self.__budget is not None:
+                await self.__budget.acquire(size)
+
+        if self.__closed is True:
+            if self.__budget is not None:
+                await self.__budget.release(size)
+            raise asyncio.QueueShutDown
+
+        self.__pending[cmd] = self.__pending.get(cmd, 0) + size
+        self.__queued += size
+        self.__outgoing.append(data)
+        self.__ready.set()
+
+        if self.__adaptive is True:
+            # Exponentially weighted mean of the time between messages.
+            now = time.perf_counter()
+            self.__interval += .2 * (min(now - self.__last_put, self.__ttl) - self.__interval)
+            self.__last_put = now
+
+            if self.__flush_due():
+                self.__flush.set()
+
+    def __flush_due(self) -> bool:
+        return len(self.__outgoing) >= self.__flush_count or self.__queued >= self.__flush_bytes
+
+    def hold_window(self) -> float:
+        """Get the time a poll with data queued is held for more data.  
+        That is the time expected for a full batch to arrive, or 0 if less than
+        one more message is expected within `latency_target`, up to `latency_target`."""
+
+        if self.__adaptive is False:
+            return self.__cooldown
+
+        rate = 1 / max(self.__interval, 1e-6)
+        if rate * self.__latency_target < 1:
+            return 0.0
+        return min(self.__latency_target, self.__flush_count / rate)
+
+    def admit(self) -> bool:
+        "Check whether a new command may start, given the session's and global buffers."
+
+        if self.__queued >= self.__max_outgoing:
+            self.__flow["rejected"] += 1
+            return False
+        if self.__budget is not None:
+            return self.__budget.admit()
+        return True
+
+    async def __wait_ready(self):
+        # Another parked poll may take the messages first, so wait again until some are left.
         try:
             async with asyncio.timeout(self.__ttl):
-                data.append(await self.__outgoing.get())
-
-                while not self.__outgoing.empty():
-                    data.append(self.__outgoing.get_nowait())
-        except asyncio.TimeoutError:
+                while not self.__outgoing and self.__closed is False:
+                    self.__ready.clear()
+                    self.__parked += 1
+
+                    try:
+                        await self.__ready.wait()
+                    finally:
+                        self.__parked -= 1
+        except TimeoutError:
             pass
 
-        to.feed_data(len(data).to_bytes(4, "little", signed=False))
-        for i in data:
-            to.feed_data(len(i).to_bytes(4, "little", signed=False))
-            to.feed_data(i)
-        
-        to.feed_eof()
+    async def pack_outgoing(self) -> bytes:
+        "Wait for at least one outgoing message, then pack up to `max_batch` bytes of queued messages."
 
-    async def parse_incoming(self):
-        reader = asyncio.StreamReader()
-        asyncio.create_task(consume_request_body(reader))
+        await self.__wait_ready()
+        return await self.__pack()
 
-        for i in range(int.from_bytes(await reader.readexactly(4), "little", signed=False)):
-            length = int.from_bytes(await reader.readexactly(4), "little", signed=False)
-            self.__incoming.put_nowait(await reader.readexactly(length))
+    async def __pack(self) -> bytes:
+        data = []
+        size = 0
 
-    async def recv(self) -> typing.AsyncGenerator[bytes]:
-        """Parse data in a request and place into the incoming queue.  
-        Then, wait until at lesat one outgoing message is available,  
-        and generate a returned response."""
+        while self.__outgoing:
+            length = main.message_size(self.__outgoing[0])
+            if data and size + length > self.__max_batch:
+                break
 
-        start = time.perf_counter()
+            item = self.__outgoing.popleft()
+            data.append(item)
+            size += length
 
-        await self.parse_incoming()
-        elapsed = time.perf_counter() - start
-        await asyncio.sleep(max(.008, self.__cooldown - elapsed))
+            cmd = main.message_command(item)
+            self.__pending[cmd] -= length
+            if self.__pending[cmd] <= 0:
+                del self.__pending[cmd]
 
-        result = asyncio.StreamReader()
-        asyncio.create_task(self.pack_outgoing(result))
+        if metrics.enabled:
+            metrics.poll_messages.observe(len(data))
+            metrics.poll_bytes.observe(size)
 
-        return dump_request_body(result)
+        if data:
+            self.__queued -= size
+            if self.__budget is not None:
+                await self.__budget.release(size)
 
-    async def get(self) -> bytes:
-        return await self.__incoming.get()
+            async with self.__credit:
+                self.__credit.notify_all()
 
-    async def shutdown(self):
-        self.__outgoing.shutdown(True)
-        self.__incoming.shutdown(True)
+        return main.pack_batch(data)
 
-class QuartLongPollHandler(main.BaseDuplexHandler):
-    __queues: dict[bytes,asyncio.Queue]
+    async def parse_incoming(self):
+        "Read the request body and dispatch every message in it."
+
+        body = await request.get_data(cache=False)
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+
+        if encoding != "identity":
+            if not encoding in self.__compression:
+                raise ValueError(f"Unsupported encoding '{encoding}'")
+
+            body = await self.__offload(len(body), decompress_body, body, encoding, self.__max_body)
+
+        for i in main.unpack_batch(body):
+            await self.__dispatch(i)
+
+    async def next_batch(self) -> bytes:
+        """Wait for outgoing messages and pack them, without reading a request.  
+        With `adaptive` set, the batch is held open for the hold window first."""
+
+        if self.__adaptive is True:
+            return await self.__coalesce()
+        return await self.pack_outgoing()
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
+    async def acknowledge(self, ack:int, lane:int=0, received:int=-1):
+        """Drop buffered batches up to sequence number `ack`, which the client has received.  
+        Batches last sent on `lane` are then settled: the response ending with batch
+        `received` arrived, and any others on that lane were lost, so are sent again.  
+        Raises `main.ReplayLost` if a batch after `ack` was already dropped, and
+        `ValueError` if `ack` was never sent or `lane` is out of range."""
+
+        if ack < 0 or ack > self.__seq:
+            raise ValueError("Acknowledged batch was never sent")
+        if lane < 0 or lane >= self.__lanes:
+            raise ValueError("Invalid poll lane")
+        if ack < self.__lost:
+            raise main.ReplayLost("Unacknowledged batches were dropped")
+
+        self.__acked = max(self.__acked, ack)
+        freed = 0
+        while self.__replay and self.__replay[0].seq <= self.__acked:
+            freed += len(self.__replay.popleft().body)
+
+        self.__replay_size -= freed
+        if freed > 0 and self.__budget is not None:
+            await self.__budget.release(freed)
+
+        for i in self.__replay:
+            if i.lane == lane and i.state is None:
+                i.state = i.response == received
+
+    async def __record(self, body:bytes, lane:int) -> tuple[int,int]:
+        # Empty batches aren't numbered, as there is nothing to resend.
+        if body[:4] == b"\0\0\0\0":
+            return self.__seq + 1, self.__seq
+
+        self.__seq += 1
+        self.__replay.append(SentBatch(self.__seq, body, lane))
+        self.__replay_size += len(body)
+
+        # The batch is already packed, so it is charged without waiting.
+        if self.__budget is not None:
+            self.__budget.force(len(body))
+
+        # The batch being sent is always kept, even if it is over the limit alone.
+        freed = 0
+        while self.__replay_size > self.__max_replay and len(self.__replay) > 1:
+            old = self.__replay.popleft()
+            self.__lost = old.seq
+            self.__replay_size -= len(old.body)
+            self.__flow["replay_dropped"] += 1
+            freed += len(old.body)
+
+        if freed > 0 and self.__budget is not None:
+            await self.__budget.release(freed)
+        return self.__seq, self.__seq
+
+    def __resend(self, lane:int) -> tuple[bytes,int,int]|None:
+        # Consecutive lost batches are merged into one, up to `max_batch` bytes.
+        picked = []
+        size = 0
+
+        for i in self.__replay:
+            if i.state is not False:
+                if picked:
+                    break
+                continue
+            if picked and (i.seq != picked[-1].seq + 1 or size + len(i.body) > self.__max_batch):
+                break
+
+            picked.append(i)
+            size += len(i.body)
+
+        if not picked:
+            return None
+
+        count = 0
+        for i in picked:
+            count += int.from_bytes(i.body[:4], "little", signed=False)
+            i.lane, i.response, i.state = lane, picked[-1].seq, None
+
+        self.__flow["resent"] += 1
+        body = count.to_bytes(4, "little", signed=False) + b"".join(memoryview(i.body)[4:] for i in picked)
+        return body, picked[0].seq, picked[-1].seq
+
+    async def recv(self) -> tuple[bytes,dict[str,str]]:
+        """Parse data in a request and dispatch it.  
+        Then, wait until at lesat one outgoing message is available,  
+        and generate a returned response.  
+        If the request has `X-Pbj-Ack`, the response is numbered (see `acknowledge()`)."""
 
-    def __init__(self):
-        self.__manager = QuartLongPollManager()
-        self.__queues = {}
-        self.__active_producer = None
+        start = time.perf_counter()
+        ack = request.headers.get("X-Pbj-Ack")
+        lane = int(request.headers.get("X-Pbj-Lane", 0))
 
-    def __get_queue(self, cmd:bytes) -> asyncio.Queue:
-        if not cmd in self.__queues:
-            self.__queues[cmd] = asyncio.Queue()
-        return self.__queues[cmd]
+        if ack is not None:
+            await self.acknowledge(int(ack), lane, int(request.headers.get("X-Pbj-Received", -1)))
+        elif lane != 0:
+            raise ValueError("Poll lanes need acknowledgements")
 
-    async def __producer(self):
-        while True:
-            data = await self.__manager.get()
-            cmd = data[:4]
-            data = data[4:]
+        await self.parse_incoming()
 
-            if cmd in self.__queues:
-                self.__queues[cmd].put_nowait(data)
+        resent = self.__resend(lane) if ack is not None else None
+        if resent is not None:
+            body, first, last = resent
+        else:
+            if self.__adaptive is True:
+                body = await self.__coalesce()
+            else:
+                elapsed = time.perf_counter() - start
+                await asyncio.sleep(max(.008, self.__cooldown - elapsed))
+                body = await self.pack_outgoing()
+
+            if ack is not None:
+                first, last = await self.__record(body, lane)
+
+        if metrics.enabled:
+            metrics.poll_hold_seconds.observe(time.perf_counter() - start)
+
+        body, headers = await self.encode_outgoing(body)
+        if self.__adaptive is True:
+            headers["X-Pbj-Window"] = f"{self.__hold:.4f}"
+        if ack is not None:
+            headers["X-Pbj-Seq-From"] = str(first)
+            headers["X-Pbj-Seq"] = str(last)
+            headers["X-Pbj-Lanes"] = str(self.__lanes)
+        return body, headers
+
+    async def __coalesce(self) -> bytes:
+        # Wait for the first message, then hold the batch open for the window.
+        await self.__wait_ready()
+        if not self.__outgoing:
+            return main.pack_batch([])
+
+        self.__hold = self.hold_window()
+
+        if self.__outgoing and self.__hold > 0 and not self.__flush_due():
+            self.__flush.clear()
+
+            try:
+                async with asyncio.timeout(self.__hold):
+                    await self.__flush.wait()
+            except TimeoutError:
+                pass
+
+        return await self.__pack()
 
+    async def shutdown(self):
+        self.__closed = True
+        self.__outgoing.clear()
+        self.__pending.clear()
 
-    async def unpack_extra_incoming(self):
-        await self.__manager.parse_incoming()
+        if self.__budget is not None:
+            await self.__budget.release(self.__queued + self.__replay_size)
+        self.__queued = 0
+        self.__replay.clear()
+        self.__replay_size = 0
+        self.__ready.set()
+        self.__flush.set()
 
+        async with self.__credit:
+            self.__credit.notify_all()
 
-    async def start(self):
-        if self.__active_producer is None:
-            self.__active_producer = asyncio.create_task(self.__producer())
+class QuartLongPollHandler(main.BaseDuplexHandler):
+    def __init__(self,
+            fragment_size:int|None=65536,
+            max_message:int=16777216,
+            max_queued:int=256,
+            max_early:int=256,
+            shed_timeout:float=30,
+            **kwargs):
+        """Each command buffers at most `max_queued` incoming frames. If a command
+        doesn't read a frame within `shed_timeout` seconds of its buffer filling up,
+        it is closed with `StatusCode.TIME_OUT`. Up to `max_early` frames are held
+        for commands that haven't started yet.  
+        Other keyword arguments are passed on to `QuartLongPollManager`."""
+
+        self.fragment_size = fragment_size
+        self.max_message = max_message
+        self.route_incoming(max_queued, max_early, shed_timeout)
+        self.__manager = QuartLongPollManager(self.dispatch, shed_timeout=shed_timeout, **kwargs)
 
-    async def handle_request(self) -> typing.AsyncIterable[bytes]:
-        if self.__active_producer is None:
-            self.__active_producer = asyncio.create_task(self.__producer)
+    async def unpack_extra_incoming(self):
+        await self.__manager.parse_incoming()
 
+    async def handle_request(self) -> tuple[bytes,dict[str,str]]:
         return await self.__manager.recv()
 
     async def send(self, data:bytes):
-        print("sending", data, "to manager")
         await self.__manager.put(data)
 
-    async def recv(self, cmd:bytes):
-        return await self.__get_queue(cmd).get()
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        await self.__manager.put((cmd, frame))
 
-    async def clean(self, cmd:bytes):
-        if cmd in self.__queues:
-            self.__queues[cmd].shutdown(True)
-            del self.__queues[cmd]
+    async def send_segment(self, segment:main.FrameSegment):
+        await self.__manager.put(segment)
 
     async def shutdown(self):
-        if self.__active_producer is not None:
-            self.__active_producer.cancel()
-        
         await self.__manager.shutdown()
+        self.router.shutdown()
 
-    async def get_response_body(self) -> bytes:
+    async def get_response_body(self) -> tuple[bytes,dict[str,str]]:
         return await self.__manager.recv()
 
-class QuartLongPollSessionManager(main.SessionHandler):
-    __poll_managers: dict[int,QuartLongPollHandler]
-    __cmd_managers: dict[int,main.CommandManager]
-    __tasks: dict[int,asyncio.Task]
-
-    def __init__(self, cmd_hndl:main.CommandHandler, key, hasher=None):
-        super().__init__(key, hasher)
-        self.__cmd_hndl = cmd_hndl
-        self.__poll_managers = {}
-        self.__cmd_managers = {}
-        self.__tasks = {}
-
-
-    async def clean_session(self, ses:main.Session):
-        handler = self.__poll_managers[ses.id]
-        manager = self.__cmd_managers[ses.id]
-        task = self.__tasks[ses.id]
-
-        await handler.shutdown()
-        task.cancel()
+    def compression_stats(self) -> dict[str,int|float]:
+        return self.__manager.compression_stats()
+
+    def flow_stats(self) -> dict[str,int]:
+        return {**self.__manager.flow_stats(), **self.router.stats()}
+
+    def admit(self) -> bool:
+        return self.__manager.admit()
+
+class QuartLongPollSessionManager(main.TransportSessionHandler):
+    def __init__(self,
+            cmd_hndl:main.CommandHandler,
+            key,
+            hasher=None,
+            session_ttl:float=60,
+            poll_options:dict|None=None,
+            scheduler:main.CommandScheduler|None=None,
+            lanes:int=1,
+            **kwargs):
+        # The session TTL must outlast a held poll, or idle sessions get reaped mid-poll.
+        super().__init__(cmd_hndl, key, hasher, session_ttl, scheduler, **kwargs)
+        self.__poll_options = {"lanes": lanes, **(poll_options or {})}
 
     async def start_session(self):
         ses = await super().start_session()
-
-        handler = QuartLongPollHandler()
-        manager = main.CommandManager(handler, self.__cmd_hndl)
-        self.__poll_managers[ses.id] = handler
-        self.__cmd_managers[ses.id] = manager
-        await handler.start()
-        self.__tasks[ses.id] = asyncio.create_task(manager.run())
-
-        ses.on_close(self.clean_session)
-
+        self.open_handler(ses, QuartLongPollHandler(**self.__poll_options))
         return ses
     
     async def request_handler(self):
@@ -242,28 +651,188 @@ class QuartLongPollSessionManager(main.SessionHandler):
 
         try:
             ses = await self.test_session(ses_id, ses_token)
+        except main.SessionMisdirected as e:
+            return "Misdirected Request", 421, {"X-Pbj-Worker": e.owner}
         except ValueError:
             return "Unauthorized", 401
         
-        manager = self.__poll_managers[ses.id]
-        return await manager.get_response_body()
+        manager = self.get_handler(ses.id)
+
+        try:
+            body, headers = await manager.get_response_body()
+        except main.ReplayLost:
+            return "Gone", 410
+        except ValueError:
+            return "Bad Request", 400
+
+        return body, 200, headers
     
     async def push_handler(self):
         "Request handler. Can be used directly as a Quart endpoint."
 
         try:
             ses_id = int(request.headers.get("X-Pbj-Session-Id"))
-        except ValueError:
+        except (ValueError, TypeError):
             return "Bad Request", 400
 
         ses_token = request.headers.get("X-Pbj-Session", "")
 
         try:
             ses = await self.test_session(ses_id, ses_token)
+        except main.SessionMisdirected as e:
+            return "Misdirected Request", 421, {"X-Pbj-Worker": e.owner}
         except ValueError:
             return "Unauthorized", 401
         
-        manager = self.__poll_managers[ses.id]
-        await manager.unpack_extra_incoming()
+        manager = self.get_handler(ses.id)
+
+        try:
+            await manager.unpack_extra_incoming()
+        except ValueError:
+            return "Bad Request", 400
 
         return ""
+
+# websocket
+
+class QuartWebsocketHandler(main.BaseDuplexHandler):
+    def __init__(self,
+            ws=None,
+            fragment_size:int|None=65536,
+            max_message:int=16777216,
+            max_queued:int=256,
+            max_early:int=256,
+            shed_timeout:float=30,
+            **kwargs):
+        """Carries one session over a websocket (by default, Quart's current one).
+        Both directions use the long-poll batch format, one batch per websocket message.  
+        Outgoing messages are buffered by a `QuartLongPollManager`, with the same credit
+        windows and limits as long-polling. Messages queued while a batch is being written
+        go out together in the next one; with `adaptive` set, batches are also held open
+        as for long-polling.  
+        Incoming limits are as for `QuartLongPollHandler`, and other keyword arguments are
+        passed on to `QuartLongPollManager`."""
+
+        self.fragment_size = fragment_size
+        self.max_message = max_message
+        self.route_incoming(max_queued, max_early, shed_timeout)
+        self.__ws = websocket._get_current_object() if ws is None else ws
+        self.__manager = QuartLongPollManager(self.dispatch, shed_timeout=shed_timeout, **kwargs)
+        self.__stats = {"received": 0, "written": 0, "written_bytes": 0}
+
+    async def __reader(self):
+        while True:
+            data = await self.__ws.receive()
+            if not isinstance(data, bytes):
+                raise ValueError("Text websocket message")
+
+            self.__stats["received"] += 1
+
+            # Dispatching waits while a command's buffer is full, which stops reading
+            # from the socket, so a fast client is slowed down by TCP backpressure.
+            for i in main.unpack_batch(data):
+                await self.dispatch(i)
+
+    async def __writer(self):
+        while self.__manager.closed is False:
+            body = await self.__manager.next_batch()
+            if len(body) <= 4:
+                continue
+
+            await self.__ws.send(body)
+            self.__stats["written"] += 1
+            self.__stats["written_bytes"] += len(body)
+
+    async def run(self):
+        """Move messages both ways until the websocket closes or the handler is shut down.  
+        Raises `ValueError` if the client sends a malformed batch."""
+
+        tasks = [asyncio.create_task(self.__reader()), asyncio.create_task(self.__writer())]
+
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for i in tasks:
+                i.cancel()
+
+        for i in done:
+            if not i.cancelled() and i.exception() is not None:
+                raise i.exception()
+
+    async def send(self, data:bytes):
+        await self.__manager.put(data)
+
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        await self.__manager.put((cmd, frame))
+
+    async def send_segment(self, segment:main.FrameSegment):
+        await self.__manager.put(segment)
+
+    async def shutdown(self):
+        await self.__manager.shutdown()
+        self.router.shutdown()
+
+    def flow_stats(self) -> dict[str,int]:
+        return {**self.__manager.flow_stats(), **self.router.stats(), **self.__stats}
+
+    def admit(self) -> bool:
+        return self.__manager.admit()
+
+class QuartWebsocketSessionManager(main.TransportSessionHandler):
+    """An all-in-one session manager based on websockets.  
+    Clients authenticate over HTTP as with long-polling, then connect to
+    `websocket_handler()` with the session ID and token. The session lasts
+    as long as the connection; a client that reconnects starts a new one
+    (for instance, with a resumption ticket)."""
+
+    def __init__(self,
+            cmd_hndl:main.CommandHandler,
+            key,
+            hasher=None,
+            session_ttl:float=60,
+            socket_options:dict|None=None,
+            scheduler:main.CommandScheduler|None=None,
+            **kwargs):
+        # A session must connect within `session_ttl` of authenticating, after which it is kept alive by the connection.
+        super().__init__(cmd_hndl, key, hasher, session_ttl, scheduler, "websocket", **kwargs)
+        self.__socket_options = socket_options or {}
+
+    async def websocket_handler(self):
+        """Websocket handler. Can be used directly as a Quart websocket endpoint.  
+        The session ID and token are read from the `X-Pbj-Session-Id` and `X-Pbj-Session`
+        headers, or the `session_id` and `session` query arguments for clients that can't
+        set headers."""
+
+        headers = websocket.headers
+        args = websocket.args
+
+        try:
+            ses_id = int(headers.get("X-Pbj-Session-Id") or args.get("session_id"))
+        except (ValueError, TypeError):
+            return "Bad Request", 400
+
+        ses_token = headers.get("X-Pbj-Session") or args.get("session", "")
+
+        try:
+            ses = await self.test_session(ses_id, ses_token)
+        except main.SessionMisdirected as e:
+            return "Misdirected Request", 421, {"X-Pbj-Worker": e.owner}
+        except ValueError:
+            return "Unauthorized", 401
+
+        if self.get_handler(ses.id) is not None:
+            return "Conflict", 409
+
+        await websocket.accept()
+
+        handler = QuartWebsocketHandler(**self.__socket_options)
+        self.open_handler(ses, handler)
+        keepalive = asyncio.create_task(self.keepalive(ses))
+
+        try:
+            await handler.run()
+        except ValueError:
+            await websocket.close(1003)
+        finally:
+            keepalive.cancel()
+            await ses.close()
@@ -57,6 +57,21 @@ async def cmd_example_persistent(pipe:main.CommandDuplexContext):
             await p.send(await p.recv())
             await p.send("Next message")
 
+# Unary command: takes one value and returns one value, in a single round trip.
+
+@cmd_handler.command("example-unary", unary=True)
+async def cmd_example_unary(name:str):
+    return f"Hello, {name}!"
+
+# Command subscribed to a topic. Anything published to `example-events` (see `/broadcast`)
+# is sent to every subscribed command, in every session.
+
+@cmd_handler.command("example-events")
+async def cmd_example_events(pipe:main.CommandDuplexContext):
+    async with pipe as p:
+        sessions.subscribe("example-events", p)
+        await p.recv()
+
 # Load a long-poll session manager for the API key `my key`.  
 # > In a production environment you'd want to store the hashed key,
 # and load that instead of hashing the plaintext key at runtime.
@@ -77,20 +92,39 @@ app = Quart(__name__)
 async def index():
     return "OK"
 
-# `/auth` path is used to start a session.
+# `/auth` path is used to start a session.  
+# > A client reconnecting with a resumption ticket skips key verification.
 
 @app.route("/auth", methods=["POST"])
 async def auth():
-    key = await request.get_data(False)
-    ses = await sessions.authenticate(key)
+    try:
+        ticket = request.headers.get("X-Pbj-Ticket")
+        if ticket:
+            ses = await sessions.resume(ticket)
+        else:
+            ses = await sessions.authenticate(await request.get_data(False))
+    except main.Overloaded:
+        return "Service Unavailable", 503, {"Retry-After": "5"}
+    except ValueError:
+        return "Unauthorized", 401
+
     token = await ses.rotate_key(86400)
     
     response = Response("OK", 200)
     response.headers.set("X-Pbj-Session-Id", str(ses.id))
     response.headers.set("X-Pbj-Session", token)
+    response.headers.set("X-Pbj-Worker", sessions.worker)
+    response.headers.set("X-Pbj-Ticket", sessions.issue_ticket(ses))
 
     return response
 
+# `/broadcast` path publishes its body to every `example-events` command.
+
+@app.route("/broadcast", methods=["POST"])
+async def broadcast():
+    count = await sessions.publish("example-events", await request.get_data(as_text=True))
+    return f"Sent to {count} commands"
+
 # POST and PUT handlers for `/pbj` are linked to the session handler.
 
 app.route("/pbj", methods=["POST"])(sessions.request_handler)
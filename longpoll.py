@@ -0,0 +1,389 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+import zlib
+import typing
+import asyncio
+import collections
+from . import main, metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Python end of a long-poll session, speaking the same HTTP protocol as the Luau client:
+# `/auth` to start a session, POST polls (with acknowledgements and poll lanes) to receive,
+# and PUT batches to send. Needs httpx, which also lets it run against an ASGI app
+# in-process, without a network.
+
+# constants
+
+# Largest PUT body, as in the Luau client. A single larger message is still sent on its own.
+MAX_BATCH = 1048576
+# PUT bodies at least this long are gzipped, when compression is on.
+COMPRESS_THRESHOLD = 1024
+
+EMPTY_BATCH = main.pack_batch([])
+
+def http_client(max_connections:int=100, timeout:float=90, app=None, **kwargs) -> "httpx.AsyncClient":
+    """Create an `httpx.AsyncClient` suited to long polls.  
+    Keep-alive connections are pooled (up to `max_connections`), and reads wait
+    `timeout` seconds, which must be longer than the server holds a poll.
+    With `app`, requests go to that ASGI app in-process. Other keyword arguments
+    are passed on to `httpx.AsyncClient`."""
+
+    if httpx is None:
+        raise RuntimeError("The long-poll client needs httpx")
+    if app is not None:
+        kwargs["transport"] = httpx.ASGITransport(app=app)
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(timeout, connect=10),
+        **kwargs
+    )
+
+# transport
+
+class LongPollClientHandler(main.BaseDuplexHandler):
+    def __init__(self,
+            http:"httpx.AsyncClient",
+            url:str,
+            headers:dict[str,str],
+            compress:bool=False,
+            max_lanes:int|None=None,
+            max_fails:int=3,
+            fragment_size:int|None=65536,
+            max_message:int=16777216,
+            max_queued:int=256,
+            max_early:int=256,
+            max_buffer:int=4194304,
+            max_batch:int=MAX_BATCH,
+            shed_timeout:float=30):
+        """Carries one session over HTTP long polls, with session `headers` from `/auth`.  
+        Outgoing messages are queued and sent by a single task, so messages sent while
+        a PUT is in progress are coalesced into the next one, up to `max_batch` bytes.
+        At most `max_buffer` bytes wait to be sent; a `send()` that can't get room within
+        `shed_timeout` seconds raises `main.Overloaded`. EOF frames never wait.
+        Polls open as many lanes as the server allows (at most `max_lanes`), and batches
+        are dispatched in order. With `compress` set, responses are requested gzipped
+        and large PUT bodies are gzipped.
+        As in the Luau client, a PUT that fails is dropped, and the session ends after
+        `max_fails` requests in a row fail."""
+
+        self.fragment_size = fragment_size
+        self.max_message = max_message
+        self.route_incoming(max_queued, max_early, shed_timeout)
+        self.buffer_outgoing(max_buffer, shed_timeout)
+        self.__http = http
+        self.__url = url
+        self.__headers = {**headers, "Content-Type": "application/x-pbj-messages"}
+        self.__poll_headers = {**self.__headers, "X-Pbj-Accept-Encoding": "gzip"} if compress else self.__headers
+        self.__compress = compress
+        self.__max_lanes = max_lanes
+        self.__max_fails = max_fails
+        self.__max_batch = max_batch
+        self.__outgoing = collections.deque()
+        self.__max_buffer = max_buffer
+        self.__ready = asyncio.Event()
+        self.__closed = False
+        self.__fails = 0
+        self.__ack = 0
+        self.__received = {}
+        self.__reorder = {}
+        self.__polls = []
+        self.__group = None
+        self.__stats = {"puts": 0, "put_bytes": 0, "written": 0, "polls": 0, "batches": 0, "received": 0, "failures": 0}
+
+    async def __queue(self, message:main.T_Message, force:bool=False):
+        if metrics.tracer is not None:
+            metrics.tracer("longpoll.send", main.message_bytes(message))
+
+        await self.reserve(main.message_size(message), force)
+        self.__outgoing.append(message)
+        self.__stats["written"] += 1
+        self.__ready.set()
+
+    async def send(self, data:bytes):
+        await self.__queue(data, data[4:5] == main.FRAME_EOF)
+
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        # Kept as separate parts, so the frame is only copied into the PUT body.
+        await self.__queue((cmd, frame))
+
+    async def send_segment(self, segment:main.FrameSegment):
+        for i in segment.split(min(self.__max_batch, self.__max_buffer)):
+            await self.__queue(i)
+
+    def __failed(self, error:str):
+        self.__fails += 1
+        self.__stats["failures"] += 1
+
+        if self.__fails >= self.__max_fails:
+            raise ConnectionError(f"Max HTTP failures exceeded ({error})")
+
+    async def __take(self) -> list[main.T_Message]:
+        # Anything past the batch limit is left for the next request.
+        outgoing = self.__outgoing
+        messages = [outgoing.popleft()]
+        size = main.message_size(messages[0])
+
+        while outgoing and size + main.message_size(outgoing[0]) <= self.__max_batch:
+            messages.append(outgoing.popleft())
+            size += main.message_size(messages[-1])
+
+        if outgoing:
+            self.__ready.set()
+        await self.release(size)
+        return messages
+
+    async def __push(self):
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+
+            if not self.__outgoing:
+                if self.__closed is True:
+                    break
+                continue
+
+            # Let messages accumulate for a moment, as the Luau client does.
+            await asyncio.sleep(0)
+            body = main.pack_batch(await self.__take())
+            headers = self.__headers
+
+            if self.__compress is True and len(body) >= COMPRESS_THRESHOLD:
+                obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+                body = obj.compress(body) + obj.flush()
+                headers = {**headers, "Content-Encoding": "gzip"}
+
+            try:
+                res = await self.__http.put(self.__url, content=body, headers=headers)
+            except httpx.TransportError as e:
+                self.__failed(f"error: {e!r}")
+                continue
+
+            self.__stats["puts"] += 1
+            self.__stats["put_bytes"] += len(body)
+
+            if res.status_code != 200:
+                self.__failed(f"status {res.status_code}")
+            else:
+                self.__fails = 0
+
+        # Shut down and drained, so the polls are no longer needed.
+        for i in self.__polls:
+            i.cancel()
+
+    async def __dispatch_batch(self, body:bytes):
+        messages = main.unpack_batch(body)
+        self.__stats["batches"] += 1
+        self.__stats["received"] += len(messages)
+
+        for i in messages:
+            await self.dispatch(i)
+
+    def __open_lanes(self, count:int):
+        if self.__max_lanes is not None:
+            count = min(count, self.__max_lanes)
+
+        for i in range(len(self.__polls), count):
+            self.__polls.append(self.__group.create_task(self.__poll(i)))
+
+    async def __poll(self, lane:int):
+        while True:
+            headers = {
+                **self.__poll_headers,
+                # The last batch received in order, and the last response on this lane,
+                # so the server can resend any that were lost.
+                "X-Pbj-Ack": str(self.__ack),
+                "X-Pbj-Lane": str(lane),
+                "X-Pbj-Received": str(self.__received.get(lane, -1))
+            }
+
+            try:
+                res = await self.__http.post(self.__url, content=EMPTY_BATCH, headers=headers)
+            except httpx.TransportError as e:
+                self.__failed(f"error: {e!r}")
+                continue
+
+            self.__stats["polls"] += 1
+
+            if res.status_code == 410:
+                # Batches this side never got can't be resent, so commands would silently miss frames.
+                raise main.ReplayLost("Server dropped unacknowledged messages")
+            if res.status_code != 200:
+                self.__failed(f"status {res.status_code}")
+                continue
+
+            self.__fails = 0
+
+            if "X-Pbj-Seq" not in res.headers:
+                # A server without acknowledgements.
+                await self.__dispatch_batch(res.content)
+                continue
+
+            if lane == 0 and len(self.__polls) == 1:
+                self.__open_lanes(int(res.headers.get("X-Pbj-Lanes", 1)))
+
+            first, last = int(res.headers["X-Pbj-Seq-From"]), int(res.headers["X-Pbj-Seq"])
+            if last < first:
+                continue
+
+            self.__received[lane] = last
+            if last > self.__ack:
+                # Batches from other lanes may arrive early, so they're dispatched in order.
+                self.__reorder[first] = (last, res.content)
+
+                while self.__ack + 1 in self.__reorder:
+                    self.__ack, body = self.__reorder.pop(self.__ack + 1)
+                    await self.__dispatch_batch(body)
+
+    async def run(self):
+        """Poll and push until the handler is shut down.  
+        Raises `main.ReplayLost` if the server dropped messages that never arrived,
+        or `ConnectionError` once `max_fails` requests in a row have failed."""
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                self.__group = group
+                self.__polls = [group.create_task(self.__poll(0))]
+                group.create_task(self.__push())
+        except ExceptionGroup as e:
+            raise e.exceptions[0] from None
+        finally:
+            # Wake every command still waiting on the session.
+            self.__closed = True
+            self.router.shutdown()
+            await self.close_buffer()
+
+    async def shutdown(self):
+        "Stop accepting messages. `run()` returns once what is queued has been sent."
+
+        self.__closed = True
+        self.router.shutdown()
+        self.__ready.set()
+        await self.close_buffer()
+
+    def admit(self) -> bool:
+        return self.buffered < self.__max_buffer
+
+    def flow_stats(self) -> dict[str,int]:
+        return {
+            **self.__stats,
+            **self.buffer_stats(),
+            **self.router.stats(),
+            "lanes": len(self.__polls),
+            "reordered": len(self.__reorder)
+        }
+
+# client
+
+async def authenticate(http:"httpx.AsyncClient", url:str, key:str|bytes, ticket:str|None=None) -> tuple[dict[str,str],str|None]:
+    """Start a session at an `/auth` endpoint, returning its session headers and resumption ticket.  
+    With a `ticket`, the key is only checked if the ticket is rejected.
+    Raises `ValueError` if the key is rejected, or `main.Overloaded` if the server is busy."""
+
+    if isinstance(key, str):
+        key = bytes(key, "utf8")
+
+    res = await http.post(url, content=key, headers={"X-Pbj-Ticket": ticket} if ticket else None)
+    if ticket and res.status_code == 401:
+        # The ticket expired, so fall back to the key.
+        res = await http.post(url, content=key)
+
+    if res.status_code in (429, 503):
+        raise main.Overloaded(f"Server is overloaded (HTTP status {res.status_code})")
+    if res.status_code != 200:
+        raise ValueError(f"Authentication failed (HTTP status {res.status_code})")
+
+    headers = {
+        "X-Pbj-Session-Id": res.headers["X-Pbj-Session-Id"],
+        "X-Pbj-Session": res.headers["X-Pbj-Session"]
+    }
+    if "X-Pbj-Worker" in res.headers:
+        headers["X-Pbj-Worker"] = res.headers["X-Pbj-Worker"]
+
+    return headers, res.headers.get("X-Pbj-Ticket")
+
+class LongPollClient(main.DuplexClient):
+    """Python end of a long-poll session, talking to a `duplex.QuartLongPollSessionManager` as a game server would.  
+    Commands are run as with `main.DuplexClient`. Use `connect()` to connect over HTTP,
+    or `connect_app()` to call an ASGI app in-process. The resumption ticket, if the server
+    issued one, is kept as `ticket`."""
+
+    ticket: str|None = None
+
+    def __init__(self, handler:LongPollClientHandler, http:"httpx.AsyncClient|None"=None):
+        self.__handler = handler
+        self.__http = http
+        self.__task = asyncio.create_task(handler.run())
+        super().__init__(handler)
+
+    @classmethod
+    async def __connect(cls, http:"httpx.AsyncClient", owned:bool, url:str, key:str|bytes, auth_url:str|None, ticket:str|None, options:dict) -> typing.Self:
+        try:
+            headers, ticket = await authenticate(http, auth_url or f"{url}/auth", key, ticket)
+        except BaseException:
+            if owned is True:
+                await http.aclose()
+            raise
+
+        client = cls(LongPollClientHandler(http, url, headers, **options), http if owned is True else None)
+        client.ticket = ticket
+        return client
+
+    @classmethod
+    async def connect(cls,
+            url:str,
+            key:str|bytes,
+            auth_url:str|None=None,
+            ticket:str|None=None,
+            http:"httpx.AsyncClient|None"=None,
+            **options) -> typing.Self:
+        """Authenticate at `auth_url` (by default, `/auth` under `url`) and start polling `url`.  
+        Sessions may share one `http` client, and its connection pool; otherwise each
+        gets its own from `http_client()`, closed along with it.
+        Raises `ValueError` if the key is rejected. Other keyword arguments are passed on to `LongPollClientHandler`."""
+
+        if http is None:
+            return await cls.__connect(http_client(), True, url, key, auth_url, ticket, options)
+        return await cls.__connect(http, False, url, key, auth_url, ticket, options)
+
+    @classmethod
+    async def connect_app(cls, app, key:str|bytes, url:str="/pbj", auth_url:str|None=None, **options) -> typing.Self:
+        """Connect to an ASGI app in-process, through `httpx.ASGITransport`, without a network.  
+        The app must already be started (for Quart, inside `app.test_app()`). See `connect()`."""
+
+        http = http_client(app=app, base_url="http://pbj")
+        return await cls.__connect(http, True, url, key, auth_url, None, options)
+
+    def flow_stats(self) -> dict[str,int]:
+        return self.__handler.flow_stats()
+
+    async def close(self):
+        "Send what is queued, then stop polling, ending every open command."
+
+        await self.__handler.shutdown()
+
+        try:
+            await self.__task
+        except (ValueError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if self.__http is not None:
+                await self.__http.aclose()
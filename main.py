@@ -16,13 +16,33 @@
 
 import io
 import os
+import sys
+import hmac
 import json
+import array
 import time
+import heapq
+import mmap
+import socket
+import struct
 import typing
+import base64
 import asyncio
+import functools
+import collections
+import multiprocessing.connection
+import concurrent.futures
+from . import metrics
+from .store import MemorySessionStore, SessionStore
 from nacl import bindings
-from hashlib import sha3_512
+from hashlib import blake2b, sha3_512
 from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # this
 
@@ -36,17 +56,66 @@ FRAME_NULL = b"\x00"
 FRAME_BINARY = b"\x40"
 FRAME_TEXT = b"\x41"
 FRAME_JSON = b"\x50"
+FRAME_STRUCT = b"\x51"
+FRAME_FRAGMENT = b"\x60"
+FRAME_FRAGMENT_END = b"\x61"
+FRAME_RESULT = b"\x70"
 FRAME_EOF = b"\xff"
 
 STATUS_OK = b"\x00"
 STATUS_NOTFOUND = b"\xa1"
 
+U32 = struct.Struct("<I")
+
+# Piece size for streamed frames, when the transport doesn't fragment frames itself.
+STREAM_CHUNK = 65536
+
+ST_NULL = 0x00
+ST_FALSE = 0x01
+ST_TRUE = 0x02
+ST_I8 = 0x10
+ST_I16 = 0x11
+ST_I32 = 0x12
+ST_I64 = 0x13
+ST_F64 = 0x18
+ST_STR = 0x20
+ST_BYTES = 0x21
+ST_ARRAY = 0x30
+ST_MAP = 0x31
+ST_VECTOR = 0x40
+
+ST_MAX_DEPTH = 64
+ST_VECTOR_MIN = 8
+
 # exceptions
 
 class CommandError(RuntimeError):
     "Base class for command-related errors"
 class InternalCommandError(CommandError):
     "Error in user-provided command handler"
+class Overloaded(CommandError):
+    "Data couldn't be buffered before the shed timeout"
+class CommandFailed(CommandError):
+    "Expected command failure, reported to the client with a status and reason"
+
+    def __init__(self, status:bytes=b"\xa0", reason:str="pbj:failed"):
+        super().__init__(f"Command failed with status {status[0]:#04x} ({reason})")
+        self.status = status
+        self.reason = reason
+
+    def __reduce__(self):
+        # Raised in pool workers, so it must survive pickling with its status intact.
+        return CommandFailed, (self.status, self.reason)
+class CommandCancelled(CommandError):
+    "The command closed while its handler was still running in a `HandlerPool`"
+class SessionMisdirected(ValueError):
+    "Valid session owned by a different worker"
+
+    def __init__(self, owner:str):
+        super().__init__(f"Session is owned by worker '{owner}'")
+        self.owner = owner
+class ReplayLost(ValueError):
+    "Batches the client hasn't acknowledged were dropped from the replay buffer"
 
 # utility
 
@@ -54,32 +123,578 @@ async def pack_eof(status:bytes, message:str) -> bytes:
     raw = bytes(message, "utf8")
     return FRAME_EOF + status + len(raw).to_bytes(1, "little", signed=False) + raw
 
-async def pack_frame(v:typing.Any) -> bytes:
-    if isinstance(v, str):
+async def pack_frame(v:typing.Any, structured:bool=False) -> bytes:
+    """Pack a value into a frame.  
+    Strings and bytes always use text and binary frames. Other values use JSON frames,
+    or structured frames if `structured` is set."""
+
+    return encode_frame(v, structured)
+
+def encode_frame(v:typing.Any, structured:bool=False) -> bytes:
+    "Synchronous `pack_frame()`, for code running outside the event loop."
+
+    if v is None:
+        return FRAME_NULL
+    elif isinstance(v, str):
         return FRAME_TEXT + bytes(v, "utf8")
     elif isinstance(v, bytes):
         return FRAME_BINARY + v
+    elif structured is True:
+        return FRAME_STRUCT + pack_struct(v)
     elif (isinstance(v, list)
             or isinstance(v, dict)
             or isinstance(v, float)
             or isinstance(v, int)
             or isinstance(v, bool)):
-        return FRAME_JSON + bytes(json.dumps(v), "utf8")
+        return FRAME_JSON + dump_json(v)
     
     raise ValueError(f"Cannot pack frame for type '{type(v)}'")
 
 async def unpack_eof(data:bytes) -> tuple[bytes,str]:
     return data[:1], str(data[2:], "utf8")
 
+def unpack_frame(data:bytes) -> typing.Any:
+    """Decode a data frame into a value.  
+    Raises `ValueError` for unknown frame types."""
+
+    frame = data[:1]
+    data = data[1:]
+
+    match frame:
+        case b"\x00":
+            return None
+        case b"\x40":
+            return data
+        case b"\x41":
+            return str(data, "utf8")
+        case b"\x50":
+            return load_json(data)
+        case b"\x51":
+            return unpack_struct(data)
+
+    raise ValueError(f"Invalid frame type: {frame[0]}")
+
+async def pack_result(status:bytes, reason:str, frame:bytes) -> bytes:
+    "Pack the result frame of a unary command, combining its reply frame and final status."
+
+    raw = bytes(reason, "utf8")
+    return FRAME_RESULT + status + len(raw).to_bytes(1, "little", signed=False) + raw + frame
+
+async def unpack_result(data:bytes) -> tuple[bytes,str,bytes]:
+    "Split a result frame into its status, reason and reply frame."
+
+    length = data[2]
+    return data[1:2], str(data[3:3 + length], "utf8"), data[3 + length:]
+
+async def iterate_chunks(chunks:typing.AsyncIterable[bytes]|typing.Iterable[bytes]) -> typing.AsyncIterator[bytes]:
+    "Iterate over an iterable or async iterable of chunks."
+
+    if hasattr(chunks, "__aiter__"):
+        async for i in chunks:
+            yield i
+    else:
+        for i in chunks:
+            yield i
+
+def split_frame(frame:bytes, limit:int) -> list[bytes]:
+    "Split a frame into fragment frames carrying at most `limit` bytes each."
+
+    view = memoryview(frame)
+    return [
+        (FRAME_FRAGMENT if i + limit < len(view) else FRAME_FRAGMENT_END) + view[i:i + limit]
+        for i in range(0, len(view), limit)
+    ]
+
+# json (uses orjson if it is installed)
+
+if orjson is not None:
+    def dump_json(v:typing.Any) -> bytes:
+        return orjson.dumps(v, option=orjson.OPT_NON_STR_KEYS)
+
+    def load_json(data:bytes) -> typing.Any:
+        return orjson.loads(data)
+else:
+    def dump_json(v:typing.Any) -> bytes:
+        return bytes(json.dumps(v), "utf8")
+
+    def load_json(data:bytes) -> typing.Any:
+        return json.loads(data)
+
+# structured frames
+
+def array_code(size:int, codes:str) -> str:
+    for i in codes:
+        if array.array(i).itemsize == size:
+            return i
+
+ST_INTS = (
+    (ST_I8, struct.Struct("<Bb"), -0x80, 0x80),
+    (ST_I16, struct.Struct("<Bh"), -0x8000, 0x8000),
+    (ST_I32, struct.Struct("<Bi"), -0x80000000, 0x80000000),
+    (ST_I64, struct.Struct("<Bq"), -0x8000000000000000, 0x8000000000000000)
+)
+ST_HEAD = struct.Struct("<BI")
+ST_VECTOR_HEAD = struct.Struct("<BBI")
+ST_FLOAT = struct.Struct("<Bd")
+ST_FIXED = {
+    ST_I8: struct.Struct("<b"),
+    ST_I16: struct.Struct("<h"),
+    ST_I32: struct.Struct("<i"),
+    ST_I64: struct.Struct("<q"),
+    ST_F64: struct.Struct("<d")
+}
+ST_ARRAYS = {ST_I32: array_code(4, "ilh"), ST_I64: array_code(8, "qlL"), ST_F64: "d"}
+
+def pack_vector(v:typing.Sequence) -> bytes|None:
+    "Pack a homogeneous list of ints or floats as one typed array, or return `None` if it isn't one."
+
+    kind = type(v[0])
+    if kind is float:
+        if not all(type(i) is float for i in v):
+            return None
+        tag = ST_F64
+        arr = array.array("d", v)
+    elif kind is int:
+        if not all(type(i) is int for i in v):
+            return None
+        try:
+            tag = ST_I32
+            arr = array.array(ST_ARRAYS[ST_I32], v)
+        except OverflowError:
+            try:
+                tag = ST_I64
+                arr = array.array(ST_ARRAYS[ST_I64], v)
+            except OverflowError:
+                return None
+    else:
+        return None
+
+    if sys.byteorder == "big":
+        arr.byteswap()
+
+    return ST_VECTOR_HEAD.pack(ST_VECTOR, tag, len(arr)) + arr.tobytes()
+
+def pack_struct_into(out:bytearray, v:typing.Any, depth:int=0):
+    if depth > ST_MAX_DEPTH:
+        raise ValueError("Structured value is nested too deeply")
+
+    # Exact type checks first, since they are by far the most common
+    kind = type(v)
+
+    if kind is str:
+        raw = bytes(v, "utf8")
+        out += ST_HEAD.pack(ST_STR, len(raw))
+        out += raw
+    elif kind is float:
+        out += ST_FLOAT.pack(ST_F64, v)
+    elif v is None:
+        out.append(ST_NULL)
+    elif v is True:
+        out.append(ST_TRUE)
+    elif v is False:
+        out.append(ST_FALSE)
+    elif isinstance(v, int):
+        for tag, packer, low, high in ST_INTS:
+            if low <= v < high:
+                out += packer.pack(tag, v)
+                return
+        raise ValueError("Integer is out of range for a structured frame")
+    elif isinstance(v, dict):
+        out += ST_HEAD.pack(ST_MAP, len(v))
+        for i, j in v.items():
+            pack_struct_into(out, i, depth + 1)
+            pack_struct_into(out, j, depth + 1)
+    elif isinstance(v, (list, tuple)):
+        vector = pack_vector(v) if len(v) >= ST_VECTOR_MIN else None
+        if vector is not None:
+            out += vector
+            return
+
+        out += ST_HEAD.pack(ST_ARRAY, len(v))
+        for i in v:
+            pack_struct_into(out, i, depth + 1)
+    elif isinstance(v, float):
+        out += ST_FLOAT.pack(ST_F64, v)
+    elif isinstance(v, str):
+        pack_struct_into(out, str(v), depth)
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        out += ST_HEAD.pack(ST_BYTES, len(v))
+        out += v
+    else:
+        raise ValueError(f"Cannot pack structured value for type '{type(v)}'")
+
+def pack_struct(v:typing.Any) -> bytes:
+    "Encode a value in the structured frame format."
+
+    out = bytearray()
+    pack_struct_into(out, v)
+    return bytes(out)
+
+def unpack_struct_from(view:bytes, cursor:int, depth:int=0) -> tuple[typing.Any,int]:
+    if depth > ST_MAX_DEPTH:
+        raise ValueError("Structured value is nested too deeply")
+
+    tag = view[cursor]
+    cursor += 1
+
+    if tag in ST_FIXED:
+        packer = ST_FIXED[tag]
+        return packer.unpack_from(view, cursor)[0], cursor + packer.size
+    elif tag == ST_STR or tag == ST_BYTES:
+        length, = U32.unpack_from(view, cursor)
+        cursor += 4
+        if cursor + length > len(view):
+            raise ValueError("Truncated structured frame")
+
+        if tag == ST_STR:
+            return view[cursor:cursor + length].decode("utf8"), cursor + length
+        return view[cursor:cursor + length], cursor + length
+    elif tag == ST_ARRAY:
+        count, = U32.unpack_from(view, cursor)
+        cursor += 4
+        res = []
+        for _ in range(count):
+            v, cursor = unpack_struct_from(view, cursor, depth + 1)
+            res.append(v)
+        return res, cursor
+    elif tag == ST_MAP:
+        count, = U32.unpack_from(view, cursor)
+        cursor += 4
+        res = {}
+        for _ in range(count):
+            k, cursor = unpack_struct_from(view, cursor, depth + 1)
+            v, cursor = unpack_struct_from(view, cursor, depth + 1)
+            res[k] = v
+        return res, cursor
+    elif tag == ST_VECTOR:
+        kind = view[cursor]
+        count, = U32.unpack_from(view, cursor + 1)
+        cursor += 5
+        if not kind in ST_ARRAYS:
+            raise ValueError(f"Invalid structured vector type: {kind}")
+
+        arr = array.array(ST_ARRAYS[kind])
+        end = cursor + count * arr.itemsize
+        if end > len(view):
+            raise ValueError("Truncated structured frame")
+
+        arr.frombytes(view[cursor:end])
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return arr.tolist(), end
+    elif tag == ST_NULL:
+        return None, cursor
+    elif tag == ST_FALSE:
+        return False, cursor
+    elif tag == ST_TRUE:
+        return True, cursor
+
+    raise ValueError(f"Invalid structured value type: {tag}")
+
+def unpack_struct(data:bytes|memoryview) -> typing.Any:
+    """Decode a value in the structured frame format.  
+    Raises `ValueError` if the data is malformed."""
+
+    # Indexing and slicing `bytes` is quicker than a memoryview here.
+    view = bytes(data)
+
+    try:
+        v, cursor = unpack_struct_from(view, 0)
+    except (IndexError, struct.error, TypeError, UnicodeDecodeError) as e:
+        raise ValueError("Malformed structured frame") from e
+
+    if cursor != len(view):
+        raise ValueError("Trailing data in structured frame")
+    return v
+
+# batches
+
+class FrameSegment:
+    """Several messages for one command, already packed as they appear in a batch
+    (each with its 4-byte length). It is queued as one item, and copied into
+    batches as it is, so the messages are never packed again."""
+
+    __slots__ = ("cmd", "data", "count")
+
+    def __init__(self, cmd:bytes, data:bytes|bytearray|memoryview, count:int):
+        self.cmd = cmd
+        self.data = data
+        self.count = count
+
+    def messages(self) -> list[memoryview]:
+        "Unpack the segment into its messages."
+
+        return unpack_batch(U32.pack(self.count) + self.data)
+
+    def split(self, limit:int) -> list["FrameSegment"]:
+        """Split the segment between messages into segments of at most `limit` bytes.  
+        A message longer than `limit` gets a segment of its own. The data isn't copied."""
+
+        if len(self.data) <= limit:
+            return [self]
+
+        view = memoryview(self.data)
+        segments = []
+        start = cursor = count = 0
+
+        while cursor < len(view):
+            end = cursor + 4 + U32.unpack_from(view, cursor)[0]
+            if count > 0 and end - start > limit:
+                segments.append(FrameSegment(self.cmd, view[start:cursor], count))
+                start = cursor
+                count = 0
+
+            count += 1
+            cursor = end
+
+        segments.append(FrameSegment(self.cmd, view[start:cursor], count))
+        return segments
+
+T_Message = bytes|tuple[bytes,...]|FrameSegment
+
+def message_size(message:T_Message) -> int:
+    "Get the length of a batch message, which may be a tuple of parts or a segment."
+
+    if type(message) is tuple:
+        return sum(map(len, message))
+    if type(message) is FrameSegment:
+        return len(message.data)
+    return len(message)
+
+def message_command(message:T_Message) -> bytes:
+    "Get the command ID a batch message is for."
+
+    if type(message) is tuple:
+        return message[0]
+    if type(message) is FrameSegment:
+        return message.cmd
+    return message[:4]
+
+def message_bytes(message:T_Message) -> bytes:
+    "Join a batch message into one `bytes` object, for tracing. Segments keep their lengths."
+
+    if type(message) is tuple:
+        return b"".join(message)
+    if type(message) is FrameSegment:
+        return bytes(message.data)
+    return message
+
+def pack_batch(messages:typing.Sequence[T_Message]) -> bytes:
+    """Pack messages into the length-prefixed batch format.  
+    A message may be a tuple of parts (such as a command ID and a frame shared
+    with other sessions), which are written one after another, or a `FrameSegment`,
+    which is written as it is.  
+    The output is sized up front and filled in a single copy of each message."""
+
+    count = len(messages)
+    parts = [b""]
+    for i in messages:
+        if type(i) is tuple:
+            parts.append(U32.pack(sum(map(len, i))))
+            parts.extend(i)
+        elif type(i) is FrameSegment:
+            count += i.count - 1
+            parts.append(i.data)
+        else:
+            parts.append(U32.pack(len(i)))
+            parts.append(i)
+
+    parts[0] = U32.pack(count)
+    return b"".join(parts)
+
+def unpack_batch(data:bytes|bytearray|memoryview) -> list[memoryview]:
+    """Unpack a length-prefixed batch into `memoryview` slices of `data`.  
+    Raises `ValueError` if the batch is truncated."""
+
+    view = memoryview(data)
+    size = len(view)
+
+    if size < 4:
+        raise ValueError("Truncated batch")
+
+    count, = U32.unpack_from(view, 0)
+    cursor = 4
+    res = []
+
+    for _ in range(count):
+        if cursor + 4 > size:
+            raise ValueError("Truncated batch")
+
+        length, = U32.unpack_from(view, cursor)
+        cursor += 4
+
+        if cursor + length > size:
+            raise ValueError("Truncated batch")
+
+        res.append(view[cursor:cursor + length])
+        cursor += length
+
+    return res
+
+# authentication
+
+class VerifierPool:
+    """Dedicated thread pool for Argon2 key verification.  
+    Verification is deliberately slow, so it runs on its own `workers` threads
+    rather than the default executor, where a burst of logins would hold up every
+    other `asyncio.to_thread` call. At most `max_pending` verifications may be
+    queued or running; past that, `verify()` raises `Overloaded` straight away."""
+
+    def __init__(self, hasher:PasswordHasher|None=None, workers:int=2, max_pending:int=64):
+        if hasher is None:
+            hasher = PasswordHasher()
+
+        self.hasher = hasher
+        self.__pool = concurrent.futures.ThreadPoolExecutor(workers, "pbj-verify")
+        self.__max_pending = max_pending
+        self.__pending = 0
+        self.__stats = {
+            "verified": 0, "failed": 0, "rejected": 0, "peak": 0,
+            "queue_time": 0.0, "max_queue_time": 0.0, "verify_time": 0.0
+        }
+
+    def __verify(self, queued:float, hash:str|bytes, key:str|bytes) -> tuple[bool,float,float]:
+        # Timings are handed back rather than recorded here, so stats are only touched on the loop.
+        start = time.perf_counter()
+
+        try:
+            res = self.hasher.verify(hash, key)
+        except (VerificationError, InvalidHashError):
+            res = False
+        return res, start - queued, time.perf_counter() - start
+
+    async def verify(self, hash:str|bytes, key:str|bytes) -> bool:
+        "Check a key against an Argon2 hash, returning `True` if it matches."
+
+        if self.__pending >= self.__max_pending:
+            self.__stats["rejected"] += 1
+            raise Overloaded("Too many pending verifications")
+
+        self.__pending += 1
+        self.__stats["peak"] = max(self.__stats["peak"], self.__pending)
+
+        try:
+            res, wait, elapsed = await asyncio.get_running_loop().run_in_executor(
+                self.__pool, self.__verify, time.perf_counter(), hash, key
+            )
+        finally:
+            self.__pending -= 1
+
+        self.__stats["queue_time"] += wait
+        self.__stats["max_queue_time"] = max(self.__stats["max_queue_time"], wait)
+        self.__stats["verify_time"] += elapsed
+        self.__stats["verified" if res is True else "failed"] += 1
+
+        if metrics.enabled:
+            metrics.auth_seconds.observe(wait + elapsed, "ok" if res is True else "failed")
+        return res
+
+    def stats(self) -> dict[str,int|float]:
+        "Get verification counters. Times are totals, in seconds."
+
+        return {**self.__stats, "pending": self.__pending}
+
+    def shutdown(self):
+        "Stop the worker threads once queued verifications finish."
+
+        self.__pool.shutdown(False, cancel_futures=True)
+
+class TicketSigner:
+    """Signs and checks small binary payloads with keyed BLAKE2b.  
+    `purpose` (up to 16 bytes) separates payloads signed for different uses
+    with the same secret. Tickets are URL-safe base64 strings, fit for headers."""
+
+    def __init__(self, secret:bytes|None=None, purpose:bytes=b"pbj"):
+        if secret is None:
+            secret = os.urandom(32)
+
+        self.__secret = secret
+        self.__purpose = purpose
+
+    def __mac(self, data:bytes) -> bytes:
+        return blake2b(data, digest_size=32, key=self.__secret, person=self.__purpose).digest()
+
+    def sign(self, data:bytes) -> str:
+        "Sign a payload, returning the ticket."
+
+        return str(base64.urlsafe_b64encode(data + self.__mac(data)).rstrip(b"="), "ascii")
+
+    def unsign(self, ticket:str) -> bytes:
+        """Check a ticket, returning its payload.  
+        Raises `ValueError` if the ticket is malformed or the signature doesn't match."""
+
+        try:
+            raw = base64.b64decode(ticket + "=" * (-len(ticket) % 4), b"-_", validate=True)
+        except (ValueError, TypeError) as e:
+            raise ValueError("Malformed ticket") from e
+
+        # Only the canonical encoding is accepted, so a ticket can't be altered
+        # (in its padding bits, for instance) and still pass.
+        if len(raw) < 32 or str(base64.urlsafe_b64encode(raw).rstrip(b"="), "ascii") != ticket:
+            raise ValueError("Malformed ticket")
+
+        data = raw[:-32]
+        # `hmac.compare_digest` is constant-time, and far cheaper to call than `sodium_memcmp`.
+        if not hmac.compare_digest(raw[-32:], self.__mac(data)):
+            raise ValueError("Invalid ticket signature")
+        return data
+
+TICKET = struct.Struct("<QdI8s")
+SESSION_TOKEN = struct.Struct("<QdI8s")
+
+def read_session_token(signer:TicketSigner, token:str) -> tuple[int,float,int,bytes,str]:
+    """Check a signed session token, returning its session ID, expiry, generation,
+    the instance of the owning worker that signed it, and the owner.  
+    Raises `ValueError` if the token is invalid or expired."""
+
+    data = signer.unsign(token)
+    if len(data) < SESSION_TOKEN.size:
+        raise ValueError("Malformed session token")
+
+    id, expiry, generation, instance = SESSION_TOKEN.unpack_from(data)
+    if expiry < time.time():
+        raise ValueError("Expired session token")
+
+    return id, expiry, generation, instance, str(data[SESSION_TOKEN.size:], "utf8")
+
 # session class
 
 class Session:
-    def __init__(self, id:int):
+    """A client session.  
+    By default, tokens are random and only their hash is kept. With a `signer`,
+    tokens are instead signed with the session ID, expiry, generation, `owner` and
+    `instance` (which tells apart sessions of a worker from before a restart), so
+    they can be checked without any per-session state. Rotating the key bumps the
+    generation, which invalidates older tokens.  
+    `requeue` is called whenever the expiry moves before the one last queued
+    for the reaper (`queued`), so the session isn't kept open past it."""
+
+    __slots__ = ("id", "token", "expiry", "queued", "dead", "generation", "token_expiry", "tickets", "__close_hook", "__store", "__signer", "__owner", "__instance", "__requeue", "__issued")
+
+    def __init__(self, id:int, store:SessionStore|None=None, signer:TicketSigner|None=None, owner:str="", instance:bytes=bytes(8),
+            requeue:typing.Callable[[typing.Self],None]|None=None):
         self.id = id
         self.token = b""
         self.expiry = 0
+        self.queued = 0
         self.dead = False
+        self.generation = 0
+        self.token_expiry = 0
+        self.tickets = 0
         self.__close_hook = []
+        self.__store = store
+        self.__signer = signer
+        self.__owner = owner
+        self.__instance = instance
+        self.__requeue = requeue
+        self.__issued = b""
+
+    def __set_expiry(self, expiry:float):
+        lowered = expiry < self.queued
+        self.expiry = expiry
+
+        if lowered and self.__requeue is not None:
+            self.__requeue(self)
 
     def on_close(self, callback:typing.Callable[[typing.Self],typing.Awaitable[None]]):
         "Add a hook to run on close."
@@ -93,91 +708,724 @@ class Session:
         if self.dead is True:
             raise RuntimeError("Cannot rotate a closed session")
 
-        token = sha3_512(os.urandom(64)).hexdigest()
-        self.token = sha3_512(bytes(token, "utf8")).digest()
-        self.expiry = time.perf_counter() + lifetime
+        self.token_expiry = time.time() + lifetime
+
+        if self.__signer is not None:
+            self.generation += 1
+            token = self.__signer.sign(
+                SESSION_TOKEN.pack(self.id, self.token_expiry, self.generation, self.__instance) + bytes(self.__owner, "utf8")
+            )
+            self.__issued = bytes(token, "ascii")
+        else:
+            token = sha3_512(os.urandom(64)).hexdigest()
+            self.token = sha3_512(bytes(token, "utf8")).digest()
+        self.__set_expiry(time.perf_counter() + lifetime)
+
+        if self.__store is not None:
+            await self.__store.save(self.id, self.token, self.token_expiry)
 
         return token
 
     async def validate(self, sent:str, bump_by:float=30) -> bool:
         "Validate a client-sent session token, returning `True` if it is valid."
-        
-        self.expiry = time.perf_counter() + bump_by
 
         if self.dead is True:
             return False
 
-        if bindings.sodium_memcmp(self.token, sha3_512(bytes(sent, "utf8")).digest()) is True:
+        if self.__signer is not None:
+            # Signing is deterministic, so the token issued for the current generation
+            # (with this session's ID, owner and instance) is the only valid one.
+            valid = (self.token_expiry >= time.time()
+                and bindings.sodium_memcmp(self.__issued, bytes(sent, "utf8")))
+        else:
+            valid = bindings.sodium_memcmp(self.token, sha3_512(bytes(sent, "utf8")).digest())
+
+        if valid is True:
+            self.__set_expiry(time.perf_counter() + bump_by)
             return True
         return False
     
+    def bump(self, by:float=30):
+        """Extend the session's expiry without checking a token.  
+        For transports that authenticate once per connection, such as websockets."""
+
+        if self.dead is False:
+            self.__set_expiry(time.perf_counter() + by)
+
     async def close(self):
         "Close the session and mark it invalid, running all close hooks afterwards."
 
+        if self.dead is True:
+            return
+
         self.dead = True
         self.expiry = 0
 
         for i in self.__close_hook:
-            await i()
+            await i(self)
 
 # session handler
 
 class SessionHandler:
-    __ses: dict[int,Session]
+    """Session registry.  
+    Sessions are tracked in a heap ordered by expiry, and a background reaper
+    closes any session that hasn't been validated before its expiry.
+
+    With a shared `store`, several worker processes can hand out session IDs
+    without conflicts. If `affinity` is set, a valid session owned by another
+    worker raises `SessionMisdirected` instead of being rejected outright,
+    so the request can be routed back to the owner (see `worker`).
+
+    Keys are checked on a `VerifierPool`, which may be shared between handlers.
+    Once authenticated, a client can be given a resumption ticket (see
+    `issue_ticket()`), valid for `ticket_ttl` seconds, which recovers its session
+    through `resume()` without checking the key again. Tickets are single use, and
+    only recover the session they were issued for. Workers that should accept
+    each other's tickets, or tickets from before a restart, need the same `ticket_secret`.
+
+    With a `token_secret`, session tokens are signed rather than random (see
+    `Session`), and any worker with the same secret can check them through
+    `check_token()`. Tokens of closed sessions are kept in a revocation set
+    until they expire, and the owning worker also rejects tokens replaced by
+    a key rotation."""
 
-    def __init__(self, key:str|bytes, hasher:PasswordHasher|None=None):
-        if hasher is None:
-            hasher = PasswordHasher()
+    __ses: dict[int,Session]
+    __expiry: list[tuple[float,int]]
+
+    def __init__(self,
+            key:str|bytes,
+            hasher:PasswordHasher|None=None,
+            session_ttl:float=30,
+            reap_interval:float=1,
+            store:SessionStore|None=None,
+            worker:str|None=None,
+            affinity:bool=False,
+            verifier:VerifierPool|None=None,
+            ticket_secret:bytes|None=None,
+            ticket_ttl:float=86400,
+            token_secret:bytes|None=None,
+            topics:"PubSub|None"=None):
+        if verifier is None:
+            verifier = VerifierPool(hasher)
+        if store is None:
+            store = MemorySessionStore()
+        if worker is None:
+            worker = f"{socket.gethostname()}-{os.getpid()}"
+        if topics is None:
+            topics = PubSub()
 
-        self.__id_prog = 0
         self.__ses = {}
+        self.__topics = topics
         self.__key = key
-        self.__hasher = hasher
+        self.__verifier = verifier
+        self.__tickets = TicketSigner(ticket_secret, b"pbj-resume")
+        self.__ticket_ttl = ticket_ttl
+        self.__spent = {}
+        self.__signer = None if token_secret is None else TicketSigner(token_secret, b"pbj-session")
+        self.__revoked = {}
+        # Tells this process's sessions apart from those of the same worker before a restart.
+        self.__instance = os.urandom(8)
+        self.__ttl = session_ttl
+        self.__expiry = []
+        self.__reaper = None
+        self.__reap_interval = reap_interval
+        self.__last_purge = 0
+        self.__store = store
+        self.__affinity = affinity
+        self.__stats = {"reaped": 0, "requeued": 0, "dropped": 0, "purged": 0, "errors": 0, "runs": 0}
+        self.worker = worker
     
     async def test_session(self, id:int, token:str) -> Session:
         """Test a session ID and token, returning it on success.  
-        Raises `ValueError` if the session is invalid."""
+        Raises `ValueError` if the session is invalid, or `SessionMisdirected`
+        if it belongs to another worker and affinity routing is enabled."""
+
+        if self.__signer is not None:
+            return await self.__test_signed(id, token)
 
         if id in self.__ses:
-            if await self.__ses[id].validate(token) is True:
+            if await self.__ses[id].validate(token, self.__ttl) is True:
                 return self.__ses[id]
+        elif self.__affinity is True:
+            row = await self.__store.load(id)
+
+            if row is not None and row[1] > time.time() and row[2] != self.worker:
+                if bindings.sodium_memcmp(row[0], sha3_512(bytes(token, "utf8")).digest()) is True:
+                    raise SessionMisdirected(row[2])
         
         raise ValueError("Invalid session")
 
+    def check_token(self, token:str) -> tuple[int,int,str]:
+        """Check a signed session token without looking up its session,
+        returning the session ID, generation and owning worker.  
+        Revocations are only known to the worker that issued the token, so a token
+        from another worker may belong to a session that has since closed or rotated
+        its key. Such tokens are only good for routing to their owner, which then
+        rejects them if they were revoked.  
+        Raises `ValueError` if the token is invalid or expired, or was issued by this
+        worker and revoked."""
+
+        id, generation, _, owner = self.__check_token(token)
+        return id, generation, owner
+
+    def __check_token(self, token:str) -> tuple[int,int,bytes,str]:
+        if self.__signer is None:
+            raise RuntimeError("Signed session tokens are not enabled")
+
+        id, _, generation, instance, owner = read_session_token(self.__signer, token)
+
+        revoked = self.__revoked.get(id)
+        if revoked is not None and owner == self.worker and generation < revoked[0]:
+            raise ValueError("Revoked session token")
+        return id, generation, instance, owner
+
+    def revoke(self, id:int, generation:int, until:float):
+        """Revoke every signed token of a session older than `generation`.  
+        The entry is kept until `until` (wall-clock time), when those tokens expire anyway."""
+
+        if self.__revoked.get(id, (0,))[0] < generation:
+            self.__revoked[id] = (generation, until)
+
+    async def __test_signed(self, id:int, token:str) -> Session:
+        # The current token of a local session is checked without reading it.
+        ses = self.__ses.get(id)
+        if ses is not None and await ses.validate(token, self.__ttl) is True:
+            return ses
+
+        # Anything else is read only to tell where it belongs. Session IDs are only
+        # unique within one worker, so a local session with the same ID is a different session.
+        tid, _, _, owner = self.__check_token(token)
+        if tid == id and owner != self.worker and self.__affinity is True:
+            raise SessionMisdirected(owner)
+        raise ValueError("Invalid session")
+
     async def start_session(self) -> Session:
         "Start a new uninitialized session."
 
-        cur_id = self.__id_prog + 1
-        self.__id_prog = cur_id
+        # Until the key is first rotated, the shared copy expires with the session.
+        cur_id = await self.__store.allocate(self.worker, time.time() + self.__ttl)
 
-        ses = Session(cur_id)
+        ses = Session(cur_id, self.__store, self.__signer, self.worker, self.__instance, self.__requeue)
+        ses.expiry = time.perf_counter() + self.__ttl
+        ses.on_close(self.__forget)
 
         self.__ses[cur_id] = ses
+        self.__requeue(ses)
+
+        if self.__reaper is None:
+            self.__reaper = asyncio.create_task(self.__reap_loop())
+
         return ses
     
     async def authenticate(self, key:str|bytes) -> Session:
-        "Start an uninitialized session if the key is valid."
+        """Start an uninitialized session if the key is valid.  
+        Raises `ValueError` if the key is invalid, or `Overloaded` if too many
+        verifications are already pending."""
 
-        if await asyncio.to_thread(self.__hasher.verify, self.__key, key) is True:
+        if await self.__verifier.verify(self.__key, key) is True:
             return await self.start_session()
+        raise ValueError("Invalid key")
+
+    def issue_ticket(self, ses:Session) -> str:
+        """Issue a signed resumption ticket for a session.  
+        Tickets carry the owning worker and its current run, and a serial number,
+        so issuing a new ticket invalidates the session's older ones."""
+
+        expiry = time.time() + self.__ticket_ttl
+        if ses.tickets > 0:
+            self.__spend((self.worker, self.__instance, ses.id), ses.tickets, expiry)
+
+        ses.tickets += 1
+        return self.__tickets.sign(
+            TICKET.pack(ses.id, expiry, ses.tickets, self.__instance) + bytes(self.worker, "utf8")
+        )
+
+    def __spend(self, key:tuple[str,bytes,int], serial:int, until:float):
+        # Tickets of a session up to `serial` are refused until they expire anyway.
+        if self.__spent.get(key, (0,))[0] < serial:
+            self.__spent[key] = (serial, until)
+
+    async def resume(self, ticket:str) -> Session:
+        """Recover a session from a resumption ticket.  
+        If the ticket was issued by this worker (in its current run) for a session
+        that is still open, and is the latest ticket of that session, the session
+        is returned (its key should be rotated). A ticket from another worker, or
+        from before a restart, starts a new session instead.  
+        Each ticket can be used once, and tickets of a closed session stop working.
+        Only this worker remembers a used ticket, so other workers with the same
+        `ticket_secret` will still accept it once, to start a new session.  
+        Raises `ValueError` if the ticket is invalid, expired or already used."""
+
+        data = self.__tickets.unsign(ticket)
+        if len(data) < TICKET.size:
+            raise ValueError("Malformed ticket")
+
+        id, expiry, serial, instance = TICKET.unpack_from(data)
+        owner = str(data[TICKET.size:], "utf8")
+        if expiry < time.time():
+            raise ValueError("Expired ticket")
+
+        key = (owner, instance, id)
+        if serial <= self.__spent.get(key, (0,))[0]:
+            raise ValueError("Revoked ticket")
+        self.__spend(key, serial, expiry)
+
+        ses = self.__ses.get(id)
+        if (owner == self.worker
+                and instance == self.__instance
+                and ses is not None
+                and ses.dead is False
+                and serial == ses.tickets):
+            return ses
+        return await self.start_session()
+
+    def verifier_stats(self) -> dict[str,int|float]:
+        "Get counters for key verification."
+
+        return self.__verifier.stats()
+
+    def subscribe(self, topic:str, ctx:"CommandDuplexContext"):
+        "Subscribe a command to a topic, until it unsubscribes or closes. See `PubSub`."
+
+        self.__topics.subscribe(topic, ctx)
+
+    def unsubscribe(self, topic:str, ctx:"CommandDuplexContext"):
+        self.__topics.unsubscribe(topic, ctx)
+
+    async def publish(self, topic:str, value:typing.Any, structured:bool=False) -> int:
+        """Send a value to every command subscribed to `topic`, in any session.  
+        Returns the number of commands it was queued for."""
+
+        return await self.__topics.publish(topic, value, structured)
+
+    def topic_stats(self) -> dict[str,int]:
+        "Get publish/subscribe counters."
+
+        return self.__topics.stats()
+
+    def __requeue(self, ses:Session):
+        # Entries for an earlier expiry supersede the session's older ones, which are dropped when they come up.
+        ses.queued = ses.expiry
+        heapq.heappush(self.__expiry, (ses.expiry, ses.id))
+
+    async def __forget(self, ses:Session):
+        self.__ses.pop(ses.id, None)
+        await self.__store.delete(ses.id)
+
+        if self.__signer is not None:
+            self.revoke(ses.id, ses.generation + 1, ses.token_expiry)
+        if ses.tickets > 0:
+            self.__spend((self.worker, self.__instance, ses.id), ses.tickets, time.time() + self.__ticket_ttl)
+
+        # Closed sessions leave stale heap entries behind, which are normally
+        # dropped when they reach the top. Rebuild if they start to dominate.
+        if len(self.__expiry) > 2 * len(self.__ses) + 64:
+            for i in self.__ses.values():
+                i.queued = i.expiry
+            self.__expiry = [(i.expiry, i.id) for i in self.__ses.values()]
+            heapq.heapify(self.__expiry)
+
+    async def reap(self) -> int:
+        """Close every session past its expiry, returning the number closed.  
+        Entries for sessions that were bumped since being queued are pushed back
+        with their new expiry, so only expired sessions are ever visited."""
+
+        now = time.perf_counter()
+        reaped = 0
+        self.__stats["runs"] += 1
+
+        while self.__expiry and self.__expiry[0][0] <= now:
+            queued, id = heapq.heappop(self.__expiry)
+            ses = self.__ses.get(id)
+
+            if ses is None or ses.dead is True or queued != ses.queued:
+                self.__stats["dropped"] += 1
+            elif ses.expiry > now:
+                self.__requeue(ses)
+                self.__stats["requeued"] += 1
+
+                # Keep the shared copy alive, so other workers' purges leave it be.
+                try:
+                    await self.__store.touch(id, time.time() + ses.expiry - now)
+                except Exception as e:
+                    self.__store_failed("touch", e)
+            else:
+                try:
+                    await ses.close()
+                except Exception:
+                    self.__stats["errors"] += 1
+                finally:
+                    self.__ses.pop(id, None)
+
+                reaped += 1
+
+        # Sessions left behind by workers that died are purged once in a while.
+        if now - self.__last_purge > self.__ttl:
+            self.__last_purge = now
+
+            try:
+                self.__stats["purged"] += await self.__store.purge(self.__ttl)
+            except Exception as e:
+                self.__store_failed("purge", e)
+
+            wall = time.time()
+            for i in [i for i, j in self.__revoked.items() if j[1] < wall]:
+                del self.__revoked[i]
+            for i in [i for i, j in self.__spent.items() if j[1] < wall]:
+                del self.__spent[i]
+
+            self.__topics.prune()
+
+        self.__stats["reaped"] += reaped
+        return reaped
+
+    def __store_failed(self, operation:str, error:Exception):
+        # A store error (such as a locked database) is logged, and retried on a later run.
+        self.__stats["errors"] += 1
+        asyncio.get_running_loop().call_exception_handler({
+            "message": f"Session store {operation} failed",
+            "exception": error
+        })
+
+    async def __reap_loop(self):
+        while True:
+            delay = self.__reap_interval
+            if self.__expiry:
+                delay = min(delay, max(0, self.__expiry[0][0] - time.perf_counter()))
+
+            await asyncio.sleep(delay)
+
+            # One failed run mustn't stop the reaper, or expired sessions would pile up again.
+            try:
+                await self.reap()
+            except Exception as e:
+                self.__store_failed("reap", e)
+
+    async def stop_reaper(self):
+        "Stop the background reaper. It will be restarted by the next `start_session()`."
+
+        if self.__reaper is not None:
+            self.__reaper.cancel()
+            self.__reaper = None
+
+    def reaper_stats(self) -> dict[str,int]:
+        "Get counters for the session reaper."
+
+        return {
+            **self.__stats,
+            "sessions": len(self.__ses),
+            "queued": len(self.__expiry),
+            "revoked": len(self.__revoked),
+            "spent": len(self.__spent)
+        }
+
+# flow control
+
+class MemoryBudget:
+    """Byte budget shared by the outgoing buffers of many sessions.  
+    `acquire()` waits while the budget is spent, and raises `Overloaded` if no room
+    frees up within `shed_timeout` seconds. Once usage passes `reject_ratio` of the
+    limit, `admit()` starts turning away new commands."""
+
+    def __init__(self, limit:int, shed_timeout:float=5, reject_ratio:float=.9):
+        self.limit = limit
+        self.used = 0
+        self.__shed_timeout = shed_timeout
+        self.__reject_at = limit * reject_ratio
+        self.__freed = asyncio.Condition()
+        self.__stats = {"waits": 0, "timeouts": 0, "rejected": 0, "peak": 0}
+
+    def __has_room(self, size:int) -> bool:
+        return self.used == 0 or self.used + size <= self.limit
+
+    async def acquire(self, size:int):
+        "Reserve `size` bytes, waiting for room if necessary."
+
+        if not self.__has_room(size):
+            self.__stats["waits"] += 1
+
+            try:
+                async with asyncio.timeout(self.__shed_timeout):
+                    async with self.__freed:
+                        await self.__freed.wait_for(lambda: self.__has_room(size))
+            except TimeoutError:
+                self.__stats["timeouts"] += 1
+                raise Overloaded("Memory budget exhausted") from None
+
+        self.force(size)
+
+    def force(self, size:int):
+        "Reserve `size` bytes without waiting."
+
+        self.used += size
+        self.__stats["peak"] = max(self.__stats["peak"], self.used)
+
+    async def release(self, size:int):
+        "Return `size` bytes to the budget."
+
+        self.used -= size
+
+        async with self.__freed:
+            self.__freed.notify_all()
+
+    def admit(self) -> bool:
+        "Check whether a new command may start, counting it if it is rejected."
+
+        if self.used >= self.__reject_at:
+            self.__stats["rejected"] += 1
+            return False
+        return True
+
+    def stats(self) -> dict[str,int]:
+        "Get counters for the budget."
+
+        return {**self.__stats, "used": self.used, "limit": self.limit}
+
+# routing
+
+class FrameRouter:
+    """Routes incoming messages straight into the queue of the command they belong to.  
+    Messages for a command that hasn't attached yet (such as frames sent in the same
+    batch as its initiation) are held until it does, up to `max_early` in total.  
+    Messages for a recently detached command are dropped.  
+    If a command's queue stays full for `shed_timeout` seconds, `dispatch()` gives
+    up and returns its ID, so the transport can close it. The root queue is never
+    shed, since every new command is started through it."""
+
+    __queues: dict[bytes,asyncio.Queue]
+    __early: dict[bytes,list[bytes]]
+    __closed: dict[bytes,None]
+
+    def __init__(self, max_queued:int=256, max_early:int=256, shed_timeout:float=30):
+        self.__queues = {}
+        self.__early = {}
+        self.__early_count = 0
+        self.__closed = {}
+        self.__max_queued = max_queued
+        self.__max_early = max_early
+        self.__shed_timeout = shed_timeout
+        self.__stats = {"routed": 0, "early": 0, "dropped": 0, "waits": 0, "stalled": 0}
+
+    def attach(self, cmd:bytes) -> asyncio.Queue:
+        "Get the queue for a command, creating it (and delivering any held messages) if needed."
+
+        queue = self.__queues.get(cmd)
+        if queue is not None:
+            return queue
+
+        queue = self.__queues[cmd] = asyncio.Queue(self.__max_queued)
+        self.__closed.pop(cmd, None)
+
+        for i in self.__early.pop(cmd, ()):
+            self.__early_count -= 1
+            if not queue.full():
+                queue.put_nowait(i)
+            else:
+                self.__stats["dropped"] += 1
+
+        return queue
+
+    def detach(self, cmd:bytes):
+        "Remove a command's queue, waking anything waiting on it."
+
+        queue = self.__queues.pop(cmd, None)
+        if queue is not None:
+            queue.shutdown(True)
+
+        self.__early_count -= len(self.__early.pop(cmd, ()))
+        self.__closed[cmd] = None
+        if len(self.__closed) > self.__max_early:
+            del self.__closed[next(iter(self.__closed))]
+
+    async def dispatch(self, data:bytes|memoryview) -> bytes|None:
+        """Route one message (command ID and payload) to its command.  
+        Returns the command ID if the command stalled and should be shed."""
+
+        cmd = bytes(data[:4])
+        queue = self.__queues.get(cmd)
+        self.__stats["routed"] += 1
+
+        if queue is None:
+            if cmd in self.__closed or self.__early_count >= self.__max_early:
+                self.__stats["dropped"] += 1
+            else:
+                self.__stats["early"] += 1
+                self.__early_count += 1
+                self.__early.setdefault(cmd, []).append(bytes(data[4:]))
+            return None
+
+        if not queue.full():
+            queue.put_nowait(bytes(data[4:]))
+            return None
+
+        self.__stats["waits"] += 1
+
+        # Initiations wait as long as it takes, which holds up the transport instead.
+        timeout = None if cmd == COMMAND_ROOT else self.__shed_timeout
+
+        try:
+            await asyncio.wait_for(queue.put(bytes(data[4:])), timeout)
+        except asyncio.QueueShutDown:
+            pass
+        except TimeoutError:
+            self.__stats["stalled"] += 1
+            self.detach(cmd)
+            return cmd
+
+    def shutdown(self):
+        "Detach every command."
+
+        for i in list(self.__queues):
+            self.detach(i)
+        self.__early.clear()
+        self.__closed.clear()
+        self.__early_count = 0
+
+    def stats(self) -> dict[str,int]:
+        "Get routing counters."
+
+        return {
+            **self.__stats,
+            "commands": len(self.__queues),
+            "frames": sum(i.qsize() for i in self.__queues.values()),
+            "held": self.__early_count
+        }
 
 # base duplex handler
 
 class BaseDuplexHandler:
+    """Frames over `fragment_size` bytes are split into fragments. Reassembled frames are limited to `max_message` bytes.  
+    Each command buffers at most `max_queued` incoming frames (0 for no limit).  
+    Handlers may route incoming frames through a `FrameRouter` (see `route_incoming()`),
+    and bound the messages waiting to be written (see `buffer_outgoing()`)."""
+
+    fragment_size: int|None = None
+    max_message: int = 16777216
+    max_queued: int = 0
+    router: FrameRouter|None = None
+    buffered: int = 0
+
     def __init__(self):
         raise RuntimeError("Do not use BaseDuplexHandler")
+
+    def route_incoming(self, max_queued:int=256, max_early:int=256, shed_timeout:float=30):
+        """Route incoming frames through a `FrameRouter`, which `dispatch()`, `attach()`,
+        `recv()` and `clean()` then use. Called by handlers from `__init__`."""
+
+        self.max_queued = max_queued
+        self.router = FrameRouter(max_queued, max_early, shed_timeout)
+
+    async def dispatch(self, data:memoryview):
+        "Route one incoming message to its command."
+
+        cmd = await self.router.dispatch(data)
+        if cmd is not None:
+            # The command stopped reading, so it is shed rather than stalling the session.
+            await self.send(cmd + await pack_eof(StatusCode.TIME_OUT, "pbj:receiver_stalled"))
+
+    def buffer_outgoing(self, max_buffer:int=4194304, shed_timeout:float=30):
+        """Hold at most `max_buffer` bytes of outgoing messages waiting to be written, for
+        handlers that write them from a single task. Called by handlers from `__init__`."""
+
+        self.buffered = 0
+        self.__max_buffer = max_buffer
+        self.__shed_timeout = shed_timeout
+        self.__room = asyncio.Condition()
+        self.__buffer_closed = False
+        self.__buffer_stats = {"send_waits": 0, "send_timeouts": 0}
+
+    def has_room(self) -> bool:
+        "Check whether the outgoing buffer has room, or is closed."
+        return self.__buffer_closed is True or self.buffered < self.__max_buffer
+
+    async def reserve(self, size:int, force:bool=False):
+        """Count `size` bytes into the outgoing buffer, waiting while it is full unless `force` is set.  
+        Raises `Overloaded` if no room frees up within `shed_timeout` seconds,
+        and `asyncio.QueueShutDown` once the buffer is closed."""
+
+        if force is False and not self.has_room():
+            self.__buffer_stats["send_waits"] += 1
+
+            try:
+                async with asyncio.timeout(self.__shed_timeout):
+                    async with self.__room:
+                        await self.__room.wait_for(self.has_room)
+            except TimeoutError:
+                self.__buffer_stats["send_timeouts"] += 1
+                raise Overloaded("Outgoing buffer is full") from None
+
+        if self.__buffer_closed is True:
+            raise asyncio.QueueShutDown
+        self.buffered += size
+
+    async def release(self, size:int):
+        "Take `size` written bytes out of the outgoing buffer, waking senders waiting for room."
+
+        self.buffered -= size
+        async with self.__room:
+            self.__room.notify_all()
+
+    async def close_buffer(self):
+        "Refuse any more outgoing messages, waking senders waiting for room."
+
+        self.__buffer_closed = True
+        async with self.__room:
+            self.__room.notify_all()
+
+    def buffer_stats(self) -> dict[str,int]:
+        "Get counters for the outgoing buffer."
+        return {**self.__buffer_stats, "queued": self.buffered}
     
     async def send(self, data:bytes):
         "Send binary data to the client."
         pass
 
+    async def send_frame(self, cmd:bytes, frame:bytes):
+        "Send a frame for a command, split into fragments if it is over `fragment_size` bytes."
+
+        limit = self.fragment_size
+        if limit is None or len(frame) <= limit:
+            await self.send(cmd + frame)
+            return
+
+        view = memoryview(frame)
+        for i in range(0, len(view), limit):
+            marker = FRAME_FRAGMENT if i + limit < len(view) else FRAME_FRAGMENT_END
+            await self.send(b"".join((cmd, marker, view[i:i + limit])))
+
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        """Send a frame that is also sent to other commands, such as a published frame.  
+        Handlers that queue messages may keep `frame` as it is rather than copying it.
+        Frames must already be split to fit in `fragment_size`."""
+
+        await self.send(cmd + frame)
+
+    async def send_segment(self, segment:FrameSegment):
+        """Send several messages packed into a `FrameSegment`.  
+        Handlers that queue messages keep the segment whole, so its messages go out
+        together, unless it is larger than their batch or buffer limits, in which case
+        it is split to fit them; by default, they are sent one at a time."""
+
+        for i in segment.messages():
+            await self.send(bytes(i))
+
     async def recv(self, cmd:bytes) -> bytes:
         "Receive binary data from the client."
-        pass
+        return await self.attach(cmd).get()
 
     async def clean(self, cmd:bytes):
         "Clean any data used to handle messages for a specific command."
-        pass
+
+        if self.router is not None:
+            self.router.detach(cmd)
+
+    def attach(self, cmd:bytes) -> asyncio.Queue:
+        "Get the queue that incoming frames for a command are routed into."
+        return self.router.attach(cmd)
+
+    def admit(self) -> bool:
+        "Check whether a new command may be started."
+        return True
 
 # status codes
 
@@ -198,6 +1446,16 @@ class StatusCode:
     CONFLICT = b"\xb2"
     TIME_OUT = b"\xc0"
 
+# priorities
+
+class Priority:
+    def __init__(self):
+        pass
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
 # commands
 
 class CommandDuplexContext:
@@ -212,96 +1470,411 @@ class CommandDuplexContext:
     This automatically sends an OK response afterwards.  
     Alternatively, `context.close()` can be called with a custom status and reason."""
 
-    def __init__(self, wraps:BaseDuplexHandler, cmd_id:bytes):
+    def __init__(self, wraps:BaseDuplexHandler, cmd_id:bytes, first:bytes|None=None):
         self.__wraps = wraps
         self.__cmd = cmd_id
-        self.__final_queue = asyncio.Queue()
-        self.__producer = asyncio.create_task(self.__consumer())
+        self.__first = first
+        self.__inbox = wraps.attach(cmd_id)
         self.__lock = False
+        self.__fragments = []
+        self.__fragment_size = 0
         self.close_status = -1
         self.close_reason = ""
 
-
-    async def __consumer(self):
+    @property
+    def closed(self) -> bool:
+        return self.__lock
+
+    async def __reassemble(self, data:bytes) -> bytes|None:
+        self.__fragment_size += len(data) - 1
+        if self.__fragment_size > self.__wraps.max_message:
+            self.__fragments.clear()
+            await self.close(StatusCode.BAD_MESSAGE, "pbj:message_too_large")
+            raise ValueError("Fragmented frame is too large")
+
+        self.__fragments.append(data[1:])
+        if data.startswith(FRAME_FRAGMENT):
+            return None
+
+        res = b"".join(self.__fragments)
+        self.__fragments.clear()
+        self.__fragment_size = 0
+        return res
+
+    async def __next_message(self) -> bytes:
+        if self.__first is not None:
+            data, self.__first = self.__first, None
+            return data
+
+        try:
+            data = await self.__inbox.get()
+        except asyncio.QueueShutDown:
+            # The transport went away underneath us (session closed or command shed).
+            self.__lock = True
+            raise
+
+        if data.startswith(FRAME_EOF):
+            # If a client has sent an EOF frame, something has gone seriously wrong.
+            # Nevertheless, we shall handle it and pretend it never happened.
+
+            status, msg = await unpack_eof(data[1:])
+            self.close_status = status[0]
+            self.close_reason = msg
+            self.__lock = True
+            await self.__wraps.clean(self.__cmd)
+            raise asyncio.QueueShutDown
+        return data
+
+    async def __next_frame(self) -> bytes:
         while True:
-            data = await self.__wraps.recv(self.__cmd)
-
-            if data.startswith(FRAME_EOF):
-                # If a client has sent an EOF frame, something has gone seriously wrong.
-                # Nevertheless, we shall handle it and pretend it never happened.
-
-                status, msg = await unpack_eof(data)
-                self.close_status = status[0]
-                self.close_reason = msg
-                self.__lock = True
-                self.__wraps.clean(self.__cmd)
-                self.__final_queue.shutdown(True)
-                break
+            data = await self.__next_message()
+
+            if data.startswith(FRAME_FRAGMENT) or data.startswith(FRAME_FRAGMENT_END):
+                data = await self.__reassemble(data)
+                if data is not None:
+                    return data
             else:
-                self.__final_queue.put_nowait(data)
+                return data
+
+    async def send(self, data:str|bytes|dict|list|int|float|None, structured:bool=False):
+        """Send a value to the client.  
+        If `structured` is set, values other than strings and bytes are sent as structured frames."""
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        await self.send_frame(await pack_frame(data, structured))
+
+    async def send_frame(self, frame:bytes):
+        """Send an already-packed frame.  
+        Large frames are split into fragments, each of which waits for credit
+        from the transport, so only a window's worth is ever queued at once."""
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        if metrics.tracer is not None:
+            metrics.tracer("command.send", self.__cmd + frame)
+
+        try:
+            await self.__wraps.send_frame(self.__cmd, frame)
+        except Overloaded:
+            # Shed the command rather than letting it wait forever.
+            await self.close(StatusCode.TIME_OUT, "pbj:overloaded")
+            raise
+
+    async def send_shared(self, frame:"SharedFrame"):
+        """Send a frame packed once for many commands (see `PubSub`).  
+        The frame and its fragments are queued as they are, rather than copied for this command."""
 
-    
-    async def send(self, data:str|bytes|dict|list|int|float):
         if self.__lock is True:
             raise RuntimeError("Attempt to operate on closed command context")
 
-        print("sending", data)
-        await self.__wraps.send(self.__cmd + await pack_frame(data))
+        if metrics.tracer is not None:
+            metrics.tracer("command.send", self.__cmd + frame.frame)
+
+        try:
+            for i in frame.pieces(self.__wraps.fragment_size):
+                await self.__wraps.send_shared(self.__cmd, i)
+        except Overloaded:
+            await self.close(StatusCode.TIME_OUT, "pbj:overloaded")
+            raise
+
+    def writer(self, structured:bool=False) -> "FrameWriter":
+        """Get a buffered writer for this command (see `FrameWriter`).  
+        Frames written to it are packed into one buffer, and sent together on `flush()`."""
+
+        return FrameWriter(self, self.__cmd, self.__wraps.fragment_size, structured)
+
+    async def send_many(self, values:typing.Iterable[typing.Any], structured:bool=False):
+        """Send several values, packed into one buffer and queued at once.  
+        Cheaper than calling `send()` for each of many small values, such as the updates of one tick."""
+
+        writer = self.writer(structured)
+        for i in values:
+            writer.write(i)
+        await writer.flush()
+
+    async def send_segment(self, segment:FrameSegment):
+        "Send a `FrameSegment` of messages for this command, as packed by a `FrameWriter`."
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        if metrics.tracer is not None:
+            for i in segment.messages():
+                metrics.tracer("command.send", bytes(i))
+
+        try:
+            await self.__wraps.send_segment(segment)
+        except Overloaded:
+            await self.close(StatusCode.TIME_OUT, "pbj:overloaded")
+            raise
+
+    async def __send_piece(self, data:bytes):
+        if metrics.tracer is not None:
+            metrics.tracer("command.send", data)
+
+        try:
+            await self.__wraps.send(data)
+        except Overloaded:
+            await self.close(StatusCode.TIME_OUT, "pbj:overloaded")
+            raise
+
+    async def send_stream(self,
+            chunks:typing.AsyncIterable[bytes]|typing.Iterable[bytes],
+            frame:bytes=FRAME_BINARY):
+        """Send one frame of type `frame`, with its payload read from `chunks`, an
+        iterable or async iterable of bytes-like objects.  
+        The payload is sent in fragments as it is read. Each one waits for credit from
+        the transport, so only about a window's worth is ever held, however large the frame."""
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        limit = self.__wraps.fragment_size or STREAM_CHUNK
+        buffer = bytearray(frame)
+        fragmented = False
+
+        async for chunk in iterate_chunks(chunks):
+            view = memoryview(chunk)
+
+            # Only full pieces with more data after them go out, so the last one can be marked as such.
+            while len(buffer) + len(view) > limit:
+                take = limit - len(buffer)
+                buffer += view[:take]
+                view = view[take:]
+
+                await self.__send_piece(b"".join((self.__cmd, FRAME_FRAGMENT, buffer)))
+                buffer.clear()
+                fragmented = True
+
+            buffer += view
+
+        if fragmented is True:
+            await self.__send_piece(b"".join((self.__cmd, FRAME_FRAGMENT_END, buffer)))
+        else:
+            await self.send_frame(bytes(buffer))
+
+    async def send_file(self, path:str|os.PathLike, frame:bytes=FRAME_BINARY, offset:int=0, length:int|None=None):
+        """Send a file, or `length` bytes of it from `offset`, as one frame of type `frame`.  
+        The file is memory-mapped and sent as with `send_stream()`, so only the pages being
+        sent are ever read in."""
+
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            end = size if length is None else min(size, offset + length)
+
+            if end <= offset:
+                # Empty files can't be mapped.
+                await self.send_stream((), frame)
+                return
+
+            limit = self.__wraps.fragment_size or STREAM_CHUNK
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+
+                def pieces() -> typing.Iterator[bytes]:
+                    # Slices are copied out, so no view holds the mapping open once it is closed.
+                    for i in range(offset, end, limit):
+                        yield data[i:min(i + limit, end)]
+
+                        # Pages already sent are dropped, so they don't stay resident.
+                        if hasattr(mmap, "MADV_DONTNEED"):
+                            start = i - i % mmap.PAGESIZE
+                            data.madvise(mmap.MADV_DONTNEED, start, min(i + limit, end) - start)
+
+                await self.send_stream(pieces(), frame)
 
     async def recv(self) -> str|bytes|dict|list|int|float|None:
         if self.__lock is True:
             raise RuntimeError("Attempt to operate on closed command context")
 
-        data = await self.__final_queue.get()
-        frame = data[:1]
-        data = data[1:]
+        return unpack_frame(await self.__next_frame())
 
-        match frame:
-            case b"\x00":
-                return None
-            case b"\x40":
-                return data
-            case b"\x41":
-                return str(data, "utf8")
-            case b"\x50":
-                return json.loads(data)
-            
-        raise ValueError(f"Invalid frame type: {frame[0]}")
+    async def recv_stream(self) -> typing.AsyncIterator[bytes]:
+        """Receive the payload of the next frame in pieces, as its fragments arrive.  
+        Unlike `recv()`, the frame is never reassembled, so it isn't limited to `max_message`
+        bytes. The frame type marker is dropped. The stream must be read to the end before
+        the next frame is received."""
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        data = await self.__next_message()
+        if not (data.startswith(FRAME_FRAGMENT) or data.startswith(FRAME_FRAGMENT_END)):
+            yield data[1:]
+            return
+
+        marker = 1
+        while True:
+            # The frame type marker is the first byte of the first non-empty piece.
+            piece = data[1 + marker:] if len(data) > 1 else b""
+            if len(data) > 1:
+                marker = 0
+            if piece:
+                yield piece
+
+            if data.startswith(FRAME_FRAGMENT_END):
+                return
+
+            data = await self.__next_message()
+            if not (data.startswith(FRAME_FRAGMENT) or data.startswith(FRAME_FRAGMENT_END)):
+                raise ValueError("Fragmented frame was interrupted")
+
+    async def recv_frame(self) -> bytes:
+        "Receive the next frame (reassembled, if fragmented) without decoding it."
+
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        return await self.__next_frame()
     
     async def close(self, status:bytes=b"\x00", reason:str="pbj:ok"):
         if self.__lock is True:
             raise RuntimeError("Attempt to operate on closed command context")
 
+        self.__lock = True
         await self.__wraps.send(self.__cmd + await pack_eof(status, reason))
         await self.__wraps.clean(self.__cmd)
-        self.__final_queue.shutdown(True)
-        self.__producer.cancel()
 
     async def __aenter__(self):
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is asyncio.CancelledError:
+            self.__lock = True
+            return False
+        if exc_type is asyncio.QueueShutDown and self.__lock is True:
+            # The client closed the command, or the session went away.
+            return True
+        if exc_type is CommandFailed and self.__lock is False:
+            await self.close(exc_val.status, exc_val.reason)
+            return True
+
         if exc_type is not None:
             raise InternalCommandError(
                 f"Error while handling command ID {int.from_bytes(self.__cmd, 'little', signed=False)}"
             ) from exc_val
 
-        await self.close()
+        if self.__lock is False:
+            await self.close()
+        return False
+
+class FrameWriter:
+    """Buffered writer for one command's outgoing frames.  
+    `write()` packs a value straight into a buffer, without waiting, and `flush()`
+    queues everything written since as a single `FrameSegment`. Frames over the
+    handler's `fragment_size` are split into fragments in the buffer.  
+    Can be used as an async context manager, which flushes on exit:
+    ```
+    async with context.writer() as w:
+        for i in updates:
+            w.write(i)
+    ```"""
+
+    def __init__(self, ctx:CommandDuplexContext, cmd_id:bytes, fragment_size:int|None, structured:bool=False):
+        self.__ctx = ctx
+        self.__cmd = cmd_id
+        self.__limit = fragment_size
+        self.__structured = structured
+        self.__buffer = bytearray()
+        self.__count = 0
+
+    def __len__(self) -> int:
+        return self.__count
+
+    @property
+    def buffered(self) -> int:
+        "Bytes written since the last flush."
+        return len(self.__buffer)
+
+    def __append(self, frame:bytes):
+        buf = self.__buffer
+        buf += U32.pack(len(self.__cmd) + len(frame))
+        buf += self.__cmd
+        buf += frame
+        self.__count += 1
+
+    def write(self, value:typing.Any):
+        "Pack a value into the buffer, as `CommandDuplexContext.send()` would."
+
+        self.write_frame(encode_frame(value, self.__structured))
+
+    def write_frame(self, frame:bytes):
+        "Add an already-packed frame to the buffer."
+
+        if self.__limit is None or len(frame) <= self.__limit:
+            self.__append(frame)
+            return
+
+        for i in split_frame(frame, self.__limit):
+            self.__append(i)
+
+    async def flush(self):
+        "Send everything written since the last flush, if anything."
+
+        if self.__count == 0:
+            return
+
+        # The buffer is handed over as it is, and a new one started.
+        segment = FrameSegment(self.__cmd, self.__buffer, self.__count)
+        self.__buffer = bytearray()
+        self.__count = 0
+        await self.__ctx.send_segment(segment)
+
+    async def __aenter__(self) -> typing.Self:
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.flush()
         return False
 
 class CommandHandler:
     def __init__(self):
         self.__commands = {}
-
-    def command(self, id:str|bytes):
+        self.__unary = {}
+        self.__priority = {}
+        self.__caches = {}
+
+    def command(self,
+            id:str|bytes,
+            unary:bool=False,
+            structured:bool=False,
+            priority:int=Priority.NORMAL,
+            pool:"HandlerPool|None"=None,
+            cache:"ResultCache|None"=None):
         """Define a command handler.  
-        The callback must accept a single `CommandDuplexContext` argument."""
+        The callback must accept a single `CommandDuplexContext` argument.  
+        If `unary` is set, the callback instead accepts the argument sent with the
+        initiation, and returns the reply, which is sent with the final status in a
+        single result frame. It may raise `CommandFailed` to fail with a specific status.
+        The reply is sent as a structured frame if `structured` is set.  
+        When a `CommandScheduler` has to queue commands, those with a higher `priority`
+        (see `Priority`) start first.  
+        With a `pool`, the callback is a plain function run in a `HandlerPool` instead
+        of on the event loop, and is given a `PoolContext` rather than a `CommandDuplexContext`.  
+        With a `cache`, the replies of a unary command are kept in a `ResultCache` and
+        reused for requests with the same argument."""
 
         if isinstance(id, str):
             id = bytes(id, "utf8")
+        if cache is not None and unary is not True:
+            raise ValueError("Only unary commands can be cached")
 
         def wrapper(callback:typing.Callable[[CommandDuplexContext],typing.Awaitable[None]]):
-            self.__commands[id] = callback
+            self.__commands[id] = callback if pool is None else pool.wrap(callback, unary)
+            self.__priority[id] = priority
+            if cache is not None:
+                self.__caches[id] = cache
+            else:
+                self.__caches.pop(id, None)
+            if unary is True:
+                self.__unary[id] = structured
+            else:
+                self.__unary.pop(id, None)
             return callback
         return wrapper
     
@@ -311,11 +1884,159 @@ class CommandHandler:
     def get(self, cmd:bytes):
         return self.__commands[cmd]
 
+    def is_unary(self, cmd:bytes) -> bool:
+        return cmd in self.__unary
+
+    def is_structured(self, cmd:bytes) -> bool:
+        return self.__unary.get(cmd, False)
+
+    def priority(self, cmd:bytes) -> int:
+        return self.__priority.get(cmd, Priority.NORMAL)
+
+    def cache(self, cmd:bytes) -> "ResultCache|None":
+        return self.__caches.get(cmd)
+
+class SchedulerLane:
+    "Queued and running commands of one `CommandManager`, as tracked by a `CommandScheduler`."
+
+    __slots__ = ("running", "queued", "queues")
+
+    def __init__(self):
+        self.running = 0
+        self.queued = 0
+        self.queues = [collections.deque() for _ in range(Priority.LOW + 1)]
+
+class CommandScheduler:
+    """Limits how many command handlers run at once, and shares them fairly between sessions.  
+    At most `max_running` handlers run in total, and, if set, at most `max_per_session`
+    for any one `CommandManager`. Commands over either limit wait in their session's queue,
+    which holds at most `max_queued`; past that, `submit()` refuses them.  
+    Long-lived commands, such as subscriptions, hold their slot until they end, so
+    `max_per_session` must be above the number a session keeps open, or the next
+    command waits until one of them finishes.
+
+    When a slot frees up, the highest priority waiting command starts. Sessions with
+    commands of that priority waiting take turns, so one busy session can't starve the rest."""
+
+    __lanes: dict[typing.Any,SchedulerLane]
+
+    def __init__(self, max_running:int=4096, max_per_session:int|None=None, max_queued:int=256):
+        self.__max_running = max_running
+        self.__max_per_session = max_per_session
+        self.__max_queued = max_queued
+        self.__running = 0
+        self.__lanes = {}
+        self.__order = collections.deque()
+        self.__stats = {"started": 0, "held": 0, "rejected": 0, "queue_time": 0.0, "max_queue_time": 0.0}
+
+    def submit(self, owner:typing.Any, priority:int, start:typing.Callable[[],asyncio.Task]) -> bool:
+        """Start a command now (by calling `start`), or queue it to start later.  
+        Returns `False` if `owner`'s queue is full, in which case the command should be rejected."""
+
+        priority = min(max(priority, Priority.HIGH), Priority.LOW)
+        lane = self.__lanes.get(owner)
+        if lane is None:
+            lane = self.__lanes[owner] = SchedulerLane()
+
+        if lane.queued == 0 and self.__running < self.__max_running and self.__has_slot(lane):
+            self.__start(lane, start, priority, None)
+            return True
+
+        if lane.queued >= self.__max_queued:
+            self.__stats["rejected"] += 1
+            return False
+
+        if lane.queued == 0:
+            self.__order.append(lane)
+
+        lane.queues[priority].append((start, time.perf_counter()))
+        lane.queued += 1
+        self.__stats["held"] += 1
+        return True
+
+    def __has_slot(self, lane:SchedulerLane) -> bool:
+        return self.__max_per_session is None or lane.running < self.__max_per_session
+
+    def drop(self, owner:typing.Any):
+        "Forget every queued command of `owner`. Running commands still release their slots."
+
+        lane = self.__lanes.pop(owner, None)
+        if lane is not None and lane.queued > 0:
+            self.__order.remove(lane)
+            lane.queued = 0
+            for i in lane.queues:
+                i.clear()
+
+    def __start(self, lane:SchedulerLane, start:typing.Callable[[],asyncio.Task], priority:int, queued:float|None):
+        if queued is not None:
+            wait = time.perf_counter() - queued
+            self.__stats["queue_time"] += wait
+            self.__stats["max_queue_time"] = max(self.__stats["max_queue_time"], wait)
+            if metrics.enabled:
+                metrics.scheduler_queue_seconds.observe(wait, str(priority))
+
+        self.__running += 1
+        lane.running += 1
+        self.__stats["started"] += 1
+
+        task = start()
+        task.add_done_callback(lambda _: self.__finish(lane))
+
+    def __finish(self, lane:SchedulerLane):
+        self.__running -= 1
+        lane.running -= 1
+        self.__pump()
+
+    def __pump(self):
+        while self.__order and self.__running < self.__max_running:
+            picked = None
+
+            for priority in range(Priority.LOW + 1):
+                for _ in range(len(self.__order)):
+                    lane = self.__order[0]
+                    self.__order.rotate(-1)
+
+                    if lane.queues[priority] and self.__has_slot(lane):
+                        picked = lane
+                        break
+
+                if picked is not None:
+                    break
+
+            if picked is None:
+                return
+
+            start, queued = picked.queues[priority].popleft()
+            picked.queued -= 1
+            if picked.queued == 0:
+                self.__order.remove(picked)
+
+            self.__start(picked, start, priority, queued)
+
+    def stats(self) -> dict[str,int|float]:
+        "Get scheduler counters. Queue times are in seconds."
+
+        return {
+            **self.__stats,
+            "running": self.__running,
+            "queued": sum(i.queued for i in self.__lanes.values()),
+            "sessions": len(self.__lanes)
+        }
 
 class CommandManager:
-    def __init__(self, around:BaseDuplexHandler, commands:CommandHandler):
+    """Starts command handlers for initiations received through a duplex handler.  
+    Handlers are started through a `CommandScheduler`, which may be shared between
+    managers to limit them together. Initiations the scheduler can't queue are
+    rejected with `StatusCode.CONFLICT` and reason `pbj:too_many_commands`."""
+
+    def __init__(self, around:BaseDuplexHandler, commands:CommandHandler, scheduler:CommandScheduler|None=None):
+        if scheduler is None:
+            scheduler = CommandScheduler()
+
         self.__wraps = around
         self.__commands = commands
+        self.__scheduler = scheduler
+        self.__tasks = set()
 
     async def run(self):
         "Start listening for commands."
@@ -324,10 +2045,792 @@ class CommandManager:
             initiator = io.BytesIO(await self.__wraps.recv(COMMAND_ROOT))
             cmd_id = initiator.read(4)
             handler = initiator.read(int.from_bytes(initiator.read(1), "little", signed=False))
+            # An initiation may carry the command's first frame (the argument, for unary commands).
+            first = initiator.read() or None
+
+            if not self.__wraps.admit():
+                await self.__reject(cmd_id, StatusCode.CONFLICT, "pbj:overloaded", "overloaded")
+                continue
+            elif not self.__commands.has(handler):
+                await self.__reject(cmd_id, STATUS_NOTFOUND, "pbj:command_not_exist", "not_found")
+                continue
+
+            if self.__commands.is_unary(handler):
+                coro = functools.partial(self.__run_unary, cmd_id, handler, first)
+            else:
+                # The context is made straight away, so frames sent while it waits to start are kept.
+                stream = CommandDuplexContext(self.__wraps, cmd_id, first)
+                coro = functools.partial(self.__commands.get(handler), stream)
+
+            if not self.__scheduler.submit(self, self.__commands.priority(handler), self.__starter(handler, coro)):
+                await self.__reject(cmd_id, StatusCode.CONFLICT, "pbj:too_many_commands", "queue_full")
+
+    def __starter(self, handler:bytes, coro:typing.Callable[[],typing.Coroutine]) -> typing.Callable[[],asyncio.Task]:
+        def start() -> asyncio.Task:
+            task = asyncio.create_task(coro())
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+            if metrics.enabled:
+                name = str(handler, "utf8", "replace")
+                metrics.commands_started.inc(name)
+                task.add_done_callback(CommandManager.__measure(name, time.perf_counter()))
+            return task
+        return start
+
+    async def __reject(self, cmd_id:bytes, status:bytes, reason:str, metric:str):
+        await self.__wraps.send(cmd_id + await pack_eof(status, reason))
+        await self.__wraps.clean(cmd_id)
+
+        if metrics.enabled:
+            metrics.commands_rejected.inc(metric)
+
+    async def __run_unary(self, cmd_id:bytes, handler:bytes, first:bytes|None):
+        # No context or incoming queue is made; the reply and status go out in one frame.
+        cache = self.__commands.cache(handler)
+        error = None
+
+        async def compute() -> tuple[bytes,bool]:
+            nonlocal error
+            result, status, error = await self.__unary_result(handler, first)
+            return result, status == StatusCode.OK
+
+        if cache is None:
+            result, _ = await compute()
+            await self.__wraps.send_frame(cmd_id, result)
+        else:
+            # Cached results are queued as they are, like published frames.
+            shared = await cache.get(handler, first, compute)
+            for i in shared.pieces(self.__wraps.fragment_size):
+                await self.__wraps.send_shared(cmd_id, i)
+
+        if error is not None:
+            raise InternalCommandError(
+                f"Error while handling command ID {int.from_bytes(cmd_id, 'little', signed=False)}"
+            ) from error
+
+    async def __unary_result(self, handler:bytes, first:bytes|None) -> tuple[bytes,bytes,Exception|None]:
+        error = None
+
+        try:
+            arg = None if first is None else unpack_frame(first)
+        except ValueError:
+            status, reason, reply = StatusCode.BAD_MESSAGE, "pbj:bad_argument", FRAME_NULL
+        else:
+            try:
+                value = await self.__commands.get(handler)(arg)
+                reply = await pack_frame(value, self.__commands.is_structured(handler))
+                status, reason = StatusCode.OK, "pbj:ok"
+            except CommandFailed as e:
+                status, reason, reply = e.status, e.reason, FRAME_NULL
+            except Exception as e:
+                status, reason, reply = StatusCode.FAILURE, "pbj:internal_error", FRAME_NULL
+                error = e
+
+        return await pack_result(status, reason, reply), status, error
+
+    @staticmethod
+    def __measure(name:str, start:float) -> typing.Callable[[asyncio.Task],None]:
+        def done(task:asyncio.Task):
+            if task.cancelled():
+                result = "cancelled"
+            elif task.exception() is not None:
+                result = "error"
+
+                # Reading the exception stops asyncio from reporting it, so it is reported here.
+                task.get_loop().call_exception_handler({
+                    "message": f"Command handler '{name}' failed",
+                    "exception": task.exception(),
+                    "task": task
+                })
+            else:
+                result = "ok"
+
+            metrics.commands_finished.inc(name, result)
+            metrics.command_seconds.observe(time.perf_counter() - start, name)
+        return done
+
+    async def shutdown(self):
+        "Drop queued commands and cancel every running command handler."
+
+        self.__scheduler.drop(self)
+
+        for i in list(self.__tasks):
+            i.cancel()
+        self.__tasks.clear()
+
+# transport sessions
+
+class TransportSessionHandler(SessionHandler):
+    """Base for session managers that run every session's commands over a duplex handler.  
+    Subclasses create a handler for a session and pass it to `open_handler()`, which
+    starts a `CommandManager` on it. Closing the session shuts both down. One `scheduler`
+    is shared by every session, so its limits apply to the whole worker."""
+
+    __handlers: dict[int,BaseDuplexHandler]
+    __cmd_managers: dict[int,CommandManager]
+    __tasks: dict[int,asyncio.Task]
+
+    def __init__(self,
+            cmd_hndl:CommandHandler,
+            key,
+            hasher=None,
+            session_ttl:float=60,
+            scheduler:CommandScheduler|None=None,
+            transport:str|None=None,
+            **kwargs):
+        super().__init__(key, hasher, session_ttl, **kwargs)
+        self.__cmd_hndl = cmd_hndl
+        self.__ttl = session_ttl
+        self.__transport = transport
+        self.scheduler = scheduler or CommandScheduler()
+        self.__handlers = {}
+        self.__cmd_managers = {}
+        self.__tasks = {}
+        metrics.registry.collector(self.collect_metrics)
+
+    def get_handler(self, id:int) -> BaseDuplexHandler|None:
+        "Get the handler of an open session, if it has one."
+        return self.__handlers.get(id)
+
+    def open_handler(self, ses:Session, handler:BaseDuplexHandler):
+        "Start running the session's commands over `handler`."
+
+        manager = CommandManager(handler, self.__cmd_hndl, self.scheduler)
+        self.__handlers[ses.id] = handler
+        self.__cmd_managers[ses.id] = manager
+        self.__tasks[ses.id] = asyncio.create_task(manager.run())
+
+    async def start_session(self) -> Session:
+        ses = await super().start_session()
+        ses.on_close(self.clean_session)
+        return ses
+
+    async def clean_session(self, ses:Session):
+        "Shut down the session's commands and handler."
+
+        handler = self.__handlers.pop(ses.id, None)
+        manager = self.__cmd_managers.pop(ses.id, None)
+        task = self.__tasks.pop(ses.id, None)
+
+        if task is not None:
+            task.cancel()
+        if manager is not None:
+            await manager.shutdown()
+        if handler is not None:
+            await handler.shutdown()
+
+    async def keepalive(self, ses:Session):
+        "Keep a session alive for as long as this runs, for transports that authenticate once per connection."
+
+        while True:
+            ses.bump(self.__ttl)
+            await asyncio.sleep(self.__ttl / 3)
+
+    def collect_metrics(self) -> typing.Iterator[metrics.T_Sample]:
+        "Yield queue depth gauges for every open session."
+
+        labels = {"worker": self.worker}
+        if self.__transport is not None:
+            labels["transport"] = self.__transport
+
+        yield "pbj_sessions", labels, len(self.__handlers)
+
+        stats = self.scheduler.stats()
+        yield "pbj_scheduler_running", labels, stats["running"]
+        yield "pbj_scheduler_queued", labels, stats["queued"]
+
+        for i, j in self.__handlers.items():
+            labels = {"session": str(i)}
+            stats = j.flow_stats()
+
+            yield "pbj_session_outgoing_bytes", labels, stats["queued"]
+            if "messages" in stats:
+                yield "pbj_session_outgoing_messages", labels, stats["messages"]
+            yield "pbj_session_incoming_frames", labels, stats["frames"] + stats["held"]
+            yield "pbj_session_commands", labels, stats["commands"]
+
+# clients
+
+class DuplexClient:
+    """The calling end of a session, over any duplex handler.  
+    Commands are run with `open()` (streaming, through the same `CommandDuplexContext`
+    the server uses) or `call()` (unary)."""
+
+    def __init__(self, handler:BaseDuplexHandler):
+        self.__handler = handler
+        self.__next_id = 0
+
+    def __new_id(self) -> bytes:
+        self.__next_id = self.__next_id % 0xfffffffe + 1
+        return self.__next_id.to_bytes(4, "little", signed=False)
+
+    def __initiation(self, cmd:bytes, command:str|bytes) -> bytes:
+        if isinstance(command, str):
+            command = bytes(command, "utf8")
+        return COMMAND_ROOT + cmd + len(command).to_bytes(1, "little", signed=False) + command
+
+    async def open(self, command:str|bytes) -> CommandDuplexContext:
+        """Start a streaming command, returning its context.  
+        The server's closing status is available as `close_status` and `close_reason` once it ends."""
+
+        cmd = self.__new_id()
+        ctx = CommandDuplexContext(self.__handler, cmd)
+        await self.__handler.send(self.__initiation(cmd, command))
+        return ctx
+
+    async def call(self, command:str|bytes, value:typing.Any=None, structured:bool=False) -> typing.Any:
+        """Run a unary command with one argument, returning its reply.  
+        Raises `CommandFailed` with the server's status and reason if it fails."""
+
+        cmd = self.__new_id()
+        queue = self.__handler.attach(cmd)
+
+        try:
+            await self.__handler.send(self.__initiation(cmd, command) + await pack_frame(value, structured))
+
+            fragments = []
+            while True:
+                data = await queue.get()
+                if data.startswith(FRAME_FRAGMENT) or data.startswith(FRAME_FRAGMENT_END):
+                    fragments.append(data[1:])
+                    if data.startswith(FRAME_FRAGMENT_END):
+                        data = b"".join(fragments)
+                        break
+                else:
+                    break
+        finally:
+            await self.__handler.clean(cmd)
+
+        if data.startswith(FRAME_EOF):
+            status, reason = await unpack_eof(data[1:])
+            raise CommandFailed(status, reason)
+
+        status, reason, reply = await unpack_result(data)
+        if status != StatusCode.OK:
+            raise CommandFailed(status, reason)
+        return unpack_frame(reply)
+
+# publish/subscribe
+
+class SharedFrame:
+    """A packed frame sent to many commands.  
+    It is split into fragments at most once for each fragment size, and every
+    command is sent the same buffers."""
+
+    __slots__ = ("frame", "__pieces")
+
+    def __init__(self, frame:bytes):
+        self.frame = frame
+        self.__pieces = {}
+
+    def pieces(self, limit:int|None) -> list[bytes]:
+        "Get the frame, or its fragments if it is over `limit` bytes."
+
+        if limit is None or len(self.frame) <= limit:
+            return [self.frame]
 
-            stream = CommandDuplexContext(self.__wraps, cmd_id)
+        res = self.__pieces.get(limit)
+        if res is None:
+            res = self.__pieces[limit] = split_frame(self.frame, limit)
+        return res
+
+class PubSub:
+    """Topic-based broadcast to long-lived commands, in any number of sessions.  
+    A command subscribes its context to a topic, and stays subscribed until it
+    unsubscribes or closes. A published value is packed once, and the same frame
+    is queued for every subscriber, so the cost of encoding it doesn't grow with
+    the number of sessions.
+
+    Subscribers are sent to concurrently, so one session with a full buffer
+    doesn't hold up the rest. Subscribers that are closed, or shed for not
+    keeping up, are unsubscribed."""
+
+    __topics: dict[str,dict[CommandDuplexContext,None]]
+
+    def __init__(self):
+        self.__topics = {}
+        self.__stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self, topic:str, ctx:CommandDuplexContext):
+        if ctx.closed is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        self.__topics.setdefault(topic, {})[ctx] = None
+
+    def unsubscribe(self, topic:str, ctx:CommandDuplexContext):
+        subs = self.__topics.get(topic)
+        if subs is not None:
+            subs.pop(ctx, None)
+            if not subs:
+                del self.__topics[topic]
+
+    def subscribers(self, topic:str) -> int:
+        return len(self.__topics.get(topic, ()))
+
+    async def publish(self, topic:str, value:typing.Any, structured:bool=False) -> int:
+        """Send a value to every subscriber of `topic`, returning the number it was queued for.  
+        Values are packed as in `CommandDuplexContext.send()`."""
+
+        if not topic in self.__topics:
+            return 0
+        return await self.publish_frame(topic, await pack_frame(value, structured))
+
+    async def publish_frame(self, topic:str, frame:bytes) -> int:
+        "Send an already-packed frame to every subscriber of `topic`, returning the number it was queued for."
+
+        subs = self.__topics.get(topic)
+        if not subs:
+            return 0
+
+        stale = [i for i in subs if i.closed is True]
+        for i in stale:
+            self.unsubscribe(topic, i)
+
+        shared = SharedFrame(frame)
+        targets = list(subs)
+        loop = asyncio.get_running_loop()
+
+        # Sends run eagerly, so those with room finish straight away, and only
+        # those that have to wait for room are left as tasks to wait on.
+        tasks = [asyncio.eager_task_factory(loop, i.send_shared(shared)) for i in targets]
+        pending = [i for i in tasks if not i.done()]
+        if pending:
+            try:
+                await asyncio.wait(pending)
+            except asyncio.CancelledError:
+                for i in pending:
+                    i.cancel()
+                raise
+
+        delivered = 0
+        error = None
+
+        for ctx, task in zip(targets, tasks):
+            res = task.exception()
+            if res is None:
+                delivered += 1
+            elif isinstance(res, (Overloaded, RuntimeError, asyncio.QueueShutDown)):
+                # The subscriber was shed, closed, or its session went away.
+                self.unsubscribe(topic, ctx)
+            elif error is None:
+                error = res
+
+        self.__stats["published"] += 1
+        self.__stats["delivered"] += delivered
+        self.__stats["dropped"] += len(stale) + len(targets) - delivered
+
+        if error is not None:
+            raise error
+        return delivered
+
+    def prune(self):
+        "Unsubscribe every closed command."
+
+        for topic, subs in list(self.__topics.items()):
+            for i in [i for i in subs if i.closed is True]:
+                self.unsubscribe(topic, i)
+
+    def stats(self) -> dict[str,int]:
+        return {
+            **self.__stats,
+            "topics": len(self.__topics),
+            "subscribers": sum(len(i) for i in self.__topics.values())
+        }
+
+# result cache
+
+class ResultCache:
+    """Keeps the replies of unary commands, so identical requests don't run their handler again.  
+    Entries are keyed on the command name and the argument frame exactly as received, and
+    hold the result frame exactly as sent, so a hit costs no decoding or encoding. Only
+    successful replies are kept, each for `ttl` seconds. Past `max_entries` entries or
+    `max_bytes` bytes, the least recently used entries are evicted.
+
+    Identical requests arriving while the handler runs wait for its reply instead of
+    running it again. Call `invalidate()` when the data behind a command changes."""
+
+    __entries: collections.OrderedDict[tuple[bytes,bytes],tuple[float,SharedFrame]]
+
+    def __init__(self, max_entries:int=1024, max_bytes:int=16 * 1024 * 1024, ttl:float=30, name:str="default"):
+        self.name = name
+        self.ttl = ttl
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__entries = collections.OrderedDict()
+        self.__flights = {}
+        self.__generation = 0
+        self.__bytes = 0
+        self.__stats = {
+            "hits": 0, "misses": 0, "coalesced": 0,
+            "stored": 0, "evicted": 0, "expired": 0, "invalidated": 0
+        }
+        metrics.registry.collector(self.collect_metrics)
+
+    def __count(self, result:str, command:bytes):
+        self.__stats[result] += 1
+        if metrics.enabled:
+            metrics.cache_requests.inc(self.name, str(command, "utf8", "replace"), result)
+
+    def __remove(self, key:tuple[bytes,bytes]) -> bool:
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return False
+
+        self.__bytes -= len(entry[1].frame)
+        return True
+
+    def __store(self, key:tuple[bytes,bytes], frame:SharedFrame):
+        if len(frame.frame) > self.__max_bytes:
+            return
+
+        self.__remove(key)
+        self.__entries[key] = (time.perf_counter() + self.ttl, frame)
+        self.__bytes += len(frame.frame)
+        self.__stats["stored"] += 1
+
+        while len(self.__entries) > self.__max_entries or self.__bytes > self.__max_bytes:
+            _, (_, old) = self.__entries.popitem(last=False)
+            self.__bytes -= len(old.frame)
+            self.__stats["evicted"] += 1
+
+    async def get(self,
+            command:bytes,
+            request:bytes|None,
+            compute:typing.Callable[[],typing.Awaitable[tuple[bytes,bool]]]) -> SharedFrame:
+        """Get the result frame for a request, calling `compute()` if it isn't cached.  
+        `compute` returns the result frame, and whether it may be cached."""
+
+        key = (command, request or b"")
+
+        while True:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > time.perf_counter():
+                    self.__entries.move_to_end(key)
+                    self.__count("hits", command)
+                    return entry[1]
+
+                self.__remove(key)
+                self.__stats["expired"] += 1
+
+            flight = self.__flights.get(key)
+            if flight is None:
+                break
+
+            # Shielded, so a waiter going away doesn't cancel the run it shares.
+            res = await asyncio.shield(flight)
+            if res is not None:
+                self.__count("coalesced", command)
+                return res
+            # The run failed or was cancelled; try again.
+
+        flight = self.__flights[key] = asyncio.get_running_loop().create_future()
+        generation = self.__generation
+        self.__count("misses", command)
+        res = None
+
+        try:
+            frame, cacheable = await compute()
+            res = SharedFrame(frame)
+
+            # Results computed across an invalidation may be stale, so they aren't kept.
+            if cacheable is True and generation == self.__generation:
+                self.__store(key, res)
+        finally:
+            del self.__flights[key]
+            flight.set_result(res)
+        return res
+
+    def invalidate(self, command:str|bytes|None=None, request:bytes|None=None) -> int:
+        """Drop cached results: every result, those of one `command`, or with a `request`
+        too, the one for that argument frame (see `encode_frame()`). Handlers already
+        running won't have their results kept. Returns the number of entries dropped."""
+
+        self.__generation += 1
+
+        if isinstance(command, str):
+            command = bytes(command, "utf8")
+
+        if command is None:
+            keys = list(self.__entries)
+        elif request is not None:
+            keys = [(command, request)]
+        else:
+            keys = [i for i in self.__entries if i[0] == command]
+
+        dropped = sum(self.__remove(i) for i in keys)
+        self.__stats["invalidated"] += dropped
+        return dropped
+
+    def collect_metrics(self) -> typing.Iterator[metrics.T_Sample]:
+        "Yield cache size gauges."
+
+        labels = {"cache": self.name}
+        yield "pbj_cache_entries", labels, len(self.__entries)
+        yield "pbj_cache_bytes", labels, self.__bytes
+
+    def stats(self) -> dict[str,int]:
+        "Get cache counters."
+
+        return {**self.__stats, "entries": len(self.__entries), "bytes": self.__bytes, "running": len(self.__flights)}
+
+# handler pools
+
+def run_pooled(fn:typing.Callable, queued:float, arg:typing.Any, conn=None) -> tuple[typing.Any,BaseException|None,float,float]:
+    """Run a pooled handler in a worker, returning its result, exception, and time queued and running.  
+    Timings are handed back rather than recorded here, so stats are only touched on the loop."""
+
+    start = time.perf_counter()
+    res, error = None, None
+
+    try:
+        if conn is None:
+            res = fn(arg)
+        else:
+            with conn:
+                fn(PoolContext(conn))
+    except BaseException as e:
+        error = e
+    return res, error, start - queued, time.perf_counter() - start
+
+class PoolContext:
+    """Stand-in for `CommandDuplexContext` given to handlers running in a `HandlerPool`.  
+    It has the same methods, but as blocking calls rather than coroutines. Frames are
+    packed and unpacked here, in the worker, and only raw frames cross to the event loop.  
+    Once the command closes on the loop side, calls raise `CommandCancelled`. Long
+    computations can check `cancelled()` to stop early."""
+
+    def __init__(self, conn:multiprocessing.connection.Connection):
+        self.__conn = conn
+        self.__lock = False
+        self.close_status = -1
+        self.close_reason = ""
+
+    def __call(self, *message):
+        if self.__lock is True:
+            raise RuntimeError("Attempt to operate on closed command context")
+
+        try:
+            self.__conn.send(message)
+        except (OSError, EOFError):
+            raise CommandCancelled("Command closed") from None
+
+    def cancelled(self) -> bool:
+        "Check whether the command has closed on the event loop side."
+
+        # The loop only writes unprompted to cancel (or closes the pipe, which also polls true).
+        return self.__conn.poll()
+
+    def send(self, data:str|bytes|dict|list|int|float|None, structured:bool=False):
+        self.__call("send", encode_frame(data, structured))
+
+    def send_frame(self, frame:bytes):
+        self.__call("send", frame)
+
+    def send_many(self, values:typing.Iterable[typing.Any], structured:bool=False):
+        # Crosses to the loop as one message, and is queued there as one segment.
+        self.__call("send_many", [encode_frame(i, structured) for i in values])
+
+    def recv(self) -> str|bytes|dict|list|int|float|None:
+        return unpack_frame(self.recv_frame())
+
+    def recv_frame(self) -> bytes:
+        self.__call("recv")
+
+        try:
+            reply = self.__conn.recv()
+        except (OSError, EOFError):
+            raise CommandCancelled("Command closed") from None
+
+        if reply[0] == "frame":
+            return reply[1]
+        if reply[0] == "closed":
+            # The client closed the command, or the session went away.
+            self.__lock = True
+            self.close_status, self.close_reason = reply[1], reply[2]
+            raise asyncio.QueueShutDown
+        raise CommandCancelled("Command closed")
+
+    def close(self, status:bytes=b"\x00", reason:str="pbj:ok"):
+        self.__call("close", status, reason)
+        self.__lock = True
+
+    def __enter__(self):
+        return self
 
-            if self.__commands.has(handler):
-                asyncio.create_task(self.__commands.get(handler)(stream))
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Anything else is handled by the command's context on the event loop.
+        return exc_type is asyncio.QueueShutDown and self.__lock is True
+
+class HandlerPool:
+    """Runs command handlers in a pool of `workers` processes (or threads, if
+    `processes` is unset), so heavy computation doesn't stall the event loop.  
+    Register handlers with `CommandHandler.command(..., pool=pool)`. Handlers are
+    plain functions: unary handlers take the decoded argument and return the reply,
+    and streaming handlers take a `PoolContext`. In process pools, handlers, arguments
+    and replies must be picklable, so handlers must be defined at module level.
+
+    When a command closes, a handler that hasn't started yet is dropped, and a running
+    one is told to stop (see `PoolContext`). Utilization is reported through `stats()`
+    and, with metrics enabled, as gauges labelled with the pool's `name`."""
+
+    def __init__(self, workers:int=4, processes:bool=True, name:str="default"):
+        self.name = name
+        self.workers = workers
+        self.__processes = processes
+        self.__pool = None
+        self.__running = 0
+        self.__created = time.perf_counter()
+        self.__stats = {
+            "completed": 0, "failed": 0, "cancelled": 0,
+            "queue_time": 0.0, "max_queue_time": 0.0, "busy_time": 0.0
+        }
+        metrics.registry.collector(self.collect_metrics)
+
+    def __executor(self) -> concurrent.futures.Executor:
+        # Created on first use, so defining a pool at import time doesn't start any workers.
+        if self.__pool is None:
+            if self.__processes is True:
+                # Forked workers would inherit the loop's sockets, keeping connections open after they close.
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self.__pool = concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context(method))
             else:
-                await stream.send(await pack_eof(STATUS_NOTFOUND, "pbj:command_not_exist"))
+                self.__pool = concurrent.futures.ThreadPoolExecutor(self.workers, f"pbj-{self.name}")
+        return self.__pool
+
+    async def __run(self, fn:typing.Callable, arg:typing.Any, conn=None, on_submit=None) -> typing.Any:
+        future = self.__executor().submit(run_pooled, fn, time.perf_counter(), arg, conn)
+        self.__running += 1
+
+        try:
+            if on_submit is not None:
+                await on_submit(future)
+            res, error, wait, elapsed = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self.__stats["cancelled"] += 1
+            raise
+        finally:
+            self.__running -= 1
+
+        self.__stats["queue_time"] += wait
+        self.__stats["max_queue_time"] = max(self.__stats["max_queue_time"], wait)
+        self.__stats["busy_time"] += elapsed
+        self.__stats["failed" if error is not None else "completed"] += 1
+
+        if metrics.enabled:
+            metrics.pool_seconds.observe(elapsed, self.name)
+
+        if error is not None:
+            raise error
+        return res
+
+    async def __serve(self, ctx:CommandDuplexContext, conn:multiprocessing.connection.Connection, future:concurrent.futures.Future):
+        # Answer the worker's requests until its handler returns.
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        done = asyncio.wrap_future(future)
+        loop.add_reader(conn.fileno(), readable.set)
+
+        try:
+            while True:
+                while conn.poll():
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        # The worker closed its end once the handler returned, and everything sent before has been read.
+                        return
+                    await self.__answer(ctx, conn, message)
+
+                # Anything the handler sent before returning is already in the pipe.
+                if done.done():
+                    return
+
+                readable.clear()
+                waiter = asyncio.ensure_future(readable.wait())
+                try:
+                    await asyncio.wait((done, waiter), return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+        finally:
+            loop.remove_reader(conn.fileno())
+
+    async def __answer(self, ctx:CommandDuplexContext, conn:multiprocessing.connection.Connection, message:tuple):
+        match message[0]:
+            case "send":
+                await ctx.send_frame(message[1])
+            case "send_many":
+                writer = ctx.writer()
+                for i in message[1]:
+                    writer.write_frame(i)
+                await writer.flush()
+            case "recv":
+                try:
+                    conn.send(("frame", await ctx.recv_frame()))
+                except (asyncio.QueueShutDown, RuntimeError):
+                    conn.send(("closed", ctx.close_status, ctx.close_reason))
+            case "close":
+                await ctx.close(message[1], message[2])
+
+    async def __stream(self, callback:typing.Callable, ctx:CommandDuplexContext):
+        ours, theirs = multiprocessing.Pipe()
+        submitted = []
+
+        async def serve(future:concurrent.futures.Future):
+            submitted.append(future)
+            try:
+                await self.__serve(ctx, ours, future)
+            except BaseException:
+                # The command closed (or failed) on this side, so the handler is stopped.
+                future.cancel()
+                try:
+                    ours.send(("cancel",))
+                except OSError:
+                    pass
+                raise
+
+        try:
+            async with ctx:
+                await self.__run(callback, None, theirs, serve)
+        finally:
+            ours.close()
+            # A thread still running the handler shares this end, and closes it itself.
+            if self.__processes is True or all(i.done() for i in submitted):
+                theirs.close()
+
+    def wrap(self, callback:typing.Callable, unary:bool=False) -> typing.Callable[[typing.Any],typing.Awaitable[typing.Any]]:
+        "Get a coroutine function that runs `callback` in this pool, for `CommandHandler`."
+
+        async def run_unary(arg:typing.Any) -> typing.Any:
+            return await self.__run(callback, arg)
+
+        async def run_stream(ctx:CommandDuplexContext):
+            await self.__stream(callback, ctx)
+
+        return run_unary if unary is True else run_stream
+
+    def collect_metrics(self) -> typing.Iterator[metrics.T_Sample]:
+        "Yield utilization gauges."
+
+        labels = {"pool": self.name}
+        yield "pbj_pool_workers", labels, self.workers
+        yield "pbj_pool_tasks", labels, self.__running
+        yield "pbj_pool_busy_seconds", labels, self.__stats["busy_time"]
+        yield "pbj_pool_utilization", labels, self.utilization()
+
+    def utilization(self) -> float:
+        "Get the share of worker time spent running handlers since the pool was created."
+
+        return self.__stats["busy_time"] / (self.workers * (time.perf_counter() - self.__created))
+
+    def stats(self) -> dict[str,int|float]:
+        "Get pool counters. Times are totals, in seconds."
+
+        return {**self.__stats, "running": self.__running, "utilization": self.utilization()}
+
+    def shutdown(self, wait:bool=True):
+        "Stop the workers. Handlers that haven't started are dropped."
+
+        if self.__pool is not None:
+            self.__pool.shutdown(wait, cancel_futures=True)
+            self.__pool = None
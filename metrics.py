@@ -0,0 +1,238 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+import bisect
+import typing
+import weakref
+
+# Instrumentation is off unless `enable()` is called. Every call site checks
+# `metrics.enabled` (or `metrics.tracer`) first, so disabled metrics cost one
+# attribute lookup.
+
+enabled = False
+tracer: typing.Callable[[str,bytes],None]|None = None
+
+T_Hook = typing.Callable[[str,dict[str,str],float],None]
+T_Sample = tuple[str,dict[str,str],float]
+
+# metric types
+
+class Counter:
+    "Monotonic counter, optionally split by label values."
+
+    kind = "counter"
+
+    def __init__(self, registry:"Registry", name:str, help:str, labels:tuple[str,...]=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.__registry = registry
+        self.__values = {}
+
+    def inc(self, *values:str, by:float=1):
+        self.__values[values] = self.__values.get(values, 0) + by
+        self.__registry.notify(self.name, self.labels, values, by)
+
+    def samples(self) -> typing.Iterator[T_Sample]:
+        for i, j in self.__values.items():
+            yield self.name, dict(zip(self.labels, i)), j
+
+class Histogram:
+    "Bucketed distribution of observed values, optionally split by label values."
+
+    kind = "histogram"
+
+    def __init__(self,
+            registry:"Registry",
+            name:str,
+            help:str,
+            buckets:typing.Sequence[float],
+            labels:tuple[str,...]=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.__registry = registry
+        self.__values = {}
+
+    def observe(self, value:float, *values:str):
+        series = self.__values.get(values)
+        if series is None:
+            # One count per bucket, then +Inf, sum and count.
+            series = self.__values[values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+        self.__registry.notify(self.name, self.labels, values, value)
+
+    def samples(self) -> typing.Iterator[T_Sample]:
+        for i, series in self.__values.items():
+            labels = dict(zip(self.labels, i))
+            total = 0
+
+            for bound, count in zip((*self.buckets, float("inf")), series):
+                total += count
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, total
+
+            yield f"{self.name}_sum", labels, series[-2]
+            yield f"{self.name}_count", labels, series[-1]
+
+# registry
+
+def format_value(v:float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def escape_label(v:str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels:dict[str,str]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{i}="{escape_label(str(j))}"' for i, j in labels.items()) + "}"
+
+class Registry:
+    """Collection of metrics, rendered in the Prometheus text format.  
+    Gauges (such as queue depths) are read on demand from collectors, which
+    are held weakly, so registering one doesn't keep its owner alive."""
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__collectors = []
+        self.__hooks = []
+
+    def counter(self, name:str, help:str, labels:tuple[str,...]=()) -> Counter:
+        self.__metrics[name] = Counter(self, name, help, labels)
+        return self.__metrics[name]
+
+    def histogram(self, name:str, help:str, buckets:typing.Sequence[float], labels:tuple[str,...]=()) -> Histogram:
+        self.__metrics[name] = Histogram(self, name, help, buckets, labels)
+        return self.__metrics[name]
+
+    def hook(self, callback:T_Hook):
+        """Call `callback(name, labels, value)` on every counter increment and histogram
+        observation. Hooks run inline, so they should be quick."""
+
+        self.__hooks.append(callback)
+
+    def collector(self, method:typing.Callable[[],typing.Iterable[T_Sample]]):
+        "Register a bound method that yields gauge samples as `(name, labels, value)`."
+
+        self.__collectors.append(weakref.WeakMethod(method))
+
+    def notify(self, name:str, labels:tuple[str,...], values:tuple[str,...], value:float):
+        if self.__hooks:
+            labels = dict(zip(labels, values))
+            for i in self.__hooks:
+                i(name, labels, value)
+
+    def collect(self) -> typing.Iterator[T_Sample]:
+        "Yield every current gauge sample."
+
+        alive = []
+        for i in self.__collectors:
+            method = i()
+            if method is not None:
+                alive.append(i)
+                yield from method()
+        self.__collectors[:] = alive
+
+    def render(self) -> str:
+        "Render every metric in the Prometheus text exposition format."
+
+        lines = []
+        for i in self.__metrics.values():
+            lines.append(f"# HELP {i.name} {i.help}")
+            lines.append(f"# TYPE {i.name} {i.kind}")
+            for name, labels, value in i.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        gauges = {}
+        for name, labels, value in self.collect():
+            gauges.setdefault(name, []).append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        for i, j in gauges.items():
+            lines.append(f"# TYPE {i} gauge")
+            lines.extend(j)
+
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# built-in metrics
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+commands_started = registry.counter(
+    "pbj_commands_started_total", "Commands started, by command name.", ("command",)
+)
+commands_finished = registry.counter(
+    "pbj_commands_finished_total", "Commands finished, by command name and result.", ("command", "result")
+)
+commands_rejected = registry.counter(
+    "pbj_commands_rejected_total", "Command initiations rejected, by reason.", ("reason",)
+)
+command_seconds = registry.histogram(
+    "pbj_command_seconds", "Command handler run time, by command name.", LATENCY_BUCKETS, ("command",)
+)
+poll_messages = registry.histogram(
+    "pbj_poll_batch_messages", "Messages in each long-poll response.", COUNT_BUCKETS
+)
+poll_bytes = registry.histogram(
+    "pbj_poll_batch_bytes", "Uncompressed size of each long-poll response.", SIZE_BUCKETS
+)
+poll_hold_seconds = registry.histogram(
+    "pbj_poll_hold_seconds", "Time each long-poll request is held before its response.", LATENCY_BUCKETS
+)
+scheduler_queue_seconds = registry.histogram(
+    "pbj_scheduler_queue_seconds", "Time commands wait to start, by priority.", LATENCY_BUCKETS, ("priority",)
+)
+cache_requests = registry.counter(
+    "pbj_cache_requests_total", "Result cache lookups, by cache, command and result.", ("cache", "command", "result")
+)
+pool_seconds = registry.histogram(
+    "pbj_pool_seconds", "Time handlers spend running in a handler pool, by pool.", LATENCY_BUCKETS, ("pool",)
+)
+auth_seconds = registry.histogram(
+    "pbj_auth_seconds", "Key verification time, including time queued, by result.", LATENCY_BUCKETS, ("result",)
+)
+
+# control
+
+def enable(on:bool=True):
+    "Turn the built-in metrics on or off."
+
+    global enabled
+    enabled = on
+
+def trace(callback:typing.Callable[[str,bytes],None]|None):
+    """Send every outgoing message to `callback(event, data)`, e.g. `metrics.trace(print)`.  
+    Pass `None` to turn tracing off again."""
+
+    global tracer
+    tracer = callback
+
+async def endpoint():
+    "Request handler serving the default registry. Can be used directly as a Quart endpoint."
+
+    return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
@@ -0,0 +1,164 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+import time
+import sqlite3
+import asyncio
+import threading
+import concurrent.futures
+
+# base store
+
+class SessionStore:
+    """Storage for session state shared between worker processes.  
+    A store only holds what another worker needs to recognise a session:
+    its ID, token hash, expiry (as wall-clock time) and owning worker.  
+    Queues and command state always stay in the owning process."""
+
+    async def allocate(self, owner:str, expiry:float) -> int:
+        """Allocate a new, unique session ID owned by `owner`.  
+        `expiry` is provisional, so the session is purged even if it is never saved."""
+        pass
+
+    async def save(self, id:int, token:bytes, expiry:float):
+        "Store the token hash and expiry of a session."
+        pass
+
+    async def touch(self, id:int, expiry:float):
+        "Update the expiry of a session."
+        pass
+
+    async def load(self, id:int) -> tuple[bytes,float,str]|None:
+        "Get the token hash, expiry and owner of a session, or `None` if it doesn't exist."
+        pass
+
+    async def delete(self, id:int):
+        "Remove a session."
+        pass
+
+    async def purge(self, grace:float=0) -> int:
+        "Remove sessions that expired over `grace` seconds ago, returning the number removed."
+        pass
+
+# in-process store
+
+class MemorySessionStore(SessionStore):
+    "Process-local store. This is the default, and does not share sessions between workers."
+
+    __rows: dict[int,list]
+
+    def __init__(self):
+        self.__id_prog = 0
+        self.__rows = {}
+
+    async def allocate(self, owner:str, expiry:float) -> int:
+        self.__id_prog += 1
+        self.__rows[self.__id_prog] = [b"", expiry, owner]
+        return self.__id_prog
+
+    async def save(self, id:int, token:bytes, expiry:float):
+        if id in self.__rows:
+            self.__rows[id][0] = token
+            self.__rows[id][1] = expiry
+
+    async def touch(self, id:int, expiry:float):
+        if id in self.__rows:
+            self.__rows[id][1] = expiry
+
+    async def load(self, id:int) -> tuple[bytes,float,str]|None:
+        if id in self.__rows:
+            return tuple(self.__rows[id])
+
+    async def delete(self, id:int):
+        self.__rows.pop(id, None)
+
+    async def purge(self, grace:float=0) -> int:
+        cutoff = time.time() - grace
+        dead = [i for i, j in self.__rows.items() if j[1] < cutoff]
+
+        for i in dead:
+            del self.__rows[i]
+        return len(dead)
+
+# sqlite store
+
+class SQLiteSessionStore(SessionStore):
+    """Store backed by an SQLite database, shared by every worker on one machine.  
+    All workers must be given the same database path. Queries run on the store's
+    own thread, so they don't compete with other work in the default executor."""
+
+    def __init__(self, path:str, timeout:float=5):
+        self.__executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="pbj-sqlite")
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+
+        with self.__lock:
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("PRAGMA synchronous=NORMAL")
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS pbj_sessions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "token BLOB NOT NULL, "
+                "expiry REAL NOT NULL, "
+                "owner TEXT NOT NULL)"
+            )
+            self.__db.execute("CREATE INDEX IF NOT EXISTS pbj_sessions_expiry ON pbj_sessions (expiry)")
+
+    def __run(self, query:str, args:tuple=()) -> tuple[list,int,int]:
+        # Results are read under the lock, since the connection is shared between threads.
+        with self.__lock:
+            cur = self.__db.execute(query, args)
+            return cur.fetchall(), cur.lastrowid, cur.rowcount
+
+    async def __query(self, query:str, args:tuple=()) -> tuple[list,int,int]:
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, self.__run, query, args)
+
+    async def allocate(self, owner:str, expiry:float) -> int:
+        _, id, _ = await self.__query(
+            "INSERT INTO pbj_sessions (token, expiry, owner) VALUES (?, ?, ?)", (b"", expiry, owner)
+        )
+        return id
+
+    async def save(self, id:int, token:bytes, expiry:float):
+        await self.__query(
+            "UPDATE pbj_sessions SET token = ?, expiry = ? WHERE id = ?", (token, expiry, id)
+        )
+
+    async def touch(self, id:int, expiry:float):
+        await self.__query("UPDATE pbj_sessions SET expiry = ? WHERE id = ?", (expiry, id))
+
+    async def load(self, id:int) -> tuple[bytes,float,str]|None:
+        rows, _, _ = await self.__query(
+            "SELECT token, expiry, owner FROM pbj_sessions WHERE id = ?", (id,)
+        )
+        if rows:
+            return rows[0]
+
+    async def delete(self, id:int):
+        await self.__query("DELETE FROM pbj_sessions WHERE id = ?", (id,))
+
+    async def purge(self, grace:float=0) -> int:
+        _, _, count = await self.__query(
+            "DELETE FROM pbj_sessions WHERE expiry < ?", (time.time() - grace,)
+        )
+        return count
+
+    def close(self):
+        "Close the database connection."
+
+        self.__executor.shutdown()
+        with self.__lock:
+            self.__db.close()
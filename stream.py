@@ -0,0 +1,328 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+import typing
+import asyncio
+from . import main, metrics
+
+# Plain asyncio streams (TCP or Unix sockets), without HTTP.
+# Every message is a 4-byte little-endian length followed by the message itself
+# (command ID and frame), as in the long-poll batch format without the count.
+# A connection opens with a record holding the API key, which the server answers
+# with a root EOF frame: `0x00` (OK) if the key is valid, `0xb0` (Unauthorized) if not.
+
+U32 = main.U32
+
+# transport
+
+class StreamDuplexHandler(main.BaseDuplexHandler):
+    def __init__(self,
+            reader:asyncio.StreamReader,
+            writer:asyncio.StreamWriter,
+            fragment_size:int|None=65536,
+            max_message:int=16777216,
+            max_queued:int=256,
+            max_early:int=256,
+            max_buffer:int=4194304,
+            read_size:int=65536,
+            shed_timeout:float=30):
+        """Carries one session over an asyncio stream.  
+        Outgoing messages are buffered and written together with `writelines()`
+        whenever the writer is free, so messages sent while a write is in progress
+        are coalesced into the next one. At most `max_buffer` bytes wait to be
+        written; a `send()` that can't get room within `shed_timeout` seconds
+        raises `main.Overloaded`. EOF frames never wait.  
+        Incoming limits are as for `duplex.QuartLongPollHandler`."""
+
+        self.fragment_size = fragment_size
+        self.max_message = max_message
+        self.route_incoming(max_queued, max_early, shed_timeout)
+        self.buffer_outgoing(max_buffer, shed_timeout)
+        self.__reader = reader
+        self.__writer = writer
+        self.__parts = []
+        self.__max_buffer = max_buffer
+        self.__read_size = read_size
+        self.__ready = asyncio.Event()
+        self.__closed = False
+        self.__stats = {"flushes": 0, "written": 0, "written_bytes": 0, "received": 0}
+
+    async def __queue(self, parts:tuple[bytes,...], size:int, force:bool=False):
+        if metrics.tracer is not None:
+            metrics.tracer("stream.send", b"".join(parts[1:]) if len(parts) > 1 else parts[0])
+
+        await self.reserve(size, force)
+        self.__parts.extend(parts)
+        self.__stats["written"] += 1
+        self.__ready.set()
+
+    async def send(self, data:bytes):
+        # Sizes include the length prefix, so the buffer counts the bytes actually written.
+        await self.__queue((U32.pack(len(data)), data), 4 + len(data), data[4:5] == main.FRAME_EOF)
+
+    async def send_shared(self, cmd:bytes, frame:bytes):
+        # Written as separate parts, so a published frame is never copied into a new message.
+        size = len(cmd) + len(frame)
+        await self.__queue((U32.pack(size), cmd, frame), 4 + size)
+
+    async def send_segment(self, segment:main.FrameSegment):
+        # A segment is already in the stream's record format, so it is written as it is,
+        # in pieces that fit the write buffer.
+        for i in segment.split(self.__max_buffer):
+            await self.__queue((i.data,), len(i.data))
+
+    async def __read_loop(self):
+        reader = self.__reader
+        limit = self.max_message + 4
+        buf = b""
+
+        while True:
+            chunk = await reader.read(self.__read_size)
+            if not chunk:
+                return
+
+            buf = buf + chunk if buf else chunk
+            view = memoryview(buf)
+            cursor = 0
+
+            while len(buf) - cursor >= 4:
+                size, = U32.unpack_from(buf, cursor)
+                if size > limit:
+                    raise ValueError("Message is too large")
+
+                end = cursor + 4 + size
+                if end > len(buf):
+                    if size <= self.__read_size:
+                        break
+
+                    # Large messages are read in one go, rather than grown chunk by chunk.
+                    buf = buf[cursor:] + await reader.readexactly(end - len(buf))
+                    view = memoryview(buf)
+                    cursor = 0
+                    end = 4 + size
+
+                self.__stats["received"] += 1
+                await self.dispatch(view[cursor + 4:end])
+                cursor = end
+
+            buf = buf[cursor:]
+
+    async def __write_loop(self):
+        writer = self.__writer
+
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+
+            if not self.__parts:
+                if self.__closed is True:
+                    return
+                continue
+
+            parts, self.__parts = self.__parts, []
+            size = self.buffered
+            writer.writelines(parts)
+            self.__stats["flushes"] += 1
+            self.__stats["written_bytes"] += size
+            await self.release(size)
+
+            # Messages sent while the transport drains are collected for the next write.
+            await writer.drain()
+
+    async def run(self):
+        """Move messages both ways until the stream closes or the handler is shut down.  
+        Raises `ValueError` if the peer sends a malformed message."""
+
+        tasks = [asyncio.create_task(self.__read_loop()), asyncio.create_task(self.__write_loop())]
+
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for i in tasks:
+                i.cancel()
+
+            # Wake every command still waiting on the stream.
+            self.__closed = True
+            self.router.shutdown()
+            await self.close_buffer()
+
+        for i in done:
+            if i.cancelled():
+                continue
+
+            error = i.exception()
+            if isinstance(error, (asyncio.IncompleteReadError, ConnectionError)):
+                continue
+            if error is not None:
+                raise error
+
+    async def shutdown(self):
+        "Stop accepting messages, write out what is buffered and close the stream."
+
+        self.__closed = True
+        self.router.shutdown()
+        self.__ready.set()
+        await self.close_buffer()
+
+        writer = self.__writer
+        if not writer.is_closing():
+            if self.__parts:
+                writer.writelines(self.__parts)
+                self.__parts = []
+            writer.close()
+
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def admit(self) -> bool:
+        return self.buffered < self.__max_buffer
+
+    def flow_stats(self) -> dict[str,int]:
+        return {**self.__stats, **self.buffer_stats(), **self.router.stats()}
+
+async def read_record(reader:asyncio.StreamReader, limit:int) -> bytes:
+    "Read one length-prefixed record. Raises `ValueError` if it is over `limit` bytes."
+
+    size, = U32.unpack(await reader.readexactly(4))
+    if size > limit:
+        raise ValueError("Message is too large")
+    return await reader.readexactly(size)
+
+# server
+
+class StreamSessionServer(main.TransportSessionHandler):
+    """A session manager for plain TCP or Unix socket connections, without HTTP.  
+    Meant for trusted local links, such as a relay process on the same machine.
+    Each connection authenticates with the API key and is one session, which
+    lasts as long as the connection. `stream_options` are passed on to every
+    connection's `StreamDuplexHandler`."""
+
+    def __init__(self,
+            cmd_hndl:main.CommandHandler,
+            key,
+            hasher=None,
+            session_ttl:float=60,
+            stream_options:dict|None=None,
+            scheduler:main.CommandScheduler|None=None,
+            handshake_timeout:float=10,
+            **kwargs):
+        super().__init__(cmd_hndl, key, hasher, session_ttl, scheduler, "stream", **kwargs)
+        self.__stream_options = stream_options or {}
+        self.__handshake_timeout = handshake_timeout
+
+    async def __handshake(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> main.Session|None:
+        try:
+            async with asyncio.timeout(self.__handshake_timeout):
+                key = await read_record(reader, 4096)
+        except (TimeoutError, ValueError, asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        try:
+            ses = await self.authenticate(key)
+        except main.Overloaded:
+            status, reason, ses = main.StatusCode.CONFLICT, "pbj:overloaded", None
+        except ValueError:
+            status, reason, ses = main.StatusCode.UNAUTHORIZED, "pbj:unauthorized", None
+        else:
+            status, reason = main.StatusCode.OK, "pbj:ok"
+
+        reply = main.COMMAND_ROOT + await main.pack_eof(status, reason)
+        writer.writelines((U32.pack(len(reply)), reply))
+        return ses
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        "Connection handler. Can be passed directly to `asyncio.start_server()`."
+
+        ses = await self.__handshake(reader, writer)
+        if ses is None:
+            writer.close()
+            return
+
+        handler = StreamDuplexHandler(reader, writer, **self.__stream_options)
+        self.open_handler(ses, handler)
+        keepalive = asyncio.create_task(self.keepalive(ses))
+
+        try:
+            await handler.run()
+        except ValueError:
+            pass
+        finally:
+            keepalive.cancel()
+            await ses.close()
+
+    async def serve_tcp(self, host:str|None, port:int, **kwargs) -> asyncio.Server:
+        "Start listening on a TCP port. Extra arguments are passed to `asyncio.start_server()`."
+
+        return await asyncio.start_server(self.handle_connection, host, port, **kwargs)
+
+    async def serve_unix(self, path:str, **kwargs) -> asyncio.Server:
+        "Start listening on a Unix socket. Extra arguments are passed to `asyncio.start_unix_server()`."
+
+        return await asyncio.start_unix_server(self.handle_connection, path, **kwargs)
+
+# client
+
+class StreamClient(main.DuplexClient):
+    """Python end of a stream session, for services talking to a `StreamSessionServer`.  
+    Commands are run as with `main.DuplexClient`. Use `connect_tcp()` or `connect_unix()` to connect."""
+
+    def __init__(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, **options):
+        self.__handler = StreamDuplexHandler(reader, writer, **options)
+        self.__task = asyncio.create_task(self.__handler.run())
+        super().__init__(self.__handler)
+
+    @classmethod
+    async def __connect(cls, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, key:str|bytes, **options) -> typing.Self:
+        if isinstance(key, str):
+            key = bytes(key, "utf8")
+
+        writer.writelines((U32.pack(len(key)), key))
+        reply = await read_record(reader, 1024)
+        status, reason = await main.unpack_eof(reply[5:])
+
+        if status != main.StatusCode.OK:
+            writer.close()
+            if status == main.StatusCode.CONFLICT:
+                raise main.Overloaded(f"Server is overloaded ({reason})")
+            raise ValueError(f"Authentication failed ({reason})")
+
+        return cls(reader, writer, **options)
+
+    @classmethod
+    async def connect_tcp(cls, host:str, port:int, key:str|bytes, **options) -> typing.Self:
+        """Connect to a server over TCP and authenticate.  
+        Raises `ValueError` if the key is rejected. Other keyword arguments are passed on to `StreamDuplexHandler`."""
+
+        reader, writer = await asyncio.open_connection(host, port)
+        return await cls.__connect(reader, writer, key, **options)
+
+    @classmethod
+    async def connect_unix(cls, path:str, key:str|bytes, **options) -> typing.Self:
+        "Connect to a server over a Unix socket and authenticate. See `connect_tcp()`."
+
+        reader, writer = await asyncio.open_unix_connection(path)
+        return await cls.__connect(reader, writer, key, **options)
+
+    def flow_stats(self) -> dict[str,int]:
+        return self.__handler.flow_stats()
+
+    async def close(self):
+        "Close the connection, ending every open command."
+
+        await self.__handler.shutdown()
+        self.__task.cancel()
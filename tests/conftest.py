@@ -0,0 +1,52 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+# Makes the repository importable as `pbnj`, whatever its directory is called.
+
+import sys
+import pathlib
+import importlib.util
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+if not "pbnj" in sys.modules:
+    spec = importlib.util.spec_from_file_location("pbnj", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["pbnj"] = module
+    spec.loader.exec_module(module)
+
+from pbnj import main, duplex
+
+class PollHandler(main.BaseDuplexHandler):
+    "The outgoing side of `duplex.QuartLongPollHandler`, driven without requests."
+
+    fragment_size = 65536
+
+    def __init__(self, max_queued:int=256, shed_timeout:float=30, **options):
+        self.route_incoming(max_queued, 256, shed_timeout)
+        self.manager = duplex.QuartLongPollManager(None, **options)
+
+    async def send(self, data:bytes):
+        await self.manager.put(data)
+
+    async def send_segment(self, segment:main.FrameSegment):
+        await self.manager.put(segment)
+
+@pytest.fixture
+def poll_handler() -> type[PollHandler]:
+    return PollHandler
@@ -0,0 +1,59 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from pbnj import main
+
+CMD = (1).to_bytes(4, "little")
+
+# batched sends
+
+def test_send_many_limits(poll_handler):
+    async def run():
+        window, max_batch = 65536, 131072
+        budget = main.MemoryBudget(98304)
+        handler = poll_handler(window=window, max_batch=max_batch, budget=budget)
+        ctx = main.CommandDuplexContext(handler, CMD)
+        values = [bytes([i % 256]) * 1024 for i in range(2000)]
+
+        task = asyncio.create_task(ctx.send_many(values))
+        received = []
+
+        while len(received) < len(values):
+            body = await handler.manager.pack_outgoing()
+            assert len(body) <= max_batch + 4
+            assert handler.manager.flow_stats()["queued"] <= window
+            received.extend(bytes(i[5:]) for i in main.unpack_batch(body))
+
+        await task
+        assert received == values
+        assert budget.stats()["peak"] <= budget.limit
+        assert budget.used == 0
+
+    asyncio.run(run())
+
+def test_segment_split():
+    writer = bytearray()
+    for i in range(10):
+        writer += main.U32.pack(104) + CMD + bytes(100)
+    segment = main.FrameSegment(CMD, writer, 10)
+
+    parts = segment.split(250)
+    assert [i.count for i in parts] == [2, 2, 2, 2, 2]
+    assert b"".join(bytes(i.data) for i in parts) == bytes(writer)
+    assert segment.split(len(writer)) == [segment]
+    assert [i.count for i in segment.split(10)] == [1] * 10
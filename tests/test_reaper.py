@@ -0,0 +1,116 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from pbnj import main
+
+# reaper
+
+async def start(handler:main.SessionHandler) -> main.Session:
+    # Reaps are run by hand, so the background reaper is stopped.
+    ses = await handler.start_session()
+    await handler.stop_reaper()
+    return ses
+
+def test_expired_session_reaped():
+    async def run():
+        handler = main.SessionHandler("", session_ttl=.01)
+        ses = await start(handler)
+        closed = []
+
+        async def hook(s:main.Session):
+            closed.append(s)
+        ses.on_close(hook)
+
+        await asyncio.sleep(.03)
+        assert await handler.reap() == 1
+        assert ses.dead is True
+        assert closed == [ses]
+
+        stats = handler.reaper_stats()
+        assert stats["reaped"] == 1
+        assert stats["sessions"] == 0
+        assert stats["queued"] == 0
+
+    asyncio.run(run())
+
+def test_bumped_session_requeued():
+    async def run():
+        handler = main.SessionHandler("", session_ttl=.01)
+        ses = await start(handler)
+        ses.bump(60)
+
+        await asyncio.sleep(.03)
+        assert await handler.reap() == 0
+        assert ses.dead is False
+
+        stats = handler.reaper_stats()
+        assert stats["requeued"] == 1
+        assert stats["reaped"] == 0
+        assert stats["sessions"] == 1
+        assert stats["queued"] == 1
+
+    asyncio.run(run())
+
+def test_closed_session_dropped():
+    async def run():
+        handler = main.SessionHandler("", session_ttl=.01)
+        ses = await start(handler)
+        await ses.close()
+
+        await asyncio.sleep(.03)
+        assert await handler.reap() == 0
+
+        stats = handler.reaper_stats()
+        assert stats["dropped"] == 1
+        assert stats["reaped"] == 0
+        assert stats["queued"] == 0
+
+    asyncio.run(run())
+
+def test_shortened_expiry_reaped():
+    async def run():
+        handler = main.SessionHandler("", session_ttl=60)
+        ses = await start(handler)
+        await ses.rotate_key(.01)
+
+        await asyncio.sleep(.03)
+        assert await handler.reap() == 1
+        assert ses.dead is True
+
+        # The entry for the original expiry is left behind, and dropped when it comes up.
+        assert handler.reaper_stats()["queued"] == 1
+
+    asyncio.run(run())
+
+def test_superseded_entry_dropped():
+    async def run():
+        handler = main.SessionHandler("", session_ttl=.02)
+        ses = await start(handler)
+        ses.bump(.01)
+        ses.bump(60)
+
+        await asyncio.sleep(.04)
+        assert await handler.reap() == 0
+        assert ses.dead is False
+
+        stats = handler.reaper_stats()
+        assert stats["requeued"] == 1
+        assert stats["dropped"] == 1
+        assert stats["queued"] == 1
+
+    asyncio.run(run())
@@ -0,0 +1,55 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from pbnj import main
+
+CMD = (1).to_bytes(4, "little")
+
+# shedding
+
+def test_root_never_shed():
+    async def run():
+        router = main.FrameRouter(max_queued=1, shed_timeout=.05)
+        queue = router.attach(main.COMMAND_ROOT)
+        await router.dispatch(main.COMMAND_ROOT + b"a")
+
+        task = asyncio.create_task(router.dispatch(main.COMMAND_ROOT + b"b"))
+        await asyncio.sleep(.2)
+        assert not task.done()
+
+        assert await queue.get() == b"a"
+        assert await task is None
+        assert await queue.get() == b"b"
+
+    asyncio.run(run())
+
+def test_stalled_command_shed(poll_handler):
+    async def run():
+        handler = poll_handler(max_queued=1, shed_timeout=.05)
+        handler.attach(CMD)
+        await handler.dispatch(CMD + b"a")
+        await handler.dispatch(CMD + b"b")
+
+        messages = main.unpack_batch(await handler.manager.pack_outgoing())
+        assert len(messages) == 1
+        assert bytes(messages[0][:4]) == CMD
+        assert messages[0][4:5] == main.FRAME_EOF
+        assert await main.unpack_eof(bytes(messages[0][5:])) == (main.StatusCode.TIME_OUT, "pbj:receiver_stalled")
+        assert handler.router.stats()["stalled"] == 1
+
+    asyncio.run(run())
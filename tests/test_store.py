@@ -0,0 +1,54 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import time
+import asyncio
+import pytest
+from pbnj import main, store
+
+@pytest.fixture(params=["memory", "sqlite"])
+def session_store(request, tmp_path) -> store.SessionStore:
+    if request.param == "memory":
+        yield store.MemorySessionStore()
+    else:
+        s = store.SQLiteSessionStore(str(tmp_path / "sessions.db"))
+        yield s
+        s.close()
+
+def test_unsaved_session_purged(session_store:store.SessionStore):
+    async def run():
+        # Allocated by a worker that died before saving it.
+        lost = await session_store.allocate("a", time.time() - 1)
+        kept = await session_store.allocate("a", time.time() + 60)
+
+        assert await session_store.purge() == 1
+        assert await session_store.load(lost) is None
+        assert await session_store.load(kept) is not None
+
+    asyncio.run(run())
+
+def test_session_allocated_with_expiry(session_store:store.SessionStore):
+    async def run():
+        handler = main.SessionHandler("", session_ttl=30, store=session_store)
+        ses = await handler.start_session()
+        await handler.stop_reaper()
+
+        _, expiry, owner = await session_store.load(ses.id)
+        assert owner == handler.worker
+        assert time.time() < expiry <= time.time() + 30
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import socket
+import asyncio
+from pbnj import main, stream
+
+CMD = (1).to_bytes(4, "little")
+
+def test_buffer_counts_written_bytes():
+    async def run():
+        near, far = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=near)
+        peer, _ = await asyncio.open_connection(sock=far)
+        handler = stream.StreamDuplexHandler(reader, writer)
+
+        segment = bytearray()
+        for i in (b"x", b"yy"):
+            segment += main.U32.pack(5 + len(i)) + CMD + main.FRAME_BINARY + i
+
+        await handler.send(CMD + main.FRAME_BINARY + b"abc")
+        await handler.send_shared(CMD, main.FRAME_BINARY + b"de")
+        await handler.send_segment(main.FrameSegment(CMD, segment, 2))
+        queued = handler.flow_stats()["queued"]
+
+        # Shutting down writes out the buffer and closes the stream.
+        await handler.shutdown()
+        assert queued == len(await peer.read())
+
+    asyncio.run(run())
@@ -0,0 +1,74 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import asyncio
+import pytest
+from pbnj import main
+
+# resumption tickets
+
+def handlers(*workers:str, **kwargs) -> list[main.SessionHandler]:
+    return [main.SessionHandler("", worker=i, **kwargs) for i in workers]
+
+async def stop(*handlers:main.SessionHandler):
+    for i in handlers:
+        await i.stop_reaper()
+
+def test_ticket_single_use():
+    async def run():
+        secret = os.urandom(32)
+        a, = handlers("a", ticket_secret=secret)
+        ses = await a.start_session()
+
+        ticket = a.issue_ticket(ses)
+        assert await a.resume(ticket) is ses
+        with pytest.raises(ValueError):
+            await a.resume(ticket)
+
+        older = a.issue_ticket(ses)
+        newer = a.issue_ticket(ses)
+        with pytest.raises(ValueError):
+            await a.resume(older)
+
+        await ses.close()
+        with pytest.raises(ValueError):
+            await a.resume(newer)
+
+        await stop(a)
+
+    asyncio.run(run())
+
+def test_ticket_other_worker():
+    async def run():
+        secret = os.urandom(32)
+        a, b = handlers("a", "b", ticket_secret=secret)
+        ses = await a.start_session()
+        local = await b.start_session()
+        assert local.id == ses.id
+
+        resumed = await b.resume(a.issue_ticket(ses))
+        assert resumed is not local
+        assert resumed is not ses
+
+        restarted, = handlers("a", ticket_secret=secret)
+        fresh = await restarted.start_session()
+        assert await restarted.resume(a.issue_ticket(ses)) is not fresh
+
+        await stop(a, b, restarted)
+
+    asyncio.run(run())
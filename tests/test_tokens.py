@@ -0,0 +1,103 @@
+# This file is part of PB\&J.
+
+# PB\&J is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+
+# PB\&J is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with PB\&J; see the file LICENSE.md.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import asyncio
+import pytest
+from pbnj import main
+
+# session tokens
+
+def handlers(*workers:str, **kwargs) -> list[main.SessionHandler]:
+    return [main.SessionHandler("", worker=i, **kwargs) for i in workers]
+
+async def stop(*handlers:main.SessionHandler):
+    for i in handlers:
+        await i.stop_reaper()
+
+def test_signed_token_owner():
+    async def run():
+        secret = os.urandom(32)
+        a, b = handlers("a", "b", token_secret=secret)
+        affine, = handlers("b", token_secret=secret, affinity=True)
+
+        ses = await a.start_session()
+        token = await ses.rotate_key(60)
+        # Both workers hand out the same first session ID.
+        other = await b.start_session()
+        await other.rotate_key(60)
+        assert other.id == ses.id
+
+        assert await a.test_session(ses.id, token) is ses
+        with pytest.raises(ValueError):
+            await b.test_session(ses.id, token)
+        assert await other.validate(token) is False
+
+        with pytest.raises(main.SessionMisdirected) as e:
+            await affine.test_session(ses.id, token)
+        assert e.value.owner == "a"
+
+        await stop(a, b, affine)
+
+    asyncio.run(run())
+
+def test_signed_token_restart():
+    async def run():
+        secret = os.urandom(32)
+        before, = handlers("a", token_secret=secret)
+        ses = await before.start_session()
+        token = await ses.rotate_key(60)
+
+        after, = handlers("a", token_secret=secret)
+        restarted = await after.start_session()
+        await restarted.rotate_key(60)
+
+        with pytest.raises(ValueError):
+            await after.test_session(restarted.id, token)
+
+        await stop(before, after)
+
+    asyncio.run(run())
+
+def test_unsign_strict():
+    signer = main.TicketSigner(os.urandom(32))
+    ticket = signer.sign(b"data")
+    assert signer.unsign(ticket) == b"data"
+
+    raw = bytearray(ticket, "ascii")
+    raw[-16] ^= 1
+    for i in (bytes(raw).decode(), ticket + "=", ticket + "A", " " + ticket, ticket[:-1]):
+        with pytest.raises(ValueError):
+            signer.unsign(i)
+
+def test_revocation_owner_only():
+    async def run():
+        secret = os.urandom(32)
+        a, b = handlers("a", "b", token_secret=secret)
+
+        ses = await a.start_session()
+        token = await ses.rotate_key(60)
+        await ses.close()
+
+        with pytest.raises(ValueError):
+            a.check_token(token)
+        # Other workers only read the owner, to route the token there.
+        assert b.check_token(token) == (ses.id, ses.generation, "a")
+
+        await stop(a, b)
+
+    asyncio.run(run())